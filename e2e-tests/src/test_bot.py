@@ -7,7 +7,7 @@ import time
 import asyncio
 import logging
 
-from repository import User
+from repository import User, DialogMessage
 
 
 _logger = logging.getLogger(__name__)
@@ -26,6 +26,25 @@ def mongo_connect():
     db.drop_database('valery')
 
 
+# usage is written to users by billing flush, see billing.flush_interval in config
+FLUSH_TIMEOUT = 15
+
+
+async def get_flushed_user(user_id, timeout=FLUSH_TIMEOUT):
+    """Gets user once a usage batch is applied to it or after timeout if none is"""
+
+    deadline = time.monotonic() + timeout
+    while True:
+        user = User.objects.get(username=user_id)
+        if user.usage_batches or time.monotonic() >= deadline:
+            return user
+        await asyncio.sleep(1)
+
+
+def current_dialog(user):
+    return list(DialogMessage.objects(user_id=user.id, dialog_id=user.current_dialog_id).order_by('seq'))
+
+
 async def wait_for_message(telegram_client, chatbot_id):
     loop = asyncio.get_running_loop()
     message_arrived = loop.create_future()
@@ -87,12 +106,13 @@ async def test_must_response_to_user_message(telegram_client, chatbot_id, user_i
     message = await wait_for_placeholder_changes(telegram_client, message, chatbot_id)
     assert 'Hello' in message.text or 'Greetings' in message.text or 'Hi' in message.text
 
-    user = User.objects.get(username=user_id)
+    user = await get_flushed_user(user_id)
     assert user.stats.llm_total_tokens > 0
-    assert user.current_dialog[0].role == 'user'
-    assert user.current_dialog[0].content == 'Hi there'
-    assert user.current_dialog[1].role == 'assistant'
-    assert user.current_dialog[1].content == message.text
+    dialog = current_dialog(user)
+    assert dialog[0].role == 'user'
+    assert dialog[0].content == 'Hi there'
+    assert dialog[1].role == 'assistant'
+    assert dialog[1].content == message.text
 
 
 @pytest.mark.anyio
@@ -122,7 +142,7 @@ async def test_new_dialog_command(telegram_client, chatbot_id, user_id):
     await telegram_client.send_message(chatbot_id, 'Hi there')
     message = await message_arrived
     user = User.objects.get(username=user_id)
-    while len(user.current_dialog) == 0:
+    while len(current_dialog(user)) == 0:
         user = User.objects.get(username=user_id)
         await asyncio.sleep(1)
 
@@ -133,7 +153,7 @@ async def test_new_dialog_command(telegram_client, chatbot_id, user_id):
     print(f'{message=}')
     assert message.text.startswith('Starting new dialog')
     user = User.objects.get(username=user_id)
-    assert len(user.current_dialog) == 0
+    assert len(current_dialog(user)) == 0
 
 
 @pytest.mark.anyio
@@ -188,7 +208,7 @@ async def test_voice(telegram_client: Client, chatbot_id, user_id, fn, expected,
         assert expected in message.text
         await wait_for_message(telegram_client, chatbot_id[1:])
 
-        user = User.objects.get(username=user_id)
+        user = await get_flushed_user(user_id)
         assert op(user.stats.llm_total_tokens, 0)
         assert op(user.stats.transcription_secs, 0)
 
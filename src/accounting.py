@@ -1,4 +1,14 @@
 from money import Money
+from repository import UsageBatch
+from timer_scheduler import utcnow
+import metrics
+
+from datetime import timedelta
+import asyncio
+import logging
+
+
+_logger = logging.getLogger(__name__)
 
 
 class TokenPriceCalculator:
@@ -14,7 +24,7 @@ class TransriptionPriceCalculator:
     def __init__(self, minute_price):
         self.__minute_price = Money(minute_price)
 
-    
+
     def calc(self, duration_seconds):
         duration_min = duration_seconds / 60
         return self.__minute_price * duration_min
@@ -27,10 +37,140 @@ class AccountingProvider:
             price = options['price']
             calcs[model] = TokenPriceCalculator(price)
 
-    
+        if config['transcription_backend'] == 'local':
+            minute_price = config['local_stt']['price']
+        else:
+            minute_price = config['deepgram_models'][config['deepgram_model']]['price']
+
+        self.__transcription_calc = TransriptionPriceCalculator(minute_price)
+
+
     def __getitem__(self, model_name):
-        return self.__calcs[mode]
+        return self.__calcs[model_name]
 
 
     def __contains__(self, model_name):
         return model_name in self.__calcs
+
+
+    def llm_cost(self, model_name, tokens_num):
+        return self[model_name].calc(tokens_num)
+
+
+    def transcription_cost(self, duration_seconds):
+        return self.__transcription_calc.calc(duration_seconds)
+
+
+class UsageLedger:
+    """Meters usage of users in memory and flushes it periodically as a single batch of increments,
+    so billing adds no writes per message. Batch is saved before it's applied to the users,
+    batches left unapplied e.g. by a crash are applied by reconciliation"""
+
+    def __init__(self, repository, accounting, flush_interval, reconcile_interval, reconcile_age, reconcile_batches):
+        self.__repo = repository
+        self.__accounting = accounting
+        self.__flush_interval = flush_interval
+        self.__reconcile_interval = reconcile_interval
+        # batches being flushed by other replicas are younger
+        self.__reconcile_age = timedelta(seconds=reconcile_age)
+        self.__reconcile_batches = reconcile_batches
+        self.__pending = dict()
+        self.__flush_lock = asyncio.Lock()
+        self.__tasks = list()
+        self.flushes = 0
+        self.flush_failures = 0
+        self.reconciled = 0
+        metrics.register('ledger_pending_users', lambda: len(self.__pending))
+        metrics.register('ledger_flushes', lambda: self.flushes)
+        metrics.register('ledger_flush_failures', lambda: self.flush_failures)
+        metrics.register('ledger_reconciled_batches', lambda: self.reconciled)
+
+
+    def record_llm(self, user_id, model_name, tokens_num):
+        self.__record(user_id, self.__accounting.llm_cost(model_name, tokens_num),
+                      {'stats.llm_total_tokens': tokens_num})
+
+
+    def record_transcription(self, user_id, duration_seconds):
+        self.__record(user_id, self.__accounting.transcription_cost(duration_seconds),
+                      {'stats.transcription_secs': duration_seconds})
+
+
+    def __record(self, user_id, cost, stats):
+        self.__merge(user_id, dict(stats, balance=-int(cost)))
+
+
+    def __merge(self, user_id, inc):
+        pending = self.__pending.setdefault(user_id, dict())
+        for path, amount in inc.items():
+            pending[path] = pending.get(path, 0) + amount
+
+
+    async def start(self):
+        self.__tasks = [asyncio.create_task(self.__every(self.__flush_interval, self.flush)),
+                        asyncio.create_task(self.__every(self.__reconcile_interval, self.reconcile))]
+
+
+    async def stop(self):
+        for task in self.__tasks:
+            task.cancel()
+
+        if self.__tasks:
+            await asyncio.wait(self.__tasks)
+
+        self.__tasks = list()
+        await self.flush()
+
+
+    async def flush(self):
+        async with self.__flush_lock:
+            pending, self.__pending = self.__pending, dict()
+            if not pending:
+                return
+
+            entries = [dict(user_id=user_id, inc=inc) for user_id, inc in pending.items()]
+            repo = self.__repo
+            try:
+                batch = await repo.add_usage_batch(UsageBatch(entries=entries, created_at=utcnow()))
+            except BaseException as e:
+                self.flush_failures += 1
+                # usage is kept to be flushed next time
+                for user_id, inc in pending.items():
+                    self.__merge(user_id, inc)
+
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+
+                _logger.error(f'Usage flush failed [{len(pending)=}]', exc_info=e)
+                return
+
+            self.flushes += 1
+            try:
+                await repo.apply_usage_batch(batch)
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                self.flush_failures += 1
+                _logger.error(f'Usage batch is left to reconciliation [{batch.id=}]', exc_info=e)
+
+
+    async def reconcile(self):
+        """Applies batches saved but not applied long enough ago"""
+
+        repo = self.__repo
+        batches = await repo.get_usage_batches(utcnow() - self.__reconcile_age, self.__reconcile_batches)
+        for batch in batches:
+            _logger.warning(f'Usage batch is reconciled [{batch.id=}; {batch.created_at=}]')
+            await repo.apply_usage_batch(batch)
+            self.reconciled += 1
+
+
+    async def __every(self, interval, fn):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await fn()
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                _logger.error(f'Ledger task failed [{fn.__name__=}]', exc_info=e)
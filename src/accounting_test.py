@@ -0,0 +1,153 @@
+from accounting import AccountingProvider, UsageLedger
+from timer_scheduler import utcnow
+from money import Money
+
+from bson import ObjectId
+from datetime import timedelta
+import pytest
+import asyncio
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+
+CONFIG = dict(models={'llama': dict(price=2)},
+              transcription_backend='deepgram',
+              deepgram_model='nova-2',
+              deepgram_models={'nova-2': dict(price=6000)},
+              local_stt=dict(price=0))
+
+
+class UsageRepository:
+    """Keeps usage batches and user increments in memory, batch is applied to a user once"""
+
+    def __init__(self):
+        self.batches = dict()
+        self.users = dict()
+        self.applied = set()
+        self.fail_add = False
+        self.fail_apply = False
+        self.writes = 0
+
+    async def add_usage_batch(self, batch):
+        self.writes += 1
+        if self.fail_add:
+            raise ConnectionError('mongo is down')
+
+        batch.id = ObjectId()
+        self.batches[batch.id] = batch
+        return batch
+
+    async def apply_usage_batch(self, batch):
+        self.writes += 1
+        if self.fail_apply:
+            raise ConnectionError('mongo is down')
+
+        for entry in batch.entries:
+            if (entry['user_id'], batch.id) in self.applied:
+                continue
+
+            self.applied.add((entry['user_id'], batch.id))
+            user = self.users.setdefault(entry['user_id'], dict())
+            for path, amount in entry['inc'].items():
+                user[path] = user.get(path, 0) + amount
+
+        self.batches.pop(batch.id, None)
+
+    async def get_usage_batches(self, before, limit):
+        batches = sorted((batch for batch in self.batches.values() if batch.created_at < before), 
+                         key=lambda batch: batch.created_at)
+        return batches[:limit]
+
+
+def make_ledger(repo, reconcile_age=60):
+    return UsageLedger(repo, AccountingProvider(CONFIG), flush_interval=10, reconcile_interval=60, 
+                       reconcile_age=reconcile_age, reconcile_batches=10)
+
+
+def test_accounting_provider_must_price_tokens_and_transcription():
+    sut = AccountingProvider(CONFIG)
+    assert 'llama' in sut
+    assert sut['llama'].calc(10) == Money(20)
+    assert sut.llm_cost('llama', 10) == Money(20)
+    assert sut.transcription_cost(30) == Money(3000)
+    assert AccountingProvider(dict(CONFIG, transcription_backend='local')).transcription_cost(30) == Money(0)
+
+
+def test_ledger_must_flush_aggregated_usage_in_a_single_batch():
+    async def test():
+        repo = UsageRepository()
+        sut = make_ledger(repo)
+        for _ in range(100):
+            sut.record_llm(1, 'llama', 10)
+
+        sut.record_transcription(1, 30)
+        sut.record_transcription(2, 60)
+        assert repo.writes == 0
+        await sut.flush()
+        await sut.flush()
+        return repo
+
+    repo = asyncio.run(test())
+    # batch is saved and applied
+    assert repo.writes == 2
+    assert repo.users == {1: {'stats.llm_total_tokens': 1000, 'stats.transcription_secs': 30, 'balance': -5000},
+                          2: {'stats.transcription_secs': 60, 'balance': -6000}}
+    assert repo.batches == dict()
+
+
+def test_ledger_must_keep_usage_failed_to_be_saved():
+    async def test():
+        repo = UsageRepository()
+        sut = make_ledger(repo)
+        sut.record_llm(1, 'llama', 10)
+        repo.fail_add = True
+        await sut.flush()
+        assert sut.flush_failures == 1
+        sut.record_llm(1, 'llama', 5)
+        repo.fail_add = False
+        await sut.flush()
+        return repo
+
+    repo = asyncio.run(test())
+    assert repo.users == {1: {'stats.llm_total_tokens': 15, 'balance': -30}}
+
+
+def test_ledger_must_reconcile_batches_left_unapplied_once():
+    async def test():
+        repo = UsageRepository()
+        sut = make_ledger(repo, reconcile_age=60)
+        sut.record_llm(1, 'llama', 10)
+        repo.fail_apply = True
+        await sut.flush()
+        repo.fail_apply = False
+        batch, = repo.batches.values()
+
+        # batch may still be applied by the replica flushed it
+        await sut.reconcile()
+        assert repo.users == dict()
+
+        batch.created_at = utcnow() - timedelta(seconds=61)
+        # applied by the replica flushed it, but not deleted
+        await repo.apply_usage_batch(batch)
+        repo.batches[batch.id] = batch
+        await sut.reconcile()
+        assert sut.reconciled == 1
+        return repo
+
+    repo = asyncio.run(test())
+    assert repo.users == {1: {'stats.llm_total_tokens': 10, 'balance': -20}}
+    assert repo.batches == dict()
+
+
+def test_ledger_must_flush_on_stop():
+    async def test():
+        repo = UsageRepository()
+        sut = make_ledger(repo)
+        await sut.start()
+        sut.record_transcription(1, 6)
+        await sut.stop()
+        return repo
+
+    assert asyncio.run(test()).users == {1: {'stats.transcription_secs': 6, 'balance': -600}}
@@ -1,6 +1,11 @@
 import openai
+from openai.types import CompletionUsage
+import httpx
 import logging
 from collections import Counter
+from functools import partial
+from itertools import accumulate
+from bisect import bisect_right
 import re
 import math
 import asyncio
@@ -12,53 +17,72 @@ class AssistantError(RuntimeError):
     pass
 
 
-async def _get_token_num(text):
-    process = await asyncio.create_subprocess_exec('node', 'tokenizer/main.mjs', 
-                                                    stdin=asyncio.subprocess.PIPE, 
-                                                    stdout=asyncio.subprocess.PIPE, 
-                                                    stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await process.communicate(text.encode('utf-8'))
-    if process.returncode != 0:
-        raise AssistantError(text, stdout, stderr, process.returncode)
+async def count_tokens_batch(tokenizer, texts):
+    """Counts tokens of all the given texts in a single tokenizer call"""
 
-    _logger.debug(f'Tokenizer returned: [{stdout}]')
-    return sum(map(int, stdout.decode().split()))
+    texts = list(texts)
+    if not texts:
+        return list()
 
+    token_nums = await tokenizer(texts)
+    _logger.debug(f'Tokenizer returned: [{token_nums=}]')
+    return token_nums
 
-async def _adapt_message_history(context_limit, prompt, message_history, message):
-    token_num = await _get_token_num(prompt) + await _get_token_num(message)
-    total_tokens = token_num
+
+async def _adapt_message_history(context_limit, prompt, message_history, message, tokenizer, tokenizer_name):
+    rmh = list(reversed(message_history))
+    pairs = list(zip(rmh[1::2], rmh[::2]))
+    items = [item for pair in pairs for item in pair]
+
+    # history items keep their token numbers, so only new ones are counted and stored back
+    uncounted = [item for item in items if tokenizer_name not in item.tokens]
+    token_nums = await count_tokens_batch(tokenizer, [prompt, message] + [item.content for item in uncounted])
+    for item, token_num in zip(uncounted, token_nums[2:]):
+        item.tokens[tokenizer_name] = token_num
+
+    token_nums = token_nums[:2] + [item.tokens[tokenizer_name] for item in items]
+    token_num = token_nums[0] + token_nums[1]
     context_limit -= token_num
     if context_limit < 0:
         raise AssistantError('Context limit exceeded')
 
-    rmh = list(reversed(message_history))
+    # running totals of the most recent pairs, the fitting ones are found by bisection
+    pair_token_nums = list(accumulate(user + assistant for user, assistant in zip(token_nums[2::2], token_nums[3::2])))
+    pairs_num = bisect_right(pair_token_nums, context_limit)
+    total_tokens = token_num + (pair_token_nums[pairs_num - 1] if pairs_num else 0)
 
     def to_dict(item):
         return dict(role=item.role, content=item.content)
 
-    dialog = list()
-    for item in zip(rmh[1::2], rmh[::2]):
-        user, assistant = item
-        token_num = await _get_token_num(assistant.content) + await _get_token_num(user.content)
-        if token_num > context_limit:
-            break
-        dialog += [to_dict(assistant), to_dict(user)]
-        context_limit -= token_num
-        total_tokens += token_num
-
+    dialog = [to_dict(item) for pair in reversed(pairs[:pairs_num]) for item in pair]
     _logger.debug(f'Dialog total tokens: [{total_tokens=}]')
-    dialog = list(reversed(dialog))
     return [dict(role='system', content=prompt)] + dialog + [dict(role='user', content=message)]
 
 
+def create_openai_client(api_key, base_url, http2, max_connections, max_keepalive_connections, 
+                         keepalive_expiry, timeout):
+    """Creates client to be shared by assistants, so connections are kept alive across requests"""
+
+    http_client = httpx.AsyncClient(http2=http2,
+                                    limits=httpx.Limits(max_connections=max_connections, 
+                                                        max_keepalive_connections=max_keepalive_connections,
+                                                        keepalive_expiry=keepalive_expiry),
+                                    timeout=httpx.Timeout(timeout, connect=5.0),
+                                    follow_redirects=True)
+    return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+
 class Assistant:
-    def __init__(self, client, config):
+    def __init__(self, client, config, tokenizer):
         self.__client = client
         self.__config = config
         self.__model = model = config['model']
         self.__context_limit = config['models'][model]['context_limit']
         self.__completion_opts = config['models'][model]['completion_options']
+        # usage of streamed completion, it's counted by tokenizer unless the last chunk reports it
+        self.stream_usage = None
+        self.__tokenizer_name = tokenizer_name = config['models'][model]['tokenizer']
+        self.__tokenizer = partial(tokenizer.count_batch, tokenizer=tokenizer_name)
 
 
     async def send_message(self, message, message_history, chat_mode):
@@ -88,17 +112,43 @@ class Assistant:
             **self.__completion_opts
         )
 
-        async for item in gen:
-            _logger.debug(f'{item=}')
-            delta = item.choices[0].delta
-            if hasattr(delta, 'content') and delta.content is not None:
-                yield delta.content.strip()
-                # # n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                # # n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-        else:
-            yield None
+        answer = ''
+        try:
+            async for item in gen:
+                _logger.debug(f'{item=}')
+                if getattr(item, 'usage', None) is not None:
+                    self.stream_usage = item.usage
+
+                if not item.choices:
+                    continue
+
+                delta = item.choices[0].delta
+                if hasattr(delta, 'content') and delta.content is not None:
+                    answer += delta.content
+                    # whitespace is yielded as is, markdown fences and line breaks depend on it
+                    yield delta.content
+            else:
+                if self.stream_usage is None:
+                    # the api reports usage of stream only if it's asked to and the client isn't able to ask
+                    self.stream_usage = await self.__count_usage(messages, answer)
+
+                yield None
+        finally:
+            # aborts the generation if the reply is cancelled, so the connection is freed at once
+            await gen.response.aclose()
+
+
+    async def __count_usage(self, messages, answer):
+        """Counts usage by tokenizer in a single call, token numbers of the sent messages are mostly cached"""
+
+        token_nums = await count_tokens_batch(self.__tokenizer, [answer] + [message['content'] for message in messages])
+        completion_tokens, prompt_tokens = token_nums[0], sum(token_nums[1:])
+        return CompletionUsage(prompt_tokens=prompt_tokens, 
+                               completion_tokens=completion_tokens, 
+                               total_tokens=prompt_tokens + completion_tokens)
 
 
     async def __adapt_message_history(self, message, message_history, chat_mode):
         prompt = self.__config['chat_modes'][chat_mode]['prompt_start']
-        return await _adapt_message_history(self.__context_limit, prompt, message_history, message)
+        return await _adapt_message_history(self.__context_limit, prompt, message_history, message, 
+                                            self.__tokenizer, self.__tokenizer_name)
@@ -1,9 +1,12 @@
 import ai
 from repository import Dialog
 
+from openai.types import CompletionUsage
+
 import pytest
-from collections import namedtuple
 import logging
+import asyncio
+from collections import namedtuple
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -28,15 +31,13 @@ USER_LEN = 10
 ASSITANT_LEN = 15
 
 
-Item = namedtuple('Item', ['role', 'content'])
-
 
 @pytest.fixture
 def message_history():
     def history_gen(n):
         for i in range(1, n + 1):
-            yield (Item(role='user', content=content_gen(USER_LEN, word=f'{i}_user_word')), 
-                   Item(role='assistant', content=content_gen(ASSITANT_LEN, word=f'{i}_assistant_word')))
+            yield (Dialog(role='user', content=content_gen(USER_LEN, word=f'{i}_user_word')), 
+                   Dialog(role='assistant', content=content_gen(ASSITANT_LEN, word=f'{i}_assistant_word')))
 
     return [el for item in history_gen(10) for el in item]
 
@@ -46,6 +47,18 @@ def message():
     return 'Hi there'
 
 
+TOKENIZER_NAME = 'llama3'
+
+
+async def tokenizer(texts):
+    return [len(text.split()) * 3 // 2 for text in texts]
+
+
+def adapt_message_history(context_limit, prompt, message_history, message, tokenizer=tokenizer):
+    return asyncio.run(ai._adapt_message_history(context_limit, prompt, message_history, message, 
+                                                 tokenizer, TOKENIZER_NAME))
+
+
 @pytest.mark.parametrize('prompt_size', [20])
 def test_adapt_message_history_must_return_limited_to_context_size_history(prompt, context_limit, message_history, message):
     exptected = [
@@ -57,26 +70,26 @@ def test_adapt_message_history_must_return_limited_to_context_size_history(promp
         dict(role='user', content=message),
     ]
 
-    assert exptected == ai._adapt_message_history(context_limit, prompt, message_history, message)
+    assert exptected == adapt_message_history(context_limit, prompt, message_history, message)
 
 
 @pytest.mark.parametrize('prompt_size', [20])
 def test_adapt_message_history_limit_exceeded_by_first_message(prompt, context_limit, message):
-    message_history = [Item(role='user', content=content_gen(50, word=f'user_word')), 
-                       Item(role='assistant', content=content_gen(50, word=f'assistant_word'))]
+    message_history = [Dialog(role='user', content=content_gen(50, word=f'user_word')), 
+                       Dialog(role='assistant', content=content_gen(50, word=f'assistant_word'))]
 
     exptected = [
         dict(role='system', content=prompt),
         dict(role='user', content=message),
     ]
 
-    assert exptected == ai._adapt_message_history(context_limit, prompt, message_history, message)
+    assert exptected == adapt_message_history(context_limit, prompt, message_history, message)
 
 
 @pytest.mark.parametrize('prompt_size', [20])
 def test_adapt_message_history_single_element_in_history(prompt, context_limit, message):
-    message_history = [Item(role='user', content=content_gen(USER_LEN, word=f'user_word')), 
-                       Item(role='assistant', content=content_gen(ASSITANT_LEN, word=f'assistant_word'))]
+    message_history = [Dialog(role='user', content=content_gen(USER_LEN, word=f'user_word')), 
+                       Dialog(role='assistant', content=content_gen(ASSITANT_LEN, word=f'assistant_word'))]
 
     exptected = [
         dict(role='system', content=prompt),
@@ -85,10 +98,144 @@ def test_adapt_message_history_single_element_in_history(prompt, context_limit,
         dict(role='user', content=message),
     ]
 
-    assert exptected == ai._adapt_message_history(context_limit, prompt, message_history, message)
+    assert exptected == adapt_message_history(context_limit, prompt, message_history, message)
 
 
 @pytest.mark.parametrize('prompt_size', [100])
 def test_adapt_message_history_must_raise_if_prompt_and_message_exceeds_limit(prompt, context_limit, message_history, message):
     with pytest.raises(ai.AssistantError):
-        ai._adapt_message_history(context_limit, prompt, message_history, message)
+        adapt_message_history(context_limit, prompt, message_history, message)
+
+
+@pytest.mark.parametrize('prompt_size', [20])
+def test_adapt_message_history_must_store_token_numbers_in_history(prompt, context_limit, message_history, message):
+    adapt_message_history(context_limit, prompt, message_history, message)
+    assert [item.tokens for item in message_history] == [{TOKENIZER_NAME: 15}, {TOKENIZER_NAME: 22}] * 10
+
+
+@pytest.mark.parametrize('prompt_size', [20])
+def test_adapt_message_history_must_not_count_stored_token_numbers(prompt, context_limit, message_history, message):
+    counted = list()
+    async def counting_tokenizer(texts):
+        counted.extend(texts)
+        return await tokenizer(texts)
+
+    for item in message_history[:-1]:
+        item.tokens[TOKENIZER_NAME] = 1
+
+    actual = adapt_message_history(context_limit, prompt, message_history, message, counting_tokenizer)
+    assert counted == [prompt, message, message_history[-1].content]
+    assert len(actual) == 2 + len(message_history)
+
+
+Chunk = namedtuple('Chunk', ['choices'])
+UsageChunk = namedtuple('UsageChunk', ['choices', 'usage'])
+Choice = namedtuple('Choice', ['delta'])
+Delta = namedtuple('Delta', ['content'])
+
+
+class FakeStream:
+    """Completion stream endlessly generating the same word"""
+
+    def __init__(self):
+        self.response = self
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0.01)
+        return Chunk(choices=[Choice(delta=Delta(content='word'))])
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeDeltaStream(FakeStream):
+    """Completion stream generating the given deltas"""
+
+    def __init__(self, deltas, usage=None):
+        super().__init__()
+        chunks = [Chunk(choices=[Choice(delta=Delta(content=delta))]) for delta in deltas]
+        if usage is not None:
+            chunks.append(UsageChunk(choices=[], usage=usage))
+
+        self.__chunks = iter(chunks)
+
+    async def __anext__(self):
+        chunk = next(self.__chunks, None)
+        if chunk is None:
+            raise StopAsyncIteration
+
+        return chunk
+
+
+class FakeCompletions:
+    def __init__(self, stream=None):
+        self.stream = stream or FakeStream()
+
+    async def create(self, **kwargs):
+        return self.stream
+
+
+class FakeTokenizer:
+    async def count_batch(self, texts, tokenizer):
+        return [len(text.split()) * 3 // 2 for text in texts]
+
+
+def make_assistant(completions):
+    client = namedtuple('Client', ['chat'])(chat=namedtuple('Chat', ['completions'])(completions=completions))
+    config = dict(model='llama', 
+                  models=dict(llama=dict(context_limit=128, completion_options=dict(), tokenizer=TOKENIZER_NAME)),
+                  chat_modes=dict(assistant=dict(prompt_start='prompt')))
+    return ai.Assistant(client, config, FakeTokenizer())
+
+
+def test_send_message_stream_must_close_response_when_cancelled():
+    async def test():
+        completions = FakeCompletions()
+        sut = make_assistant(completions)
+
+        async def reply():
+            async for _ in sut.send_message_stream('Hi there', [], 'assistant'):
+                pass
+
+        task = asyncio.create_task(reply())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert completions.stream.closed
+
+    asyncio.run(test())
+
+
+def test_send_message_stream_must_yield_deltas_as_is():
+    async def test():
+        deltas = ['Here', ' is', ':\n\n', '```', 'python', '\n', 'def', ' f', '():\n', '    pass', '\n', '```', '\n', 'Done', '.']
+        sut = make_assistant(FakeCompletions(FakeDeltaStream(deltas)))
+        answers = [answer async for answer in sut.send_message_stream('Hi there', [], 'assistant')]
+        assert answers == deltas + [None]
+
+    asyncio.run(test())
+
+
+def test_send_message_stream_must_count_usage_unless_it_is_reported():
+    async def test():
+        sut = make_assistant(FakeCompletions(FakeDeltaStream(['Four', ' words', ' of', ' answer'])))
+        async for _ in sut.send_message_stream('Hi there', [], 'assistant'):
+            pass
+
+        # prompt and message are 1 and 3 tokens by fake tokenizer
+        assert sut.stream_usage == CompletionUsage(prompt_tokens=4, completion_tokens=6, total_tokens=10)
+
+        usage = CompletionUsage(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+        sut = make_assistant(FakeCompletions(FakeDeltaStream(['Answer'], usage)))
+        async for _ in sut.send_message_stream('Hi there', [], 'assistant'):
+            pass
+
+        assert sut.stream_usage == usage
+
+    asyncio.run(test())
@@ -1,4 +1,5 @@
 from mongoengine import connect
+import asyncio
 import logging
 
 
@@ -6,10 +7,50 @@ _logger = logging.getLogger(__name__)
 
 
 class AppService:
-    def __init__(self, config, bot):
+    def __init__(self, config, bot, repository, tokenizer, openai_client, transcriber, ledger):
         self.__config = config
         self.__bot = bot
+        self.__repo = repository
+        self.__tokenizer = tokenizer
+        self.__openai_client = openai_client
+        self.__transcriber = transcriber
+        self.__ledger = ledger
 
 
     def run(self):
+        self.__add_hooks()
         self.__bot.run()
+
+
+    def run_worker(self, shard, updates):
+        """Processes updates routed to the shard in worker process"""
+        self.__add_hooks()
+        self.__bot.run_worker(shard, updates)
+
+
+    def __add_hooks(self):
+        bot = self.__bot
+        bot.add_startup_hook(self.__prewarm_tokenizer)
+        bot.add_startup_hook(self.__ledger.start)
+        if self.__config['user_cache']['watch_changes']:
+            bot.add_startup_hook(self.__repo.watch_changes)
+        bot.add_shutdown_hook(self.__tokenizer.close)
+        bot.add_shutdown_hook(self.__openai_client.close)
+        bot.add_shutdown_hook(self.__transcriber.close)
+        # usage is flushed before the repository is closed
+        bot.add_shutdown_hook(self.__ledger.stop)
+        bot.add_shutdown_hook(self.__repo.close)
+
+
+    def migrate_dialogs(self):
+        users_num = asyncio.run(self.__repo.migrate_users())
+        _logger.info(f'Dialogs migrated [{users_num=}]')
+
+
+    async def __prewarm_tokenizer(self):
+        """Starts tokenizer workers and caches token numbers of chat mode prompts"""
+        config = self.__config
+        prompts = [chat_mode['prompt_start'] for chat_mode in config['chat_modes'].values()]
+        tokenizer_name = config['models'][config['model']]['tokenizer']
+        await self.__tokenizer.count_batch(prompts, tokenizer_name)
+        _logger.info(f'Tokenizer prewarmed with [{len(prompts)}] prompts')
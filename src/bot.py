@@ -1,5 +1,14 @@
-from repository import Dialog
+from repository import Dialog, UserSession
+from timer_scheduler import utcnow
+from webhook import WebhookServer
+from sharding import ShardIngress
+from stream_editor import StreamEditor, EditPacer, EditRateLimiter
+from markup import (MESSAGE_LEN_LIMIT, escape_markdown, unescape_markdown, is_markdown, split_text, split_message,
+                    MarkdownStream, TextStream)
+from lease import LeaseBusyError
+from transcription import AudioTooLargeError
 from money import Money
+import metrics
 
 from telegram.ext import (
     Application,
@@ -8,7 +17,6 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
-    AIORateLimiter,
     filters
 )
 from telegram.constants import ParseMode, ChatAction
@@ -22,14 +30,12 @@ from telegram import (
 )
 import telegram
 
-from deepgram import DeepgramClient, PrerecordedOptions, FileSource
-from pydub import AudioSegment
 
 from datetime import datetime, timezone, timedelta
 import logging
 import asyncio
-from contextlib import contextmanager, asynccontextmanager
-from io import BytesIO
+import signal
+from contextlib import contextmanager, asynccontextmanager, AsyncExitStack
 from functools import wraps
 import traceback
 import html
@@ -43,6 +49,7 @@ HELP_MESSAGE = """Commands:
 👉 /start – Get started
 👉 /new – Start new dialog
 👉 /mode – Select chat mode
+👉 /cancel – Cancel pending reply
 👉 /help – Show help
 
 🎤 You can send <b>Voice Messages</b> instead of text
@@ -60,25 +67,11 @@ For example: "{bot_username} write a poem about Telegram"
 """
 
 
-_logger = logging.getLogger(__name__)
-
-
-def escape_markdown(text):
-    # SPECIAL_CHARS = '\\', '_', '*', '[', ']', '(', ')', '~', '`', '>', '<', '&', '#', '+', '-', '=', '|', '{', '}', '.', '!'
-    SPECIAL_CHARS = '\\', '[', ']', '(', ')', '>', '<', '&', '#', '+', '-', '=', '|', '{', '}', '.', '!'
+# telegram rejects empty message text, so empty reply is edited in as this one
+EMPTY_REPLY_MESSAGE = '🤷‍♀️ Got empty answer, please try again'
 
-    for char in SPECIAL_CHARS:
-        text = text.replace(char, f'\\{char}')
 
-    return text
-
-# fixme: figure out deepgram options
-async def transcribe_audio(api_key, buffer, timeout, **options):
-    payload = dict(buffer=buffer)
-    client = DeepgramClient(api_key)    
-    resp = await client.listen.asyncprerecorded.v('1').transcribe_file(payload, PrerecordedOptions(**options), timeout=timeout)
-    _logger.debug(f'Voice transcription: [{resp=}]')
-    return resp.results.channels[0].alternatives[0].transcript.strip(), resp.metadata.duration
+_logger = logging.getLogger(__name__)
 
 
 PendingGuard = namedtuple('PendingGuard', ['lock', 'message_lock', 'messages'])
@@ -97,7 +90,7 @@ def pending_message(guard, message):
 
 def pending_protect(method):
     @wraps(method)
-    async def pending_guard(self, update, *args, **kwargs):
+    async def pending_guard(self, update, context, *args, **kwargs):
         if not isinstance(update, Update):
             raise ValueError('The first arg of protected callable must have an Update type')
 
@@ -105,39 +98,47 @@ def pending_protect(method):
         user = update.effective_user
         assert message and user
 
-        self._register_user(user)
         guard = self._get_pending_guard(user.id)
         _logger.debug(f'Processing message: [{message.id=}; {message.text=}; {len(guard.messages)=};]')
 
-        with pending_message(guard, message) as lock:
-            _logger.debug(f'Pending get IN: [{len(guard.messages)=}; {guard.messages=}]')
-            if len(guard.messages) > 1:
-                async with guard.message_lock:
-                    if update.callback_query is not None:
-                        await update.callback_query.answer()
+        async def reply_wait():
+            async with guard.message_lock:
+                if update.callback_query is not None:
+                    await update.callback_query.answer()
+
+                text = "⏳ Please <b>wait</b> for a reply to the previous message\nOr you can /cancel it"
+                await message.reply_text(text, reply_to_message_id=message.id, parse_mode=ParseMode.HTML)
 
-                    text = "⏳ Please <b>wait</b> for a reply to the previous message\nOr you can /cancel it"
-                    await message.reply_text(text, reply_to_message_id=message.id, parse_mode=ParseMode.HTML)
+        try:
+            with pending_message(guard, message) as lock:
+                _logger.debug(f'Pending get IN: [{len(guard.messages)=}; {guard.messages=}]')
+                if len(guard.messages) > 1:
+                    await reply_wait()
                     return
 
-            async with lock:
-                _logger.debug(f'Enter method: [{method.__name__}]')
-                await method(self, update, *args, **kwargs)
-                _logger.debug(f'Exit method: [{method.__name__}]')
+                # in-process lock goes first, so the lease is contended by other bot replicas only
+                async with lock:
+                    try:
+                        async with self._user_lease(user.id) as fence:
+                            # user changes are written before the message is popped and the lease is released, 
+                            # so the next message of the user reads them
+                            async with self._user_session(user, fence) as session:
+                                context.user_session = session
+                                _logger.debug(f'Enter method: [{method.__name__}]')
+                                await method(self, update, context, *args, **kwargs)
+                                _logger.debug(f'Exit method: [{method.__name__}]')
+                    except LeaseBusyError:
+                        # the message of the user is being processed by another replica
+                        await reply_wait()
+                        return
+        finally:
+            self._release_pending_guard(user.id, guard)
 
         _logger.debug(f'Pending get OUT: [{len(guard.messages)=}; {guard.messages=}]')
 
     return pending_guard
 
 
-MESSAGE_LEN_LIMIT = 4096
-
-
-def split_text(text, chunk_size=MESSAGE_LEN_LIMIT):
-    for i in range(0, len(text), chunk_size):
-        yield text[i:i + chunk_size]
-
-
 def format_exc(exc, update):
     tb_list = traceback.format_exception(None, exc, exc.__traceback__)
     tb_str = html.escape("".join(tb_list))
@@ -171,42 +172,24 @@ def log_handler(logger):
     return decorator
 
 
-def get_ogg_duration_secs(file):
-    pos = file.tell()
-    try:
-        duration = AudioSegment.from_ogg(file).duration_seconds
-    finally:
-        file.seek(pos)
-
-    return duration
-
-
-def is_markdown(parse_mode):
-    return parse_mode.lower().startswith('markdown')
-
-
 async def send_reply(text, message, parse_mode=None):
-    #fixme: Split code containig messages in smart way completing closing and opening markup symbols
     _logger.debug(f'Reply to user with: [{text=}]')
-    try:
-        for s in split_text(text):
+    # messages are sent one by one, as telegram doesn't keep the order of concurrent ones
+    for s in split_message(text, parse_mode):
+        try:
             await message.reply_text(s, parse_mode=parse_mode)
-    except telegram.error.BadRequest as e:
-        _logger.warn(f'BadRequest: [{e!r}]', exc_info=e)
-        for s in split_text(text.replace('\\', '') if is_markdown(parse_mode) else text):
-            await message.reply_text(s)
+        except telegram.error.BadRequest as e:
+            _logger.warning(f'BadRequest: [{e!r}]', exc_info=e)
+            # only the message failed to be parsed is sent as is
+            await message.reply_text(unescape_markdown(s) if parse_mode is not None and is_markdown(parse_mode) else s)
 
 
-def deposit(user, amount, repo):
+async def deposit(user, amount, repo):
     if not isinstance(amount, Money):
         ValueError('Given amount must be an instance of Money type')
 
     user.balance += amount
-    repo.put_user(user)
-
-
-def calc_transcribe_cost(duration, price):
-    pass    
+    await repo.update_user(user.id, {'$inc': {'balance': int(amount)}})
 
 
 def is_command(text):
@@ -220,16 +203,18 @@ def command_payload(text):
 
 
 class Bot:
-    def __init__(self, config, telegram_app_builder, repository, assistant_factory):
+    def __init__(self, config, telegram_app_builder, repository, assistant_factory, timer_scheduler, leases, transcriber, 
+                 ledger):
         _logger.debug(f'Creating bot [{config=}]')
         self.__config = config
         app = (telegram_app_builder
             .token(config['telegram_token'])
             .concurrent_updates(True)
-            .rate_limiter(AIORateLimiter(max_retries=5))
+            .rate_limiter(EditRateLimiter(max_retries=5))
             .http_version("1.1")
             .get_updates_http_version("1.1")
             .post_init(self.__post_init)
+            .post_shutdown(self.__post_shutdown)
             .build()
         )
         self.__app = app
@@ -237,8 +222,19 @@ class Bot:
         self.__assistant_factory = assistant_factory
         self.__tasks = dict()
         self.__pending_guards = dict()
-        self.__timers = dict()
-        self._register_user = self.__register_user
+        self.__timers = timer_scheduler
+        self.__transcriber = transcriber
+        self.__ledger = ledger
+        self.__edit_pacer = EditPacer(min_interval=config['stream_edit_interval']['min'], 
+                                      max_interval=config['stream_edit_interval']['max'])
+        self.__fires_timers = True
+        self.__startup_hooks = list()
+        self.__shutdown_hooks = list()
+        self.__metrics_task = None
+        self._user_session = self.__user_session
+        self._user_lease = leases.hold
+        metrics.register('pending_guards', lambda: len(self.__pending_guards))
+        metrics.register('reply_tasks', lambda: len(self.__tasks))
         app.add_handler(CommandHandler("start", self.__start_handler, filters=filters.COMMAND))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.__message_handler))
 
@@ -247,6 +243,7 @@ class Bot:
         app.add_handler(CallbackQueryHandler(self.__set_chat_mode_handler, pattern="^set_chat_mode"))
 
         app.add_handler(CommandHandler("new", self.__new_dialog_handler, filters=filters.COMMAND))
+        app.add_handler(CommandHandler("cancel", self.__cancel_handler, filters=filters.COMMAND))
         app.add_handler(MessageHandler(filters.VOICE, self.__voice_message_handler))
 
         app.add_handler(CommandHandler("help", self.__help_handler, filters=filters.COMMAND))
@@ -254,7 +251,64 @@ class Bot:
 
 
     def run(self):
-        self.__app.run_polling()
+        webhook = self.__config['webhook']
+        if not webhook['enabled']:
+            self.__app.run_polling()
+            return
+
+        server = WebhookServer(self.__app, 
+                               url=webhook['url'],
+                               listen=webhook['listen'], 
+                               port=webhook['port'], 
+                               path=webhook['path'],
+                               secret_token=webhook['secret_token'],
+                               max_queue=webhook['max_queue'],
+                               workers=webhook['workers'])
+        stopping = asyncio.Event()
+        asyncio.run(self.__serve(server, stopping, webhook['drain_timeout'], stop_signals=(signal.SIGINT, signal.SIGTERM)))
+
+
+    def run_worker(self, shard, updates):
+        """Processes updates routed to the shard by dispatcher process till it sends None. 
+        Timers are fired by the first shard only, it polls timers added by the others"""
+
+        stopping = asyncio.Event()
+        self.__fires_timers = shard == 0
+        asyncio.run(self.__serve(ShardIngress(self.__app, updates, stopping), stopping, drain_timeout=None))
+
+
+    async def __serve(self, ingress, stopping, drain_timeout, stop_signals=()):
+        """Runs application the same way run_polling does, but updates are fed by the given ingress"""
+
+        app = self.__app
+        loop = asyncio.get_running_loop()
+        for signum in stop_signals:
+            loop.add_signal_handler(signum, stopping.set)
+
+        await app.initialize()
+        try:
+            await self.__post_init(app)
+            await app.start()
+            await ingress.start()
+            await stopping.wait()
+            _logger.info('Bot is stopping')
+        finally:
+            await ingress.stop(drain_timeout)
+            if app.running:
+                await app.stop()
+
+            await app.shutdown()
+            await self.__post_shutdown(app)
+
+
+    def add_startup_hook(self, hook):
+        """Registers coroutine function to be awaited on application startup"""
+        self.__startup_hooks.append(hook)
+
+
+    def add_shutdown_hook(self, hook):
+        """Registers coroutine function to be awaited on application shutdown"""
+        self.__shutdown_hooks.append(hook)
 
 
     async def __error_handler(self, update: Update, context: CallbackContext) -> None:
@@ -293,29 +347,27 @@ class Bot:
     @log_handler(_logger)
     @pending_protect
     async def __voice_message_handler(self, update: Update, context: CallbackContext):
-        def put_duration(user, duration):
-            user.stats.transcription_secs += duration
-            self.__repo.put_user(user)
-
-        user = self.__register_user(update.message.from_user)
+        async def reply_too_large():
+            await update.message.reply_text(f'🎙️ Voice message is too long', parse_mode=ParseMode.HTML)
 
         voice = update.message.voice
+        max_size = self.__config['voice_max_size']
+        if voice.file_size is not None and voice.file_size > max_size:
+            await reply_too_large()
+            return
+
         voice_file = await context.bot.get_file(voice.file_id)
-        
-        buf = BytesIO()
-        await voice_file.download_to_memory(buf)
-        buf.name = "voice.oga"  # file extension is required
-        buf.seek(0)
-        duration_seconds = get_ogg_duration_secs(buf)
-        _logger.debug(f'Got audio file: [{duration_seconds=} secs]')
+        try:
+            # voice is streamed into transcription request while it's downloaded
+            text, duration = await self.__transcriber.transcribe_url(update.effective_user.id, 
+                                                                     voice_file.file_path, 
+                                                                     max_size)
+        except AudioTooLargeError:
+            await reply_too_large()
+            return
 
-        config = self.__config
-        model = config['deepgram_model']
-        options = config['deepgram_models'][model]['options']
-        text, duration = await transcribe_audio(config['deepgram_token'], buf.read(), 
-                                                config['deepgram_timeout'], **options)
         if text:
-            put_duration(user, duration)
+            self.__ledger.record_transcription(update.effective_user.id, duration)
             await update.message.reply_text(f'🎙️ Got it\n{text}', parse_mode=ParseMode.HTML)
             await self.__handle_message(update, context, alt_text=text)
         else:
@@ -326,9 +378,6 @@ class Bot:
     @log_handler(_logger)
     @pending_protect
     async def __start_handler(self, update: Update, context: CallbackContext):
-        tg_user = update.message.from_user
-        self.__register_user(tg_user)
-
         reply_text = "Hi there! Pleased to meet you! Feel free to choose preset or supply your own 🤖\n\n"
         reply_text += HELP_MESSAGE
 
@@ -339,22 +388,33 @@ class Bot:
     @log_handler(_logger)
     @pending_protect
     async def __help_handler(self, update: Update, context: CallbackContext):
-        tg_user = update.message.from_user
-        self.__register_user(tg_user)
         await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
     @log_handler(_logger)
     @pending_protect
     async def __new_dialog_handler(self, update: Update, context: CallbackContext):
-        user = self.__register_user(update.message.from_user)
-        user.current_dialog = list()
-        self.__repo.put_user(user)
+        session = context.user_session
+        user = session.user
+        session.new_dialog()
         await update.message.reply_text('Starting new dialog...')
         welcome_message = self.__config['chat_modes'][user.chat_mode]['welcome_message']
         await update.message.reply_text(welcome_message, parse_mode=ParseMode.HTML)
 
 
+    # not protected as it's sent while the reply is pending
+    @log_handler(_logger)
+    async def __cancel_handler(self, update: Update, context: CallbackContext):
+        """Cancels pending reply, the pending message handler replies on cancellation and releases the guard"""
+
+        task = self.__tasks.get(update.effective_user.id)
+        if task is None or task.done():
+            await update.message.reply_text('<i>Nothing to cancel...</i>', parse_mode=ParseMode.HTML)
+            return
+
+        task.cancel()
+
+
     @log_handler(_logger)
     @pending_protect
     async def __message_handler(self, update: Update, context: CallbackContext, alt_text=None):
@@ -363,11 +423,10 @@ class Bot:
 
     async def __handle_message(self, update: Update, context: CallbackContext, alt_text=None):
         tg_user = update.message.from_user
-        user = self.__register_user(tg_user)
 
         _logger.debug(f'Message arrived: [{alt_text or update.message.text}, message.id={update.message.id if alt_text is None else None}]')
 
-        with (self.__reply_task(tg_user, update.message, user.current_dialog, user.chat_mode, alt_text) as reply_task, 
+        with (self.__reply_task(tg_user, context.user_session, update.message, alt_text) as reply_task, 
               self.__typing_task(update.message) as typing_task):
             try:
                 await asyncio.wait([reply_task, typing_task], return_when=asyncio.FIRST_COMPLETED)
@@ -391,16 +450,16 @@ class Bot:
 
 
     @contextmanager
-    def __reply_task(self, tg_user, message, message_history, chat_mode, alt_text):
+    def __reply_task(self, tg_user, session, message, alt_text):
         user_id = tg_user.id
         task = asyncio.create_task(self.__message_handler_task(
-            tg_user, message, message_history, chat_mode, alt_text))
+            tg_user, session, message, alt_text))
         tasks = self.__tasks
         tasks[user_id] = task
         try:
             yield task
         finally:
-            if user_id in tasks:
+            if tasks.get(user_id) is task:
                 del tasks[user_id]
 
 
@@ -411,68 +470,66 @@ class Bot:
                     markdown_v2=ParseMode.MARKDOWN_V2).get(config['chat_modes'][chat_mode]['parse_mode'], 
                                                            ParseMode.HTML)
 
-    async def __message_handler_task(self, tg_user, message, message_history, chat_mode, alt_text):
-        user_id = tg_user.id
-        user = self.__repo.get_user(user_id)
+    async def __message_handler_task(self, tg_user, session, message, alt_text):
+        user = session.user
+        # token numbers assistant backfills into history items are saved by the session
+        message_history = await session.get_dialog()
+        chat_mode = user.chat_mode
 
-        def put_dialog_item(user, message_text, response):
-            user.current_dialog.append(Dialog(role='user', content=message_text))
-            user.current_dialog.append(Dialog(role='assistant', content=response))
-            self.__repo.put_user(user)
-
-        def put_llm_stats(user, usage):
-            user.stats.llm_total_tokens += usage.total_tokens
-            self.__repo.put_user(user)
+        def put_dialog_item(session, message_text, response, usage=None):
+            # the message is counted once along with the next request
+            model = config['model']
+            tokens = dict() if usage is None else {config['models'][model]['tokenizer']: usage.completion_tokens}
+            session.push_dialog(Dialog(role='user', content=message_text),
+                                Dialog(role='assistant', content=response, tokens=tokens))
 
         assistant = self.__assistant_factory()
         config = self.__config
         parse_mode = self.__parse_mode(chat_mode)
-        
-        # can't stream markdown as telegram fails with parsing errors because of 
-        # it unable to find closing pair of starting markup symbol
-        is_code_assistant = chat_mode == 'code_assistant'
         message_text = alt_text or message.text
         assert message_text
 
-        if config['message_streaming'] and not is_code_assistant:
-            placeholder_message = await message.reply_text('...')
-            await message.reply_chat_action(action=ChatAction.TYPING)
-            prev_answer = ''
+        if config['message_streaming']:
             whole_answer = ''
-            async for answer in assistant.send_message_stream(message_text, message_history, chat_mode):
-                limit = config['stream_update_chars']
-
-                if answer is not None:
-                    whole_answer += escape_markdown(answer) if is_markdown(parse_mode) else answer
+            # partial markdown is rendered with open entities closed, so telegram is able to parse it
+            stream = MarkdownStream(escape=True) if is_markdown(parse_mode) else TextStream(parse_mode)
+            async with AsyncExitStack() as stack:
+                sent = 0
+                editor = None
+                async def edit(texts):
+                    nonlocal sent, editor
+                    # reply is continued in the next message, the previous one is edited with its final text
+                    while editor is None or sent < len(texts) - 1:
+                        if editor is not None:
+                            await editor.finish(texts[sent])
+                            sent += 1
+
+                        placeholder_message = await message.reply_text('...')
+                        editor = await stack.enter_async_context(self.__stream_editor(placeholder_message, parse_mode))
+
+                    if texts[-1]:
+                        editor.push(texts[-1])
+
+                await edit([''])
+                await message.reply_chat_action(action=ChatAction.TYPING)
+                async for answer in assistant.send_message_stream(message_text, message_history, chat_mode):
+                    if answer is None:
+                        put_dialog_item(session, message_text, whole_answer.strip(), assistant.stream_usage)
+                        continue
 
-                if answer is not None and abs(len(whole_answer) - len(prev_answer)) < limit:
-                    continue
+                    whole_answer += answer
+                    stream.feed(answer)
+                    await edit(stream.messages())
 
-                if answer is None:
-                    put_dialog_item(user, message_text, whole_answer)
+                self.__ledger.record_llm(user.id, config['model'], assistant.stream_usage.total_tokens)
 
-                _logger.debug(f'{prev_answer=}, {placeholder_message=}, {parse_mode=}')
-                try:
-                    await self.__app.bot.edit_message_text(whole_answer, 
-                                                           chat_id=placeholder_message.chat_id, 
-                                                           message_id=placeholder_message.message_id, 
-                                                           parse_mode=parse_mode)
-                except telegram.error.BadRequest as e:
-                    _logger.warn(f'BadRequest: [{e!r}]', exc_info=e)
-                    if str(e).startswith("Message is not modified"):
-                        continue
-                    else:
-                        await self.__app.bot.edit_message_text(whole_answer, 
-                                                               chat_id=placeholder_message.chat_id, 
-                                                               message_id=placeholder_message.message_id, 
-                                                               parse_mode=parse_mode)
-
-                await asyncio.sleep(0.01)
-                prev_answer = whole_answer
+                texts = stream.messages(final=True)
+                await edit(texts)
+                await editor.finish(texts[-1])
         else:
             resp, usage = await assistant.send_message(message_text, message_history, chat_mode)
-            put_dialog_item(user, message_text, resp)
-            put_llm_stats(user, usage)
+            put_dialog_item(session, message_text, resp, usage)
+            self.__ledger.record_llm(user.id, config['model'], usage.total_tokens)
 
             if is_markdown(parse_mode):
                 resp = escape_markdown(resp)
@@ -484,44 +541,80 @@ class Bot:
                     if 'timer' in payload:
                         _logger.debug(f'Setting up timer: [{payload}]')
                         timer = payload['timer']
-                        loop = asyncio.get_running_loop()
                         fire_in = timedelta(seconds=timer['fire_in'])
-                        loop.call_later(fire_in.total_seconds(), asyncio.create_task, self.__timer_tracker_task(tg_user, timer))
+                        await self.__timers.add(user_id=tg_user.id, 
+                                                chat_id=message.chat_id, 
+                                                text=timer['text'], 
+                                                fire_at=utcnow() + fire_in)
                         await send_reply(f'⏰ Timer is set up: {fire_in}', message)
                 else:
                     await send_reply(resp, message, parse_mode)
 
 
+    def __stream_editor(self, message, parse_mode):
+        config = self.__config
+        bot = self.__app.bot
+        
+        async def edit(text, final):
+            # only the final text may be empty, intermediate ones are edited in once there are chars
+            text = text or EMPTY_REPLY_MESSAGE
+            try:
+                # intermediate edits aren't retried by rate limiter, so the editor backs off on flood control
+                await bot.edit_message_text(text, 
+                                            chat_id=message.chat_id, 
+                                            message_id=message.message_id, 
+                                            parse_mode=parse_mode,
+                                            rate_limit_args=None if final else dict(max_retries=0))
+            except telegram.error.BadRequest as e:
+                if str(e).startswith("Message is not modified"):
+                    return
+
+                _logger.warning(f'BadRequest: [{e!r}]', exc_info=e)
+                if final:
+                    # partial markup can't be parsed, so the text is sent as is
+                    await bot.edit_message_text(unescape_markdown(text) if is_markdown(parse_mode) else text, 
+                                                chat_id=message.chat_id, 
+                                                message_id=message.message_id)
+
+        return StreamEditor(edit, 
+                            self.__edit_pacer, 
+                            message.chat_id, 
+                            min_chars=config['stream_update_chars'], 
+                            max_delay=config['stream_max_delay'])
+
+
     async def __bot_typing_task(self, message):
         while True:
             await message.reply_chat_action(action=ChatAction.TYPING)
             await asyncio.sleep(6)
 
 
-    async def __timer_tracker_task(self, user, timer):
-        _logger.debug(f'Fire timer: [{timer}]')
-        await user.send_message(f"⏰ Please don't forget about: {timer['text']}")
+    async def __timer_tracker_task(self, timer):
+        _logger.debug(f'Fire timer: [{timer.id=}; {timer.fire_at=}]')
+        try:
+            await self.__app.bot.send_message(timer.chat_id, f"⏰ Please don't forget about: {timer.text}")
+        except telegram.error.Forbidden as e:
+            # bot is blocked by the user, no use to retry
+            _logger.info(f'Timer is not delivered [{timer.user_id=}] [{e!r}]')
 
 
-    def __register_user(self, tg_user):
-        if tg_user.id not in self.__pending_guards:
-            self.__pending_guards[tg_user.id] = PendingGuard(lock=asyncio.Lock(),
-                                                             message_lock=asyncio.Lock(),
-                                                             messages=list())
+    @asynccontextmanager
+    async def __user_session(self, tg_user, fence=None):
+        """Registers user and gives update scoped session, 
+        so the user is read once and all the changes are written once"""
 
-        now_utc = datetime.now(tz=timezone.utc)
-        repo = self.__repo
-        user = repo.get_user(tg_user.id)
-        user.last_seen = now_utc
-        if user.first_seen is None:
-            _logger.debug('Add new user')
-            user.first_seen = now_utc
-            user.username = tg_user.username
-            user.first_name=tg_user.first_name
-            user.last_name= tg_user.last_name
+        dialog_max_items = self.__config['dialog_max_items']
+        async with UserSession(self.__repo, tg_user.id, dialog_max_items, fence) as session:
+            now_utc = datetime.now(tz=timezone.utc)
+            session.set(last_seen=now_utc)
+            if session.user.first_seen is None:
+                _logger.debug('Add new user')
+                session.set(first_seen=now_utc,
+                            username=tg_user.username,
+                            first_name=tg_user.first_name,
+                            last_name=tg_user.last_name)
 
-        repo.put_user(user)
-        return user
+            yield session
 
 
     @log_handler(_logger)
@@ -531,7 +624,6 @@ class Bot:
 
 
     async def __show_chat_modes(self, update: Update, context: CallbackContext):
-        self.__register_user(update.message.from_user)
         text, reply_markup = self.__get_chat_mode_menu()
         await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
@@ -540,7 +632,6 @@ class Bot:
     @pending_protect
     async def __show_chat_modes_callback_handler(self, update: Update, context: CallbackContext):
         query = update.callback_query
-        self.__register_user(query.from_user)
 
         await query.answer()
 
@@ -559,15 +650,14 @@ class Bot:
     @pending_protect
     async def __set_chat_mode_handler(self, update: Update, context: CallbackContext):
         query = update.callback_query
-        user = self.__register_user(query.from_user)
 
         await query.answer()
 
         chat_mode = query.data.split("|")[1]
 
-        user.chat_mode = chat_mode
-        user.current_dialog = list()
-        self.__repo.put_user(user)
+        session = context.user_session
+        session.set(chat_mode=chat_mode)
+        session.new_dialog()
         config = self.__config
 
         await context.bot.send_message(
@@ -616,9 +706,23 @@ class Bot:
 
 
     def _get_pending_guard(self, user_id):
+        if user_id not in self.__pending_guards:
+            self.__pending_guards[user_id] = PendingGuard(lock=asyncio.Lock(),
+                                                          message_lock=asyncio.Lock(),
+                                                          messages=list())
+
         return self.__pending_guards[user_id]
 
 
+    def _release_pending_guard(self, user_id, guard):
+        """Drops the guard along with the last pending message of the user. 
+        Guard is got and its message is pushed with no await in between, 
+        so the guard having no pending messages is not used by anyone"""
+
+        if not guard.messages and self.__pending_guards.get(user_id) is guard:
+            del self.__pending_guards[user_id]
+
+
     async def __post_init(self, app):
         _logger.info(f'Bot started')
 
@@ -631,3 +735,34 @@ class Bot:
             BotCommand("/help", "Show help message"),
         ])
 
+        for hook in self.__startup_hooks:
+            try:
+                await hook()
+            except BaseException as e:
+                _logger.error('Startup hook failed', exc_info=e)
+
+        if self.__fires_timers:
+            self.__timers.start(self.__timer_tracker_task)
+        interval = self.__config['metrics_log_interval']
+        if interval:
+            self.__metrics_task = asyncio.create_task(self.__metrics_log_task(interval))
+
+
+    async def __metrics_log_task(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            metrics.log_snapshot()
+
+
+    async def __post_shutdown(self, app):
+        if self.__metrics_task is not None:
+            self.__metrics_task.cancel()
+
+        await self.__timers.stop()
+        for hook in self.__shutdown_hooks:
+            try:
+                await hook()
+            except BaseException as e:
+                _logger.error('Shutdown hook failed', exc_info=e)
+
+        _logger.info(f'Bot stopped')
@@ -0,0 +1,295 @@
+from bot import Bot, pending_protect, send_reply, EMPTY_REPLY_MESSAGE
+from lease import LocalLeases, LeaseBusyError
+from repository import User as BotUser
+from ai_test import make_assistant, FakeCompletions, FakeDeltaStream
+from stream_editor import EditPacer, EditRateLimiter
+
+import telegram
+from telegram import Update, Message, Chat, User
+from telegram.constants import ParseMode
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+from contextlib import asynccontextmanager
+from collections import namedtuple
+from datetime import datetime
+import pytest
+import asyncio
+import json
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+
+class FakeContext:
+    pass
+
+
+class PendingHost:
+    def __init__(self, leases=LocalLeases()):
+        self._Bot__pending_guards = dict()
+        self._user_lease = leases.hold
+        self.release = asyncio.Event()
+        self.replied = list()
+        self.fences = list()
+
+    _get_pending_guard = Bot._get_pending_guard
+    _release_pending_guard = Bot._release_pending_guard
+
+    @property
+    def guards(self):
+        return self._Bot__pending_guards
+
+    @asynccontextmanager
+    async def _user_session(self, user, fence):
+        self.fences.append(fence)
+        yield None
+
+    @pending_protect
+    async def handle(self, update, context):
+        await self.release.wait()
+        self.replied.append(update.effective_message.text)
+
+
+def make_update(user_id, text):
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=user_id, type='private'), 
+                      from_user=User(id=user_id, first_name='user', is_bot=False), text=text)
+    return Update(update_id=1, message=message)
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    replies = list()
+    async def reply_text(self, text, **kwargs):
+        replies.append(text)
+
+    monkeypatch.setattr(Message, 'reply_text', reply_text)
+    return replies
+
+
+def test_pending_guard_must_be_dropped_with_the_last_pending_message(replies):
+    async def test():
+        sut = PendingHost()
+        first = asyncio.create_task(sut.handle(make_update(1, 'first'), FakeContext()))
+        await asyncio.sleep(0)
+        assert list(sut.guards) == [1]
+
+        # rejected while the first one is pending, the guard is kept
+        await sut.handle(make_update(1, 'second'), FakeContext())
+        assert len(replies) == 1
+        assert list(sut.guards) == [1]
+
+        sut.release.set()
+        await first
+        assert sut.replied == ['first']
+        assert sut.guards == dict()
+
+    asyncio.run(test())
+
+
+def test_pending_guard_must_be_dropped_on_failure(replies):
+    async def test():
+        sut = PendingHost()
+        with pytest.raises(AttributeError):
+            await sut.handle(make_update(1, 'first'), None)
+
+        assert sut.guards == dict()
+
+    asyncio.run(test())
+
+
+class BusyLeases:
+    @asynccontextmanager
+    async def hold(self, user_id):
+        raise LeaseBusyError(user_id)
+        yield
+
+
+def test_pending_protect_must_reply_wait_if_user_lease_is_held_by_another_replica(replies):
+    async def test():
+        sut = PendingHost(BusyLeases())
+        sut.release.set()
+        await sut.handle(make_update(1, 'first'), FakeContext())
+        assert len(replies) == 1
+        assert sut.replied == []
+        assert sut.guards == dict()
+
+    asyncio.run(test())
+
+
+def test_send_reply_must_resend_only_message_failed_to_be_parsed(monkeypatch):
+    sent = list()
+    async def reply_text(self, text, parse_mode=None, **kwargs):
+        if parse_mode is not None and 'bad' in text:
+            raise telegram.error.BadRequest("Can't parse entities")
+
+        sent.append((text, parse_mode))
+
+    monkeypatch.setattr(Message, 'reply_text', reply_text)
+    message = make_update(1, 'question').message
+    text = f'{"good " * 700}\n\nbad \\.'
+    asyncio.run(send_reply(text, message, 'MarkdownV2'))
+    assert [parse_mode for _, parse_mode in sent] == ['MarkdownV2', None]
+    assert sent[1][0].strip() == 'bad .'
+
+
+class EditingBot:
+    def __init__(self):
+        self.edits = list()
+
+    async def edit_message_text(self, text, parse_mode=None, **kwargs):
+        if not text:
+            raise telegram.error.BadRequest('Message text is empty')
+
+        self.edits.append((text, parse_mode))
+
+
+class StreamEditorHost:
+    def __init__(self, bot):
+        self._Bot__config = dict(stream_update_chars=100, stream_max_delay=2)
+        self._Bot__app = namedtuple('App', ['bot'])(bot=bot)
+        self._Bot__edit_pacer = EditPacer(min_interval=0, max_interval=1)
+
+    _stream_editor = _Bot__stream_editor = Bot._Bot__stream_editor
+
+
+def test_stream_editor_must_edit_in_empty_reply_message_if_answer_is_empty():
+    async def test():
+        bot = EditingBot()
+        placeholder = make_update(1, '...').message
+        async with StreamEditorHost(bot)._stream_editor(placeholder, ParseMode.MARKDOWN_V2) as editor:
+            await editor.finish('')
+
+        assert bot.edits == [(EMPTY_REPLY_MESSAGE, ParseMode.MARKDOWN_V2)]
+
+    asyncio.run(test())
+
+
+class UnparsingBot(EditingBot):
+    async def edit_message_text(self, text, parse_mode=None, **kwargs):
+        if parse_mode is not None:
+            raise telegram.error.BadRequest("Can't parse entities")
+
+        await super().edit_message_text(text, parse_mode, **kwargs)
+
+
+def test_stream_editor_must_edit_in_unescaped_text_if_markdown_fails_to_be_parsed():
+    async def test():
+        bot = UnparsingBot()
+        placeholder = make_update(1, '...').message
+        async with StreamEditorHost(bot)._stream_editor(placeholder, ParseMode.MARKDOWN_V2) as editor:
+            await editor.finish('*Done\\.')
+
+        assert bot.edits == [('*Done.', None)]
+
+    asyncio.run(test())
+
+
+class FloodRequest(BaseRequest):
+    """Telegram api flood controlling the first requests"""
+
+    def __init__(self, floods):
+        self.floods = floods
+        self.texts = list()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        self.texts.append(request_data.parameters.get('text'))
+        if self.floods:
+            self.floods -= 1
+            return 429, json.dumps(dict(ok=False, error_code=429, description='Too Many Requests: retry after 1',
+                                        parameters=dict(retry_after=1))).encode()
+
+        return 200, json.dumps(dict(ok=True, result=True)).encode()
+
+
+def test_stream_editor_must_not_retry_flood_controlled_intermediate_edit_by_rate_limiter():
+    async def test():
+        request = FloodRequest(floods=1)
+        bot = ExtBot('1:token', request=request, get_updates_request=request, rate_limiter=EditRateLimiter(max_retries=5))
+        host = StreamEditorHost(bot)
+        host._Bot__config['stream_update_chars'] = 1
+        placeholder = make_update(1, '...').message
+        async with host._stream_editor(placeholder, ParseMode.HTML) as editor:
+            editor.push('part')
+            await asyncio.wait_for(wait_for(lambda: len(request.texts) == 2), timeout=5)
+            await editor.finish('final')
+
+        # flood control is handled by the editor
+        assert request.texts == ['part', 'part', 'final']
+        assert host._Bot__edit_pacer.retries == 1
+
+    asyncio.run(test())
+
+
+async def wait_for(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+class FakeLedger:
+    def __init__(self):
+        self.records = list()
+
+    def record_llm(self, user_id, model_name, tokens_num):
+        self.records.append((user_id, model_name, tokens_num))
+
+
+class FakeSession:
+    def __init__(self, user):
+        self.user = user
+        self.dialog = list()
+
+    async def get_dialog(self):
+        return list()
+
+    def push_dialog(self, *items):
+        self.dialog.extend((item.content, dict(item.tokens)) for item in items)
+
+
+class ReplyHost(StreamEditorHost):
+    def __init__(self, bot, assistant, ledger):
+        super().__init__(bot)
+        self._Bot__config.update(message_streaming=True, 
+                                 model='llama', 
+                                 models=dict(llama=dict(tokenizer='llama3')), 
+                                 chat_modes=dict(assistant=dict(parse_mode='html')))
+        self._Bot__assistant_factory = lambda: assistant
+        self._Bot__ledger = ledger
+
+    _Bot__parse_mode = Bot._Bot__parse_mode
+    _message_handler_task = Bot._Bot__message_handler_task
+
+
+def test_streamed_reply_must_be_billed_by_counted_tokens(monkeypatch):
+    placeholder = make_update(1, '...').message
+    async def reply_text(self, text, **kwargs):
+        return placeholder
+
+    async def reply_chat_action(self, action, **kwargs):
+        pass
+
+    monkeypatch.setattr(Message, 'reply_text', reply_text)
+    monkeypatch.setattr(Message, 'reply_chat_action', reply_chat_action)
+
+    async def test():
+        bot, ledger = EditingBot(), FakeLedger()
+        assistant = make_assistant(FakeCompletions(FakeDeltaStream(['Four', ' words', ' of', ' answer'])))
+        session = FakeSession(BotUser(id=1, chat_mode='assistant'))
+        message = make_update(1, 'Hi there').message
+        await ReplyHost(bot, assistant, ledger)._message_handler_task(message.from_user, session, message, None)
+
+        assert ledger.records == [(1, 'llama', 10)]
+        assert session.dialog == [('Hi there', {}), ('Four words of answer', {'llama3': 6})]
+        assert bot.edits[-1] == ('Four words of answer', 'HTML')
+
+    asyncio.run(test())
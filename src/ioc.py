@@ -1,28 +1,92 @@
-from repository import Repository
+from repository import Repository, AsyncRepository, CachingRepository, UserCache
 from bot import Bot
 from app_service import AppService
-from ai import Assistant
+from ai import Assistant, create_openai_client
+from tokenizer_service import TokenizerService, TokenCountCache
+from timer_scheduler import TimerScheduler
+from lease import LocalLeases, MongoLeases
+from transcription import DeepgramTranscriber, LocalTranscriber
+from accounting import AccountingProvider, UsageLedger
 
 from telegram.ext import ApplicationBuilder
-import openai
 
 from dependency_injector.containers import DeclarativeContainer
-from dependency_injector.providers import Configuration, Singleton, Dependency, Factory
+from dependency_injector.providers import Configuration, Singleton, Dependency, Factory, Selector
 from os.path import realpath, abspath
 
 
 class Container(DeclarativeContainer):
     config = Configuration(strict=True)
-    repo = Singleton(Repository, mongodb_uri=config.mongodb_uri)
+    sync_repo = Singleton(Repository, mongodb_uri=config.mongodb_uri)
+    async_repo = Singleton(AsyncRepository, repository=sync_repo, max_workers=config.repository_workers)
+    user_cache = Singleton(UserCache, capacity=config.user_cache.capacity, ttl=config.user_cache.ttl)
+    repo = Singleton(CachingRepository, repository=async_repo, cache=user_cache)
     tg_app_builder = Singleton(ApplicationBuilder)
-    openai_client = Factory(openai.AsyncOpenAI, 
-                            api_key=config.anyscale_token, 
-                            base_url=config.anyscale_base_url)
+    openai_client = Singleton(create_openai_client, 
+                              api_key=config.anyscale_token, 
+                              base_url=config.anyscale_base_url,
+                              http2=config.openai_http.http2,
+                              max_connections=config.openai_http.max_connections,
+                              max_keepalive_connections=config.openai_http.max_keepalive_connections,
+                              keepalive_expiry=config.openai_http.keepalive_expiry,
+                              timeout=config.openai_http.timeout)
 
-    assistant = Factory(Assistant, client=openai_client, config=config)
+    token_cache = Singleton(TokenCountCache, max_entries=config.token_cache_entries)
+    tokenizer = Singleton(TokenizerService, workers=config.tokenizer_workers, cache=token_cache)
+    assistant = Factory(Assistant, client=openai_client, config=config, tokenizer=tokenizer)
+    timer_scheduler = Singleton(TimerScheduler, 
+                                repository=async_repo,
+                                window=config.timers.window,
+                                batch_size=config.timers.batch_size,
+                                retry_delay=config.timers.retry_delay,
+                                max_attempts=config.timers.max_attempts,
+                                poll_interval=config.timers.poll_interval,
+                                claim_ttl=config.timers.claim_ttl)
+    leases = Selector(config.user_lease.backend,
+                      local=Singleton(LocalLeases),
+                      mongo=Singleton(MongoLeases, repository=async_repo, ttl=config.user_lease.ttl))
+    transcriber = Selector(config.transcription_backend,
+                           deepgram=Singleton(DeepgramTranscriber,
+                                              api_key=config.deepgram_token,
+                                              model=config.deepgram_model,
+                                              models=config.deepgram_models,
+                                              timeout=config.deepgram_timeout,
+                                              max_concurrency=config.deepgram_http.max_concurrency,
+                                              max_attempts=config.deepgram_http.max_attempts,
+                                              backoff=config.deepgram_http.backoff,
+                                              keepalive_expiry=config.deepgram_http.keepalive_expiry),
+                           local=Singleton(LocalTranscriber,
+                                           model=config.local_stt.model,
+                                           compute_type=config.local_stt.compute_type,
+                                           workers=config.local_stt.workers,
+                                           cpu_threads=config.local_stt.cpu_threads,
+                                           options=config.local_stt.options,
+                                           max_batch=config.local_stt.max_batch,
+                                           batch_window=config.local_stt.batch_window,
+                                           batch_max_size=config.local_stt.batch_max_size,
+                                           download_timeout=config.local_stt.download_timeout))
+    accounting = Singleton(AccountingProvider, config=config)
+    ledger = Singleton(UsageLedger,
+                       repository=repo,
+                       accounting=accounting,
+                       flush_interval=config.billing.flush_interval,
+                       reconcile_interval=config.billing.reconcile_interval,
+                       reconcile_age=config.billing.reconcile_age,
+                       reconcile_batches=config.billing.reconcile_batches)
     bot = Singleton(Bot,
                     config=config, 
                     telegram_app_builder=tg_app_builder, 
                     repository=repo,
-                    assistant_factory=assistant.provider)
-    app_service = Singleton(AppService, config=config, bot=bot)
+                    assistant_factory=assistant.provider,
+                    timer_scheduler=timer_scheduler,
+                    leases=leases,
+                    transcriber=transcriber,
+                    ledger=ledger)
+    app_service = Singleton(AppService, 
+                            config=config, 
+                            bot=bot, 
+                            repository=repo,
+                            tokenizer=tokenizer, 
+                            openai_client=openai_client,
+                            transcriber=transcriber,
+                            ledger=ledger)
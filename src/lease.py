@@ -0,0 +1,78 @@
+from timer_scheduler import utcnow
+import metrics
+
+from contextlib import asynccontextmanager
+from uuid import uuid4
+import asyncio
+import logging
+import socket
+import os
+
+
+_logger = logging.getLogger(__name__)
+
+
+class LeaseBusyError(RuntimeError):
+    pass
+
+
+class LocalLeases:
+    """Leases of the only bot instance. Users are serialized by in-process locks, so leases are always granted 
+    and writes are not fenced"""
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        yield None
+
+
+class MongoLeases:
+    """Per user leases shared by bot replicas. Lease is renewed while it's held and expires if the holder stalls. 
+    Every acquisition gets greater fencing token, so writes of a stalled holder are rejected. 
+    Leases expire by replica clocks, so they're expected to be synchronized well within ttl"""
+
+    def __init__(self, repository, ttl):
+        self.__repo = repository
+        self.__ttl = ttl
+        self.__owner_prefix = f'{socket.gethostname()}:{os.getpid()}'
+        self.busy = 0
+        self.lost = 0
+        metrics.register('user_leases_busy', lambda: self.busy)
+        metrics.register('user_leases_lost', lambda: self.lost)
+
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        """Holds the user lease yielding its fencing token. Raises LeaseBusyError if it's held by another owner"""
+
+        repo = self.__repo
+        owner = f'{self.__owner_prefix}:{uuid4().hex}'
+        token = await repo.acquire_lease(user_id, owner, utcnow(), self.__ttl)
+        if token is None:
+            self.busy += 1
+            raise LeaseBusyError(user_id)
+
+        renewal = asyncio.create_task(self.__renew(user_id, owner, token))
+        try:
+            yield token
+        finally:
+            renewal.cancel()
+            try:
+                await repo.release_lease(user_id, owner, token, utcnow())
+            except BaseException as e:
+                # expires by itself
+                _logger.warning(f'Lease is not released [{user_id=}; {token=}] [{e!r}]')
+
+
+    async def __renew(self, user_id, owner, token):
+        ttl = self.__ttl
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await self.__repo.renew_lease(user_id, owner, token, utcnow(), ttl):
+                    self.lost += 1
+                    _logger.warning(f'Lease is lost [{user_id=}; {token=}]')
+                    return
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                _logger.warning(f'Lease renewal failed [{user_id=}; {token=}] [{e!r}]')
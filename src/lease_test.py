@@ -0,0 +1,80 @@
+from lease import MongoLeases, LeaseBusyError
+
+import pytest
+import asyncio
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+
+class FakeRepository:
+    def __init__(self):
+        self.leases = dict()
+        self.last_token = 0
+        self.renewals = 0
+
+    async def acquire_lease(self, user_id, owner, now, ttl):
+        if user_id in self.leases:
+            return None
+
+        self.last_token += 1
+        self.leases[user_id] = owner, self.last_token
+        return self.last_token
+
+    async def renew_lease(self, user_id, owner, token, now, ttl):
+        self.renewals += 1
+        return self.leases.get(user_id) == (owner, token)
+
+    async def release_lease(self, user_id, owner, token, now):
+        if self.leases.get(user_id) == (owner, token):
+            del self.leases[user_id]
+
+
+def test_mongo_leases_must_give_growing_fencing_tokens_and_release_lease():
+    async def test():
+        repo = FakeRepository()
+        sut = MongoLeases(repo, ttl=30)
+        async with sut.hold(1) as first:
+            assert 1 in repo.leases
+
+        async with sut.hold(1) as second:
+            pass
+
+        assert first < second
+        assert repo.leases == dict()
+
+    asyncio.run(test())
+
+
+def test_mongo_leases_must_raise_if_lease_is_held():
+    async def test():
+        sut = MongoLeases(FakeRepository(), ttl=30)
+        async with sut.hold(1):
+            with pytest.raises(LeaseBusyError):
+                async with sut.hold(1):
+                    pass
+
+            async with sut.hold(2):
+                pass
+
+        assert sut.busy == 1
+
+    asyncio.run(test())
+
+
+def test_mongo_leases_must_renew_held_lease():
+    async def test():
+        repo = FakeRepository()
+        sut = MongoLeases(repo, ttl=0.03)
+        async with sut.hold(1):
+            await asyncio.sleep(0.05)
+            assert repo.renewals >= 2
+            # taken over after expiration
+            repo.leases[1] = 'other', 100
+            await asyncio.sleep(0.02)
+
+        assert sut.lost == 1
+        assert repo.leases == {1: ('other', 100)}
+
+    asyncio.run(test())
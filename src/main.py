@@ -3,6 +3,7 @@ from dependency_injector.wiring import inject, Provide
 from dependency_injector.providers import Configuration
 
 import ioc
+from sharding import ShardDispatcher
 
 from os.path import dirname, realpath, abspath, join, basename, splitext
 from argparse import ArgumentParser
@@ -11,6 +12,7 @@ import logging
 import sys
 import os
 import glob
+import signal
 
 
 logger = logging.getLogger(__name__)
@@ -30,6 +32,10 @@ class Color:
 c = Color
 
 
+def migrate_dialogs(app_service, **kwargs):
+    app_service.migrate_dialogs()
+
+
 @inject
 def run(args, app_service=Provide[ioc.Container.app_service]):
     if 'handler' in args:
@@ -49,6 +55,14 @@ def cli(args=sys.argv[1:]):
     parser.add_argument('--log-level', default=os.environ.get('VALERY_LOG_LEVEL', 'INFO'), help='App log level (default: %(default)s')
     parser.add_argument('--deps-log-level', default=os.environ.get('VALERY_DEPS_LOG_LEVEL', 'WARNING'), help='App deps log level (default: %(default)s')
     parser.add_argument('--no-color', action='store_true', default=False, help='Use no color for log output')
+    parser.add_argument('--webhook', action='store_true', default=False, help='Receive updates by webhook instead of polling')
+    parser.add_argument('--workers', type=int, help='Worker processes users are sharded to (default: workers from config)')
+
+    subparsers = parser.add_subparsers(title='commands')
+    migrate_parser = subparsers.add_parser('migrate-dialogs', 
+                                           help='Move dialogs embedded into users to dialogs collection. '
+                                                'Safe to run along with the bot')
+    migrate_parser.set_defaults(handler=migrate_dialogs)
 
     return parser.parse_args(args)
 
@@ -62,9 +76,7 @@ def setup_loggers(log_level, deps_log_level, log_format):
         logging.getLogger(name).setLevel(deps_log_level)
 
 
-def main():
-    args = cli()
-
+def setup(args):
     log_format = ('[%(asctime)s]:%(levelname)-5s:: %(message)s -- {%(filename)s:%(lineno)d:(%(funcName)s)}' 
                   if args.no_color else
                   f'[{c.white}%(asctime)s{c.off}]:{c.yellow}%(levelname)-5s{c.off}::{c.green} %(message)s {c.white}-- {c.yellow}{{{c.blue}%(filename)s{c.off}:{c.cyan}%(lineno)d{c.off}:({c.purple}%(funcName)s{c.off}){c.yellow}}}{c.off}')
@@ -73,7 +85,38 @@ def main():
     container = ioc.Container()
     config_fn = realpath(abspath(args.config))
     container.config.from_yaml(config_fn, required=True)
+    if args.webhook:
+        container.config.webhook.enabled.from_value(True)
+
+    if args.workers is not None:
+        container.config.workers.from_value(args.workers)
+
     container.wire(modules=[__name__])
+    return container
+
+
+def run_worker(args, shard, updates):
+    """Worker process processing updates of the shard"""
+
+    # stopped by dispatcher once it's done with routing
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    container = setup(args)
+    container.app_service().run_worker(shard, updates)
+
+
+def main():
+    args = cli()
+    container = setup(args)
+    config = container.config
+    if config.workers() > 1 and 'handler' not in args:
+        dispatcher = ShardDispatcher(config(), 
+                                     workers=config.workers(), 
+                                     worker_main=run_worker, 
+                                     worker_args=(args,), 
+                                     max_queue=config.worker_queue())
+        dispatcher.run()
+        return
+
     run(args)
 
 
@@ -0,0 +1,365 @@
+import logging
+import re
+
+
+_logger = logging.getLogger(__name__)
+
+
+MESSAGE_LEN_LIMIT = 4096
+
+
+# SPECIAL_CHARS = '\\', '_', '*', '[', ']', '(', ')', '~', '`', '>', '<', '&', '#', '+', '-', '=', '|', '{', '}', '.', '!'
+SPECIAL_CHARS = '\\', '[', ']', '(', ')', '>', '<', '&', '#', '+', '-', '=', '|', '{', '}', '.', '!'
+_ESCAPE_TABLE = str.maketrans({char: f'\\{char}' for char in SPECIAL_CHARS})
+# see markup_bench.py
+_TRANSLATE_MAX_LEN = 16
+_ESCAPED_RE = re.compile(r'\\(.)', re.DOTALL)
+
+
+def escape_markdown(text):
+    """Escapes special chars. Chars are escaped independently of each other,
+    so streamed deltas are escaped one by one and joined the same as the whole text"""
+
+    if len(text) <= _TRANSLATE_MAX_LEN:
+        # single pass is faster for short deltas
+        return text.translate(_ESCAPE_TABLE)
+
+    # c replace passes over long text are faster than translating it char by char
+    for char in SPECIAL_CHARS:
+        text = text.replace(char, f'\\{char}')
+
+    return text
+
+
+def unescape_markdown(text):
+    return _ESCAPED_RE.sub(r'\1', text)
+
+
+def is_markdown(parse_mode):
+    return parse_mode.lower().startswith('markdown')
+
+
+def split_text(text, chunk_size=MESSAGE_LEN_LIMIT):
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+
+
+_HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^>]*>')
+# longest html entity is to be kept whole, e.g. &#x1F600;
+_HTML_ENTITY_MAX_LEN = 10
+
+
+def split_message(text, parse_mode=None, limit=MESSAGE_LEN_LIMIT):
+    """Splits text into messages at paragraph, line or word edges. 
+    Entities open at the split are closed and reopened in the next message, so every message is parsed"""
+
+    if parse_mode is not None and is_markdown(parse_mode):
+        stream = MarkdownStream(limit)
+        stream.feed(text)
+        return [message for message in stream.messages(final=True) if message]
+
+    return list(_split_at_edges(text, limit, html=parse_mode is not None and parse_mode.lower() == 'html'))
+
+
+def _split_at_edges(text, limit, html):
+    stack = list()
+    pos, n = 0, len(text)
+    while pos < n:
+        prefix = ''.join(opener for _, opener in stack)
+        end = max(limit - len(prefix), 1)
+        while True:
+            chunk = text[pos:pos + end]
+            if pos + end < n:
+                chunk = chunk[:_edge(chunk, html)]
+
+            tags = _open_tags(stack, chunk) if html else stack
+            closers = ''.join(f'</{name}>' for name, _ in reversed(tags))
+            overflow = len(prefix) + len(chunk) + len(closers) - limit
+            if overflow <= 0 or len(chunk) == 1:
+                break
+
+            end = max(len(chunk) - overflow, 1)
+
+        yield prefix + chunk + closers
+        stack = tags
+        pos += len(chunk)
+
+
+def _edge(chunk, html):
+    """Length of chunk part ending at paragraph, line or word edge found in its second half"""
+
+    end = len(chunk)
+    for separator in '\n\n', '\n', ' ':
+        pos = chunk.rfind(separator, end // 2)
+        if pos >= 0:
+            end = pos + len(separator)
+            break
+
+    if html:
+        # tags and entities aren't cut
+        tag_start = chunk.rfind('<', 0, end)
+        if tag_start > chunk.rfind('>', 0, end):
+            end = tag_start
+
+        entity_start = chunk.rfind('&', max(end - _HTML_ENTITY_MAX_LEN, 0), end)
+        if entity_start >= 0 and chunk.find(';', entity_start, end) < 0:
+            end = entity_start
+
+    return end or len(chunk)
+
+
+def _open_tags(stack, chunk):
+    """Tags left open after the chunk given tags open before it"""
+
+    stack = list(stack)
+    for tag in _HTML_TAG_RE.finditer(chunk):
+        closing, name = tag[1], tag[2].lower()
+        if not closing:
+            stack.append((name, tag[0]))
+            continue
+
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                del stack[i:]
+                break
+
+    return stack
+
+
+class TextStream:
+    """Splits streamed text with no markup or html into messages"""
+
+    def __init__(self, parse_mode=None, limit=MESSAGE_LEN_LIMIT):
+        self.__parse_mode = parse_mode
+        self.__limit = limit
+        self.__text = ''
+
+
+    def feed(self, delta):
+        self.__text += delta
+
+
+    def messages(self, final=False):
+        return split_message(self.__text, self.__parse_mode, self.__limit) or ['']
+
+
+class _Entity:
+    __slots__ = 'marker', 'opener', 'pos', 'empty'
+
+    def __init__(self, marker, opener, pos):
+        self.marker = marker
+        self.opener = opener
+        # position of the opener in the message body
+        self.pos = pos
+        self.empty = True
+
+
+# pre, inline code, underline, italic, bold, strikethrough
+_PRE, _CODE, _UNDERLINE = '```', '`', '__'
+_TOGGLES = '_', '*', '~'
+# runs of chars taken as is, new lines are left out as messages are split at them
+_CODE_RUN_RE = re.compile(r'[^\\`\n]+')
+_TEXT_RUN_RE = re.compile(r'[^\\`_*~\n]+')
+
+
+class MarkdownStream:
+    """Incrementally renders streamed markdown v2 text, escaped by escape_markdown, into valid messages.
+    Raw deltas are escaped on feeding if escape is set.
+    Open entities are tracked across deltas and auto-closed in every render, entities having no content yet
+    are left out. Text is split into messages at the length limit, preferably at a new line,
+    entities open at the split are closed and reopened in the next message, so code blocks are kept whole"""
+
+    # room left for closing entities
+    SPLIT_MARGIN = 32
+
+    def __init__(self, limit=MESSAGE_LEN_LIMIT, escape=False):
+        self.__limit = limit
+        self.__escape = escape
+        # messages are split at a new line once this length is reached
+        self.__soft_limit = limit * 3 // 4
+        self.__done = list()
+        self.__body = ''
+        self.__pending = ''
+        self.__stack = list()
+        # body position of the last entity opened or closed
+        self.__mark = 0
+
+
+    def feed(self, delta):
+        self.__pending += escape_markdown(delta) if self.__escape else delta
+        self.__scan(final=False)
+
+
+    def messages(self, final=False):
+        """Gets rendered messages, all but the last one are complete.
+        Final render takes the tail kept while it could be the start of markup"""
+
+        if final:
+            self.__scan(final=True)
+
+        return self.__done + [self.__render()]
+
+
+    def __scan(self, final):
+        text, stack = self.__pending, self.__stack
+        i, n = 0, len(text)
+        while i < n:
+            top = stack[-1].marker if stack else None
+            run = (_CODE_RUN_RE if top in (_PRE, _CODE) else _TEXT_RUN_RE).match(text, i)
+            if run is not None:
+                self.__append_run(run[0])
+                i = run.end()
+                continue
+
+            char = text[i]
+            if char == '\\':
+                # escaped char
+                if i + 1 >= n and not final:
+                    break
+
+                self.__append(text[i:i + 2] if i + 1 < n else '\\\\')
+                i += 2
+            elif top == _PRE:
+                if char != '`':
+                    self.__append(char)
+                    i += 1
+                elif text.startswith(_PRE, i):
+                    self.__close()
+                    i += 3
+                elif i + 3 > n and not final:
+                    break
+                else:
+                    # backticks must be escaped inside code block
+                    self.__append('\\`')
+                    i += 1
+            elif top == _CODE:
+                if char == '`':
+                    self.__close()
+                else:
+                    self.__append(char)
+
+                i += 1
+            elif char == '`':
+                if i + 3 > n and not final:
+                    break
+
+                if text.startswith(_PRE, i):
+                    end = text.find('\n', i + 3)
+                    if end < 0 and not final:
+                        # language line isn't complete
+                        break
+
+                    end = n if end < 0 else end + 1
+                    self.__open(_PRE, text[i:end].rstrip('\n') + '\n')
+                    i = end
+                else:
+                    self.__open(_CODE, _CODE)
+                    i += 1
+            elif char == '_' and text.startswith(_UNDERLINE, i):
+                self.__toggle(_UNDERLINE)
+                i += 2
+            elif char == '_' and i + 2 > n and not final:
+                # may turn out underline
+                break
+            elif char in _TOGGLES:
+                self.__toggle(char)
+                i += 1
+            else:
+                self.__append(char)
+                i += 1
+
+        self.__pending = text[i:]
+
+
+    def __toggle(self, marker):
+        stack = self.__stack
+        if stack and stack[-1].marker == marker:
+            self.__close()
+        elif any(entity.marker == marker for entity in stack):
+            # closing markup crossing another entity can't be parsed, so it's taken as is
+            self.__append(f'\\{marker[0]}' * len(marker))
+        else:
+            self.__open(marker, marker)
+
+
+    def __open(self, marker, opener):
+        self.__stack.append(_Entity(marker, opener, len(self.__body)))
+        self.__body += opener
+        self.__mark = len(self.__body)
+
+
+    def __close(self):
+        entity = self.__stack.pop()
+        if entity.empty:
+            # empty entity is dropped
+            self.__body = self.__body[:entity.pos]
+        else:
+            self.__body += self.__closer(entity, self.__body)
+
+        self.__mark = len(self.__body)
+
+
+    def __append(self, token):
+        self.__body += token
+        for entity in self.__stack:
+            entity.empty = False
+
+        body_len = len(self.__body)
+        if body_len + self.SPLIT_MARGIN >= self.__limit:
+            self.__split(self.__edge())
+        elif token == '\n' and body_len >= self.__soft_limit:
+            self.__split(body_len)
+
+
+    def __append_run(self, run):
+        while run:
+            # the run is cut where message is to be split
+            room = max(self.__limit - self.SPLIT_MARGIN - len(self.__body), 1)
+            self.__append(run[:room])
+            run = run[room:]
+
+
+    @staticmethod
+    def __closer(entity, body):
+        if entity.marker == _PRE:
+            return _PRE if body.endswith('\n') else '\n' + _PRE
+
+        return entity.marker
+
+
+    def __render(self):
+        body, stack = self.__body, self.__stack
+        # entities having no content are cut off along with their openers
+        cut = next((i for i, entity in enumerate(stack) if entity.empty), len(stack))
+        if cut < len(stack):
+            body = body[:stack[cut].pos]
+
+        return body + ''.join(self.__closer(entity, body) for entity in reversed(stack[:cut]))
+
+
+    def __edge(self):
+        """Body position to split at, the last line or word edge in the second half of the body
+        having no markup after it, so the rest is moved into the next message as is"""
+
+        body = self.__body
+        start = max(self.__mark + 1, len(body) // 2)
+        for separator in '\n', ' ':
+            pos = body.rfind(separator, start)
+            if pos >= 0 and body[pos - 1] != '\\':
+                return pos + 1
+
+        return len(body)
+
+
+    def __split(self, pos):
+        body, rest = self.__body[:pos], self.__body[pos:]
+        self.__body = body
+        self.__done.append(self.__render())
+        self.__body = ''
+        for entity in self.__stack:
+            entity.pos = len(self.__body)
+            entity.empty = not rest
+            self.__body += entity.opener
+
+        self.__mark = len(self.__body)
+        self.__body += rest
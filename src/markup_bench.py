@@ -0,0 +1,54 @@
+"""Microbenchmark of markdown escaping, run as python markup_bench.py"""
+
+from markup import escape_markdown, SPECIAL_CHARS, MarkdownStream
+
+import timeit
+
+
+def legacy_escape_markdown(text):
+    for char in SPECIAL_CHARS:
+        text = text.replace(char, f'\\{char}')
+
+    return text
+
+
+CODE = '''```python
+def fib(n: int) -> int:
+    # returns n-th fibonacci number
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a if n >= 0 else -1
+
+
+print({i: fib(i) for i in range(10)}, [x ** 2 for x in (1, 2, 3)], "done!")
+```
+'''
+
+
+def bench(name, fn, number):
+    secs = min(timeit.repeat(fn, number=number, repeat=5))
+    print(f'{name:<32}{secs / number * 1e6:>10.1f} us')
+
+
+def main():
+    text = CODE * 40
+    deltas = [text[i:i + 4] for i in range(0, len(text), 4)]
+    print(f'{len(text)=}; {len(deltas)=}')
+    bench('legacy, whole text', lambda: legacy_escape_markdown(text), 200)
+    bench('escape_markdown, whole text', lambda: escape_markdown(text), 200)
+    bench('legacy, deltas', lambda: [legacy_escape_markdown(delta) for delta in deltas], 20)
+    bench('escape_markdown, deltas', lambda: [escape_markdown(delta) for delta in deltas], 20)
+
+    def stream():
+        sut = MarkdownStream(escape=True)
+        for delta in deltas:
+            sut.feed(delta)
+
+        return sut.messages(final=True)
+
+    bench('markdown stream, deltas', stream, 20)
+
+
+if __name__ == '__main__':
+    main()
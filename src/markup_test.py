@@ -0,0 +1,145 @@
+from markup import MarkdownStream, TextStream, escape_markdown, unescape_markdown, split_message, SPECIAL_CHARS
+
+import pytest
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+
+def stream_renders(text, step=1, limit=4096):
+    sut = MarkdownStream(limit=limit)
+    renders = list()
+    for i in range(0, len(text), step):
+        sut.feed(text[i:i + step])
+        renders.append(sut.messages())
+
+    return renders, sut.messages(final=True)
+
+
+def test_markdown_stream_must_close_open_entities():
+    renders, final = stream_renders(escape_markdown('Use *bold and `code'))
+    assert renders[-1] == ['Use *bold and `code`*']
+    assert final == ['Use *bold and `code`*']
+
+
+def test_markdown_stream_must_leave_out_empty_entities():
+    renders, _ = stream_renders('text *')
+    assert renders[-1] == ['text ']
+
+
+def test_markdown_stream_must_close_code_block_and_hold_language_line():
+    text = escape_markdown('Here:\n```python\nprint(1)\n```\nDone.')
+    renders, final = stream_renders(text)
+    assert ['Here:\n'] in renders
+    assert ['Here:\n```python\nprint\\(1\\)\n```'] in renders
+    assert final == [text]
+
+
+def test_markdown_stream_must_escape_backticks_inside_code_block():
+    _, final = stream_renders('```\na `b` c\n```')
+    assert final == ['```\na \\`b\\` c\n```']
+
+
+def test_markdown_stream_must_keep_underline_and_escapes_whole():
+    renders, final = stream_renders('__under__ \\. _it_')
+    assert ['__u__'] in renders
+    assert all(not render[-1].endswith('\\') for render in renders)
+    assert final == ['__under__ \\. _it_']
+
+
+def test_markdown_stream_must_take_crossing_markup_as_is():
+    _, final = stream_renders('*bold _it* end_')
+    assert final == ['*bold _it\\* end_*']
+
+
+def test_markdown_stream_must_split_messages_without_breaking_code_block():
+    code = ''.join(f'line {i}\n' for i in range(80))
+    text = f'```python\n{code}```'
+    renders, final = stream_renders(text, step=7, limit=256)
+    assert len(final) > 2
+    assert all(len(message) <= 256 for message in final)
+    for message in final:
+        assert message.startswith('```python\n') and message.endswith('```')
+
+    assert ''.join(message[len('```python\n'):-len('```')] for message in final) == code
+
+
+def test_text_stream_must_split_text():
+    sut = TextStream(limit=4)
+    sut.feed('abcdefghij')
+    assert sut.messages() == ['abcd', 'efgh', 'ij']
+
+
+def legacy_escape_markdown(text):
+    for char in SPECIAL_CHARS:
+        text = text.replace(char, f'\\{char}')
+
+    return text
+
+
+@pytest.mark.parametrize('text', ['', 'plain', 'a\\b.c', 'f(x) = [1, 2] | {3}! <a href="#">&</a>', '\\\\.', '*_~`'])
+def test_escape_markdown_must_match_legacy_escaping(text):
+    assert escape_markdown(text) == legacy_escape_markdown(text)
+    assert unescape_markdown(escape_markdown(text)) == text
+
+
+def test_escape_markdown_must_escape_deltas_as_whole_text():
+    text = 'def f(x):\n    return x.y \\ 2 - 1 # comment!'
+    deltas = [text[i:i + 3] for i in range(0, len(text), 3)]
+    assert ''.join(map(escape_markdown, deltas)) == escape_markdown(text)
+
+
+def test_markdown_stream_must_escape_raw_deltas():
+    sut = MarkdownStream(escape=True)
+    for delta in 'Call *f(x)* \\', 'n.':
+        sut.feed(delta)
+
+    assert sut.messages(final=True) == ['Call *f\\(x\\)* \\\\n\\.']
+
+
+def test_escape_markdown_must_escape_long_text():
+    text = 'f(x) = [1, 2] | {3}! <a href="#">&</a> \\' * 10
+    assert escape_markdown(text) == legacy_escape_markdown(text)
+
+
+def test_split_message_must_reopen_html_tags():
+    text = '<b>bold <i>italic</i> text &amp; more</b>\n' * 20
+    messages = split_message(text, 'HTML', limit=100)
+    assert len(messages) > 1
+    assert all(len(message) <= 100 for message in messages)
+    assert all(message.endswith('\n') for message in messages)
+    assert ''.join(messages) == text
+
+
+def test_split_message_must_keep_html_tags_and_entities_whole():
+    text = '<a href="https://example.com">link</a> &amp;' * 10
+    for message in split_message(text, 'HTML', limit=50):
+        assert message.count('<') == message.count('>')
+        assert message.count('&') == message.count(';')
+
+
+def test_split_message_must_close_open_html_tags():
+    messages = split_message('<pre><code>' + 'x = 1\n' * 30 + '</code></pre>', 'HTML', limit=64)
+    assert all(message.startswith('<pre><code>') and message.endswith('</code></pre>') for message in messages)
+
+
+def test_split_message_must_split_markdown_without_breaking_code_block():
+    text = '```\n' + 'x \\= 1\n' * 300 + '```'
+    messages = split_message(text, 'MarkdownV2', limit=512)
+    assert len(messages) > 1
+    assert all(message.startswith('```\n') and message.endswith('```') for message in messages)
+
+
+def test_split_message_must_split_plain_text_at_words():
+    assert split_message('aaa bbb ccc ddd', limit=8) == ['aaa bbb ', 'ccc ddd']
+    assert split_message('a' * 10, limit=4) == ['aaaa', 'aaaa', 'aa']
+    assert split_message('') == []
+
+
+def test_markdown_stream_must_split_at_word_edge():
+    text = '*' + 'word ' * 100 + '*'
+    messages = split_message(text, 'MarkdownV2', limit=128)
+    assert all(len(message) <= 128 for message in messages)
+    assert all(message.startswith('*word') and message.endswith(' *') for message in messages[:-1])
+    assert ''.join(message[1:-1] for message in messages) == text[1:-1]
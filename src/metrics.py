@@ -0,0 +1,19 @@
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+_metrics = dict()
+
+
+def register(name, value_fn):
+    """Registers callable returning current value of the metric"""
+    _metrics[name] = value_fn
+
+
+def snapshot():
+    return {name: value_fn() for name, value_fn in _metrics.items()}
+
+
+def log_snapshot():
+    _logger.info(f'Metrics: [{snapshot()}]')
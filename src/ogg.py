@@ -0,0 +1,121 @@
+import logging
+import struct
+import os
+
+
+_logger = logging.getLogger(__name__)
+
+
+CAPTURE_PATTERN = b'OggS'
+PAGE_HEADER_LEN = 27
+MAX_PAGE_LEN = PAGE_HEADER_LEN + 255 + 255 * 255
+# granule position of opus is counted in 48 kHz samples whatever the input rate is
+OPUS_GRANULE_RATE = 48000
+# no packet is finished on the page
+NO_GRANULE = -1
+
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+
+def _page(data, pos):
+    """Parses page header at the position into (granule, serial, page length)"""
+
+    if len(data) < pos + PAGE_HEADER_LEN:
+        raise ValueError(f'Ogg page is truncated [{pos=}]')
+
+    capture, version, _, granule, serial, _, _, segments = _PAGE_HEADER.unpack_from(data, pos)
+    if capture != CAPTURE_PATTERN or version != 0:
+        raise ValueError(f'Not an ogg page [{pos=}]')
+
+    header_len = PAGE_HEADER_LEN + segments
+    if len(data) < pos + header_len:
+        raise ValueError(f'Ogg page is truncated [{pos=}]')
+
+    return granule, serial, header_len, sum(data[pos + PAGE_HEADER_LEN:pos + header_len])
+
+
+def _stream_params(payload):
+    """Gets (granule rate, pre-skip) from identification header of opus or vorbis stream"""
+
+    if payload.startswith(b'OpusHead') and len(payload) >= 12:
+        pre_skip, = struct.unpack_from('<H', payload, 10)
+        return OPUS_GRANULE_RATE, pre_skip
+
+    if payload.startswith(b'\x01vorbis') and len(payload) >= 16:
+        rate, = struct.unpack_from('<I', payload, 12)
+        if rate > 0:
+            return rate, 0
+
+    raise ValueError('Unsupported ogg stream')
+
+
+# first page keeps identification header only
+_HEAD_LEN = PAGE_HEADER_LEN + 255 + 64
+
+
+def ogg_duration_secs(file):
+    """Gets duration of ogg opus or vorbis file from granule position of its last page, nothing is decoded.
+    Only the first and the last pages are read. File position is kept"""
+
+    pos = file.tell()
+    try:
+        head = file.read(_HEAD_LEN)
+        size = file.seek(0, os.SEEK_END)
+        file.seek(max(size - MAX_PAGE_LEN, pos))
+        tail = file.read()
+    finally:
+        file.seek(pos)
+
+    return _duration_secs(head, tail)
+
+
+class OggDurationReader:
+    """Gets duration of ogg file fed chunk by chunk, e.g. while it's downloaded.
+    Only the head and the tail of the last page size are kept"""
+
+    def __init__(self):
+        self.__head = bytearray()
+        self.__tail = bytearray()
+
+
+    def feed(self, chunk):
+        view = memoryview(chunk)
+        head, tail = self.__head, self.__tail
+        if len(head) < _HEAD_LEN:
+            head += view[:_HEAD_LEN - len(head)]
+
+        if len(view) >= MAX_PAGE_LEN:
+            tail[:] = view[-MAX_PAGE_LEN:]
+            return
+
+        tail += view
+        if len(tail) > MAX_PAGE_LEN:
+            del tail[:len(tail) - MAX_PAGE_LEN]
+
+
+    def duration_secs(self):
+        return _duration_secs(self.__head, self.__tail)
+
+
+def _duration_secs(head, tail):
+    _, serial, header_len, _ = _page(head, 0)
+    rate, pre_skip = _stream_params(bytes(head[header_len:]))
+
+    # pages are chained backwards from the end, so capture pattern found in packet data isn't taken for a page
+    end = len(tail)
+    start = tail.rfind(CAPTURE_PATTERN, 0, end)
+    while start >= 0:
+        try:
+            granule, page_serial, header_len, body_len = _page(tail, start)
+        except ValueError:
+            granule = None
+
+        if granule is not None and start + header_len + body_len == end:
+            if page_serial == serial and granule != NO_GRANULE:
+                return max(granule - pre_skip, 0) / rate
+
+            end = start
+
+        start = tail.rfind(CAPTURE_PATTERN, 0, start)
+
+    raise ValueError('No granule position found in ogg file')
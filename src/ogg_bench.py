@@ -0,0 +1,56 @@
+"""Benchmark of voice duration parsing, run as python ogg_bench.py [dir with .oga files].
+Voice samples of e2e tests are taken along with synthetic opus files if no dir is given,
+pydub is measured only if ffmpeg is found. Files of unsupported streams are reported and skipped"""
+
+from ogg import ogg_duration_secs
+from ogg_synth import make_opus
+
+from pydub import AudioSegment
+from io import BytesIO
+import shutil
+import timeit
+import sys
+import os
+
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'e2e-tests', 'src')
+
+
+def load_corpus(path):
+    corpus = dict()
+    if path is None:
+        corpus.update((f'synthetic-{secs}s.oga', make_opus(secs)) for secs in (1, 10, 60, 300))
+        path = SAMPLES_DIR
+
+    for name in sorted(os.listdir(path)):
+        if name.endswith(('.oga', '.ogg', '.opus')):
+            with open(os.path.join(path, name), 'rb') as f:
+                corpus[name] = f.read()
+
+    return corpus
+
+
+def bench(fn, data, number):
+    return min(timeit.repeat(lambda: fn(BytesIO(data)), number=number, repeat=3)) / number
+
+
+def main():
+    corpus = load_corpus(sys.argv[1] if len(sys.argv) > 1 else None)
+    decode = shutil.which('ffmpeg') is not None
+    for name, data in corpus.items():
+        try:
+            duration = ogg_duration_secs(BytesIO(data))
+        except ValueError as e:
+            print(f'{name:<32}{len(data):>10} bytes skipped [{e}]')
+            continue
+
+        line = f'{name:<32}{len(data):>10} bytes{duration:>10.2f} s{bench(ogg_duration_secs, data, 1000) * 1e6:>10.1f} us'
+        if decode:
+            secs = bench(lambda f: AudioSegment.from_ogg(f).duration_seconds, data, 3)
+            line += f'{secs * 1e6:>12.1f} us pydub'
+
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
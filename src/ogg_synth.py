@@ -0,0 +1,25 @@
+"""Synthetic ogg files for tests and benchmarks"""
+
+from ogg import OPUS_GRANULE_RATE
+
+import struct
+
+
+def make_page(payload, granule, serial=1, seq=0, header_type=0):
+    segments = [255] * (len(payload) // 255) + [len(payload) % 255]
+    header = struct.pack('<4sBBqIIIB', b'OggS', 0, header_type, granule, serial, seq, 0, len(segments))
+    return header + bytes(segments) + payload
+
+
+def make_opus(duration_secs, pre_skip=312, packet=b'\x00' * 200, packets_per_page=50, serial=1):
+    """Ogg opus file of 20 ms packets, packets aren't real audio as nothing is decoded"""
+
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 1, pre_skip, 16000, 0, 0)
+    pages = [make_page(head, 0, serial), make_page(b'OpusTags' + b'\x00' * 8, 0, serial, seq=1)]
+    total = pre_skip + int(duration_secs * OPUS_GRANULE_RATE)
+    granule, samples = pre_skip, OPUS_GRANULE_RATE // 50
+    while granule < total:
+        granule = min(granule + samples * packets_per_page, total)
+        pages.append(make_page(packet * packets_per_page, granule, serial, seq=len(pages)))
+
+    return b''.join(pages)
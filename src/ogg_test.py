@@ -0,0 +1,44 @@
+from ogg import ogg_duration_secs, OggDurationReader, OPUS_GRANULE_RATE, NO_GRANULE
+from ogg_synth import make_page, make_opus
+
+from io import BytesIO
+import pytest
+import struct
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+
+def test_ogg_duration_must_be_read_from_last_granule_position():
+    file = BytesIO(make_opus(7.5))
+    assert ogg_duration_secs(file) == pytest.approx(7.5)
+    assert file.tell() == 0
+
+
+def test_ogg_duration_must_skip_page_with_no_granule_and_capture_pattern_in_data():
+    data = make_opus(3, packet=b'OggS' * 50)
+    data += make_page(b'OggS\x00' * 10, NO_GRANULE, seq=100)
+    assert ogg_duration_secs(BytesIO(data)) == pytest.approx(3)
+
+
+def test_ogg_duration_must_take_vorbis_rate():
+    head = b'\x01vorbis' + struct.pack('<IBI', 0, 1, 44100) + b'\x00' * 14
+    data = make_page(head, 0) + make_page(b'\x00' * 100, 44100 * 2, seq=1)
+    assert ogg_duration_secs(BytesIO(data)) == pytest.approx(2)
+
+
+@pytest.mark.parametrize('data', [b'', b'RIFF' + b'\x00' * 100, make_page(b'\x00' * 19, 0)])
+def test_ogg_duration_must_raise_for_not_opus_data(data):
+    with pytest.raises(ValueError):
+        ogg_duration_secs(BytesIO(data))
+
+
+@pytest.mark.parametrize('chunk_size', [1000, 4096, 100000])
+def test_ogg_duration_reader_must_read_duration_of_chunks(chunk_size):
+    data = make_opus(60)
+    sut = OggDurationReader()
+    for i in range(0, len(data), chunk_size):
+        sut.feed(data[i:i + chunk_size])
+
+    assert sut.duration_secs() == pytest.approx(60)
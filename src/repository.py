@@ -1,9 +1,21 @@
 from money_field import MoneyField
 from money import Money
 
-from mongoengine import Document, StringField, IntField, DateField, \
-    connect, EmbeddedDocumentField, EmbeddedDocument, ListField, FloatField
+from mongoengine import Document, StringField, IntField, DateField, DateTimeField, \
+    connect, EmbeddedDocumentField, EmbeddedDocument, ListField, FloatField, DictField, ObjectIdField
+import metrics
+
+from pymongo import UpdateOne, InsertOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import timedelta, timezone
+from functools import partial, reduce
+from uuid import uuid4
+import threading
+import asyncio
 import logging
+import time
 
 
 _logger = logging.getLogger(__name__)
@@ -12,6 +24,32 @@ _logger = logging.getLogger(__name__)
 class Dialog(EmbeddedDocument):
     role = StringField(choices=('user', 'assistant'))
     content = StringField()
+    # content token numbers by tokenizer name, filled in lazily for older items
+    tokens = DictField(IntField())
+
+
+class DialogMessage(Document):
+    """Dialog item stored in separate collection, 
+    so user document doesn't grow and only tail of dialog is read"""
+
+    user_id = IntField(required=True)
+    dialog_id = StringField(required=True)
+    seq = IntField(required=True)
+    role = StringField(choices=('user', 'assistant'))
+    content = StringField()
+    # content token numbers by tokenizer name, filled in lazily for older items
+    tokens = DictField(IntField())
+
+    meta = {
+        'collection': 'dialogs',
+        'indexes': [
+            {'fields': ['user_id', 'dialog_id', '-seq'], 'unique': True},
+        ]
+    }
+
+
+def new_dialog_id():
+    return uuid4().hex
 
 
 class Stats(EmbeddedDocument):
@@ -28,22 +66,91 @@ class User(Document):
     first_seen = DateField()
     last_seen = DateField()
     chat_mode = StringField(default='english_tutor')
+    # legacy embedded dialog, moved into dialogs collection on migration
     current_dialog = ListField(EmbeddedDocumentField(Dialog))
-    stats = EmbeddedDocumentField(Stats, default=Stats())
+    current_dialog_id = StringField()
+    # sequence number of the last dialog message
+    dialog_seq = IntField(default=0)
+    # incremented on every update to detect stale copies
+    version = IntField(default=0)
+    # fencing token of the last lease holder written the user
+    lease_token = IntField()
+    stats = EmbeddedDocumentField(Stats, default=Stats)
     balance = MoneyField(default=Money.ZERO)
+    # the last usage batches applied to the user, so a batch is applied once
+    usage_batches = ListField(ObjectIdField())
+
+
+class Timer(Document):
+    """Reminder to be sent to the chat at the given time (naive utc)"""
+
+    user_id = IntField(required=True)
+    chat_id = IntField(required=True)
+    text = StringField()
+    fire_at = DateTimeField(required=True)
+    # number of failed firing attempts
+    attempts = IntField(default=0)
+    # timers added by other replicas are polled by creation time
+    created_at = DateTimeField()
+    # timer is fired by the replica claimed it, the claim of stalled replica expires
+    claimed_until = DateTimeField()
+
+    meta = {
+        'collection': 'timers',
+        'indexes': ['fire_at', 'created_at']
+    }
+
+
+class UsageBatch(Document):
+    """Usage increments of users flushed at once. Batch is kept until it's applied to the users"""
+
+    # list of dict(user_id=..., inc={field path: amount})
+    entries = ListField(DictField())
+    created_at = DateTimeField(required=True)
+
+    meta = {
+        'collection': 'usage_batches',
+        'indexes': ['created_at']
+    }
+
+
+# usage batches applied to the user are remembered for a batch to be safely reapplied by reconciliation
+USAGE_BATCHES_KEPT = 32
+
+
+class UserLease(Document):
+    """Lease of the user shared by bot replicas, expired leases are deleted by mongo"""
+
+    id = IntField(primary_key=True)
+    owner = StringField()
+    # fencing token growing on every acquisition
+    token = IntField()
+    expires_at = DateTimeField()
+
+    meta = {
+        'collection': 'leases',
+        'indexes': [
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},
+        ]
+    }
 
 
 class Repository:
-    def __init__(self, mongodb_uri):
+    def __init__(self, mongodb_uri, **connect_options):
         _logger.debug(f'Connecting to mongo [{mongodb_uri=}]')
-        connect(host=mongodb_uri)
+        connect(host=mongodb_uri, **connect_options)
 
 
     def get_user(self, user_id):
-        """Gets user by id if exists and creates new one if doesn't"""
+        """Gets user by id if exists and creates new one if doesn't. 
+        Dialog isn't read, users having legacy embedded dialog are migrated"""
 
         try:
-            return User.objects.get(id=user_id)
+            user = User.objects.exclude('current_dialog').get(id=user_id)
+            if user.current_dialog_id is None:
+                user.current_dialog_id, user.dialog_seq = self.migrate_user(user_id)
+
+            return user
         except User.DoesNotExist as e:
             _logger.info(f'User does not exist [{user_id=}] [{e!r}]')
             return User(id=user_id)
@@ -56,6 +163,213 @@ class Repository:
         user.save()
 
 
+    def update_user(self, user_id, update, version=None, fence=None):
+        """Applies mongo update document to the user creating one if it doesn't exist, the user version is incremented.
+        If version is given the update is applied only if the stored user has the same one. 
+        If fencing token is given the update is rejected if the user is written by a later lease holder.
+        Returns dialog id and seq of the updated user or None if the update isn't applied"""
+
+        query = {'_id': user_id}
+        if version is not None:
+            # users stored before versioning have no version
+            query['version'] = version if version else {'$in': [0, None]}
+
+        update = dict(update)
+        update['$inc'] = dict(update.get('$inc', dict()), version=1)
+        if fence is not None:
+            query['lease_token'] = {'$not': {'$gt': fence}}
+            update['$max'] = dict(update.get('$max', dict()), lease_token=fence)
+
+        try:
+            # dialog seq is incremented by mongo, so the caller numbers new messages by it even if its user is stale
+            return User._get_collection().find_one_and_update(query, update, 
+                                                              projection={'current_dialog_id': True, 'dialog_seq': True}, 
+                                                              upsert=True, 
+                                                              return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # user of another version exists
+            return None
+
+
+    def get_dialog(self, user_id, dialog_id, limit, before_seq=None):
+        """Gets page of the last dialog messages in chronological order. 
+        Previous pages are got by passing seq of the first message"""
+
+        query = dict(user_id=user_id, dialog_id=dialog_id)
+        if before_seq is not None:
+            query['seq__lt'] = before_seq
+
+        messages = list(DialogMessage.objects(**query).order_by('-seq').limit(limit))
+        return list(reversed(messages))
+
+
+    def update_dialog(self, messages, tokens):
+        """Inserts new dialog messages and sets token numbers of the existing ones by message id 
+        in a single round trip"""
+
+        requests = ([InsertOne(message.to_mongo()) for message in messages] +
+                    [UpdateOne({'_id': message_id}, {'$set': {f'tokens.{name}': token_num 
+                                                              for name, token_num in message_tokens.items()}}) 
+                     for message_id, message_tokens in tokens.items()])
+        if requests:
+            DialogMessage._get_collection().bulk_write(requests, ordered=True)
+
+
+    def migrate_user(self, user_id):
+        """Moves legacy embedded dialog of the user into dialogs collection. Returns dialog id and last seq"""
+
+        user = User.objects.only('current_dialog', 'current_dialog_id', 'dialog_seq').get(id=user_id)
+        if user.current_dialog_id is not None:
+            return user.current_dialog_id, user.dialog_seq
+
+        dialog_id = new_dialog_id()
+        messages = [DialogMessage(user_id=user_id, dialog_id=dialog_id, seq=seq, 
+                                  role=item.role, content=item.content, tokens=item.tokens)
+                    for seq, item in enumerate(user.current_dialog, start=1)]
+        if messages:
+            DialogMessage.objects.insert(messages, load_bulk=False)
+
+        updated = User.objects(id=user_id, current_dialog_id=None).update_one(set__current_dialog_id=dialog_id,
+                                                                             set__dialog_seq=len(messages),
+                                                                             unset__current_dialog=True,
+                                                                             inc__version=1)
+        if not updated:
+            # migrated concurrently
+            DialogMessage.objects(user_id=user_id, dialog_id=dialog_id).delete()
+            return self.migrate_user(user_id)
+
+        _logger.info(f'User dialog migrated [{user_id=}; {len(messages)=}]')
+        return dialog_id, len(messages)
+
+
+    def migrate_users(self):
+        """Migrates all the users having legacy embedded dialog. Safe to run along with the bot"""
+
+        user_ids = [user.id for user in User.objects(current_dialog_id=None).only('id')]
+        for user_id in user_ids:
+            self.migrate_user(user_id)
+
+        return len(user_ids)
+
+
+    def watch_users(self, on_change):
+        """Blocks calling on_change(user_id, version) on every user change. 
+        Version is None if it's unknown. Requires mongo replica set"""
+
+        pipeline = [{'$match': {'operationType': {'$in': ['update', 'replace', 'delete']}}}]
+        with User._get_collection().watch(pipeline) as stream:
+            for change in stream:
+                fields = change.get('updateDescription', dict()).get('updatedFields', dict())
+                on_change(change['documentKey']['_id'], fields.get('version'))
+
+
+    def acquire_lease(self, user_id, owner, now, ttl):
+        """Acquires the user lease for ttl seconds unless it's held by another owner. 
+        Returns fencing token or None if the lease is held"""
+
+        leases = UserLease._get_collection()
+        expires_at = now + timedelta(seconds=ttl)
+        # token is never less than the current time in ms, so it keeps growing after expired lease is deleted
+        min_token = int(now.replace(tzinfo=timezone.utc).timestamp() * 1000)
+        # upsert can't be conditional on expired lease, so expired one is taken over and missing one is inserted
+        lease = leases.find_one_and_update({'_id': user_id, 'expires_at': {'$not': {'$gt': now}}},
+                                           [{'$set': {
+                                               'owner': {'$literal': owner},
+                                               'token': {'$max': [{'$add': [{'$ifNull': ['$token', 0]}, 1]}, min_token]},
+                                               'expires_at': expires_at,
+                                           }}],
+                                           projection={'token': True},
+                                           return_document=ReturnDocument.AFTER)
+        if lease is not None:
+            return lease['token']
+
+        try:
+            leases.insert_one(dict(_id=user_id, owner=owner, token=min_token, expires_at=expires_at))
+        except DuplicateKeyError:
+            # lease is held
+            return None
+
+        return min_token
+
+
+    def renew_lease(self, user_id, owner, token, now, ttl):
+        """Prolongs the lease for ttl seconds. Returns False if the lease is lost"""
+
+        result = UserLease._get_collection().update_one({'_id': user_id, 'owner': owner, 'token': token},
+                                                        {'$set': {'expires_at': now + timedelta(seconds=ttl)}})
+        return result.matched_count == 1
+
+
+    def release_lease(self, user_id, owner, token, now):
+        UserLease._get_collection().update_one({'_id': user_id, 'owner': owner, 'token': token},
+                                               {'$set': {'expires_at': now}})
+
+
+    def add_timer(self, timer):
+        timer.save()
+        return timer
+
+
+    def get_due_timers(self, until, now, limit):
+        """Gets timers firing not later than the given time unclaimed by now, the earliest first"""
+        return list(Timer.objects(fire_at__lte=until, claimed_until__not__gt=now).order_by('fire_at').limit(limit))
+
+
+    def get_claims_expiry(self, until, now):
+        """Gets time the earliest claim of timers firing not later than the given time expires at 
+        or None if none is claimed by now"""
+
+        timer = Timer.objects(fire_at__lte=until, claimed_until__gt=now).order_by('claimed_until').only('claimed_until').first()
+        return None if timer is None else timer.claimed_until
+
+
+    def get_new_timers(self, since, until, now, limit):
+        """Gets timers added not earlier than since firing earlier than until unclaimed by now, the earliest first"""
+        return list(Timer.objects(created_at__gte=since, fire_at__lt=until, claimed_until__not__gt=now)
+                    .order_by('fire_at').limit(limit))
+
+
+    def claim_timer(self, timer_id, attempts, now, until):
+        """Claims timer to be fired by the caller till the given time. Returns False if it's claimed by another replica, 
+        rescheduled since it's read or deleted"""
+
+        return Timer.objects(id=timer_id, attempts=attempts, claimed_until__not__gt=now).update_one(
+            set__claimed_until=until) == 1
+
+
+    def delete_timer(self, timer_id):
+        Timer.objects(id=timer_id).delete()
+
+
+    def reschedule_timer(self, timer_id, fire_at):
+        """Postpones timer failed to fire and releases its claim"""
+        Timer.objects(id=timer_id).update_one(set__fire_at=fire_at, inc__attempts=1, unset__claimed_until=True)
+
+
+    def add_usage_batch(self, batch):
+        batch.save()
+        return batch
+
+
+    def apply_usage_batch(self, batch):
+        """Increments users by the batch in a single round trip and deletes the batch. 
+        Users the batch is applied to already are skipped, so it's safe to apply it again"""
+
+        requests = [UpdateOne({'_id': entry['user_id'], 'usage_batches': {'$ne': batch.id}},
+                              {'$inc': dict(entry['inc'], version=1),
+                               '$push': {'usage_batches': {'$each': [batch.id], '$slice': -USAGE_BATCHES_KEPT}}})
+                    for entry in batch.entries]
+        if requests:
+            User._get_collection().bulk_write(requests, ordered=False)
+
+        UsageBatch.objects(id=batch.id).delete()
+
+
+    def get_usage_batches(self, before, limit):
+        """Gets batches created earlier than the given time, the oldest first"""
+        return list(UsageBatch.objects(created_at__lt=before).order_by('created_at').limit(limit))
+
+
     # def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
     #     if self.__users.count_documents({"_id": user_id}) > 0:
     #         return True
@@ -97,30 +411,6 @@ class Repository:
     #     if not self.check_if_user_exists(user_id):
     #         self.__users.insert_one(user_dict)
 
-    # def start_new_dialog(self, user_id: int):
-    #     self.check_if_user_exists(user_id, raise_exception=True)
-
-    #     dialog_id = str(uuid.uuid4())
-    #     dialog_dict = {
-    #         "_id": dialog_id,
-    #         "user_id": user_id,
-    #         "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
-    #         "start_time": datetime.now(),
-    #         "model": self.get_user_attribute(user_id, "current_model"),
-    #         "messages": []
-    #     }
-
-    #     # add new dialog
-    #     self.__dialogs.insert_one(dialog_dict)
-
-    #     # update user's current dialog
-    #     self.__users.update_one(
-    #         {"_id": user_id},
-    #         {"$set": {"current_dialog_id": dialog_id}}
-    #     )
-
-    #     return dialog_id
-
     # def get_user_attribute(self, user_id: int, key: str):
     #     self.check_if_user_exists(user_id, raise_exception=True)
     #     user_dict = self.__users.find_one({"_id": user_id})
@@ -148,22 +438,465 @@ class Repository:
 
     #     self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
 
-    # def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-    #     self.check_if_user_exists(user_id, raise_exception=True)
 
-    #     if dialog_id is None:
-    #         dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+class UserSession:
+    """Update scoped unit of work. User is read once on enter and all the changes 
+    are written once on exit as atomic partial update, so write cost is in respect to changes. 
+    Changes must be made through the session, they're mirrored to the user document"""
 
-    #     dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
-    #     return dialog_dict["messages"]
+    def __init__(self, repository, user_id, dialog_max_items, fence=None):
+        self.__repo = repository
+        self.__user_id = user_id
+        self.__dialog_max_items = dialog_max_items
+        self.__fence = fence
+        self.__set = dict()
+        self.__inc = dict()
+        self.__dialog = None
+        self.__loaded_dialog = list()
+        self.__new_messages = list()
+        self.user = None
 
-    # def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-    #     self.check_if_user_exists(user_id, raise_exception=True)
 
-    #     if dialog_id is None:
-    #         dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+    async def __aenter__(self):
+        self.user = user = await self.__repo.get_user(self.__user_id)
+        if user.current_dialog_id is None:
+            self.set(current_dialog_id=new_dialog_id())
+
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        repo = self.__repo
+        if exc_type is not None:
+            # changes may be half made, so none is written. Cached user mirrors them, so it's dropped
+            if self.__set or self.__inc or self.__new_messages:
+                repo.invalidate(self.__user_id)
+
+            return
+
+        update = self.__user_update()
+        messages, tokens = self.__new_messages, self.__dialog_tokens()
+        fence = self.__fence
+        if fence is None and not messages:
+            await asyncio.gather(*([repo.update_user(self.__user_id, update)] if update else []),
+                                 *([repo.update_dialog(messages, tokens)] if tokens else []))
+            return
+
+        # new messages are numbered by the seq the user write allocates, 
+        # dialog is written only if the user write passes the fence
+        written = await repo.update_user(self.__user_id, update, fence=fence)
+        if not written:
+            _logger.warning(f'User is written by a later lease holder, changes are dropped [{self.__user_id=}; {fence=}]')
+            return
+
+        if messages:
+            self.__number_messages(written)
+
+        if messages or tokens:
+            await repo.update_dialog(messages, tokens)
+
+
+    async def get_dialog(self):
+        """Gets the last messages of the current dialog up to the max items number. 
+        The dialog is read once per session and only when it's needed"""
+
+        if self.__dialog is None:
+            user = self.user
+            self.__dialog = await self.__repo.get_dialog(user.id, user.current_dialog_id, self.__dialog_max_items)
+            # token numbers filled in by assistant into loaded messages are written as well
+            self.__loaded_dialog = [(message, set(message.tokens)) for message in self.__dialog]
+
+        return self.__dialog
+
+
+    def new_dialog(self):
+        self.set(current_dialog_id=new_dialog_id())
+        self.__dialog = list()
+
+
+    def set(self, **fields):
+        for name, value in fields.items():
+            setattr(self.user, name, value)
+            field = User._fields[name]
+            self.__set[field.db_field] = field.to_mongo(getattr(self.user, name))
+
+
+    def inc(self, **fields):
+        """Increments fields given as double underscore separated path e.g. stats__llm_total_tokens"""
+
+        for path, amount in fields.items():
+            *parents, name = path.split('__')
+            doc = reduce(getattr, parents, self.user)
+            setattr(doc, name, getattr(doc, name) + amount)
+            key = '.'.join(parents + [name])
+            self.__inc[key] = self.__inc.get(key, 0) + (int(amount) if isinstance(amount, Money) else amount)
+
+
+    def push_dialog(self, *items):
+        user = self.user
+        for item in items:
+            self.inc(dialog_seq=1)
+            message = DialogMessage(user_id=user.id, dialog_id=user.current_dialog_id, seq=user.dialog_seq,
+                                    role=item.role, content=item.content, tokens=item.tokens)
+            self.__new_messages.append(message)
+            if self.__dialog is not None:
+                self.__dialog.append(message)
+
+
+    def __number_messages(self, written):
+        """Numbers new messages by the seq allocated in the database, 
+        the user read may be stale if it's written by another replica"""
+
+        user, messages = self.user, self.__new_messages
+        user.dialog_seq = written['dialog_seq']
+        user.current_dialog_id = written.get('current_dialog_id', user.current_dialog_id)
+        for seq, message in enumerate(messages, start=user.dialog_seq - len(messages) + 1):
+            message.dialog_id, message.seq = user.current_dialog_id, seq
+
+
+    def __user_update(self):
+        update = dict()
+        if self.__set:
+            update['$set'] = self.__set
+
+        if self.__inc:
+            update['$inc'] = self.__inc
+
+        return update
+
+
+    def __dialog_tokens(self):
+        tokens = dict()
+        for message, names in self.__loaded_dialog:
+            new_tokens = {name: token_num for name, token_num in message.tokens.items() if name not in names}
+            if new_tokens:
+                tokens[message.id] = new_tokens
+
+        return tokens
+
+
+class AsyncRepository:
+    """Runs blocking repository calls in a bounded thread pool to keep event loop responsive"""
+
+    def __init__(self, repository, max_workers):
+        self.__repo = repository
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='repository')
+
+
+    async def __run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, partial(fn, *args, **kwargs))
+
+
+    async def get_user(self, user_id):
+        return await self.__run(self.__repo.get_user, user_id)
+
+
+    async def put_user(self, user):
+        await self.__run(self.__repo.put_user, user)
+
+
+    async def update_user(self, user_id, update, version=None, fence=None):
+        return await self.__run(self.__repo.update_user, user_id, update, version, fence)
+
+
+    async def get_dialog(self, user_id, dialog_id, limit, before_seq=None):
+        return await self.__run(self.__repo.get_dialog, user_id, dialog_id, limit, before_seq)
+
+
+    async def update_dialog(self, messages, tokens):
+        await self.__run(self.__repo.update_dialog, messages, tokens)
+
+
+    async def migrate_users(self):
+        return await self.__run(self.__repo.migrate_users)
+
+
+    def invalidate(self, user_id, version=None):
+        """Users aren't cached"""
+
+
+    def watch_users(self, on_change, on_restart, backoff=1, max_backoff=60):
+        """Calls on_change(user_id, version) on every user change in the event loop 
+        from a daemon thread watching changes. Failed watching is restarted with exponential backoff 
+        calling on_restart(), since changes made in between are missed"""
+
+        loop = asyncio.get_running_loop()
+        def watch():
+            delay = backoff
+            while True:
+                changed = False
+                def change(*args):
+                    nonlocal changed
+                    changed = True
+                    loop.call_soon_threadsafe(on_change, *args)
+
+                try:
+                    self.__repo.watch_users(change)
+                except BaseException as e:
+                    if loop.is_closed():
+                        return
+
+                    _logger.error(f'Users watching failed, it is restarted [{delay=}]', exc_info=e)
+
+                if changed:
+                    # watched for a while, so it's not the same failure repeating
+                    delay = backoff
+
+                time.sleep(delay)
+                delay = min(delay * 2, max_backoff)
+                try:
+                    loop.call_soon_threadsafe(on_restart)
+                except RuntimeError:
+                    # event loop is closed
+                    return
+
+        threading.Thread(target=watch, name='users-watcher', daemon=True).start()
+
+
+    async def acquire_lease(self, user_id, owner, now, ttl):
+        return await self.__run(self.__repo.acquire_lease, user_id, owner, now, ttl)
+
+
+    async def renew_lease(self, user_id, owner, token, now, ttl):
+        return await self.__run(self.__repo.renew_lease, user_id, owner, token, now, ttl)
+
+
+    async def release_lease(self, user_id, owner, token, now):
+        await self.__run(self.__repo.release_lease, user_id, owner, token, now)
+
+
+    async def add_timer(self, timer):
+        return await self.__run(self.__repo.add_timer, timer)
+
+
+    async def get_due_timers(self, until, now, limit):
+        return await self.__run(self.__repo.get_due_timers, until, now, limit)
+
+
+    async def get_claims_expiry(self, until, now):
+        return await self.__run(self.__repo.get_claims_expiry, until, now)
+
+
+    async def get_new_timers(self, since, until, now, limit):
+        return await self.__run(self.__repo.get_new_timers, since, until, now, limit)
+
+
+    async def claim_timer(self, timer_id, attempts, now, until):
+        return await self.__run(self.__repo.claim_timer, timer_id, attempts, now, until)
+
+
+    async def delete_timer(self, timer_id):
+        await self.__run(self.__repo.delete_timer, timer_id)
+
+
+    async def reschedule_timer(self, timer_id, fire_at):
+        await self.__run(self.__repo.reschedule_timer, timer_id, fire_at)
+
+
+    async def add_usage_batch(self, batch):
+        return await self.__run(self.__repo.add_usage_batch, batch)
+
+
+    async def apply_usage_batch(self, batch):
+        await self.__run(self.__repo.apply_usage_batch, batch)
+
+
+    async def get_usage_batches(self, before, limit):
+        return await self.__run(self.__repo.get_usage_batches, before, limit)
+
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.__executor.shutdown)
+
+
+class UserCache:
+    """LRU cache of users, entries expire after ttl seconds"""
+
+    def __init__(self, capacity, ttl):
+        if capacity < 0:
+            raise ValueError(f'Capacity must not be negative [{capacity=}]')
+
+        self.__capacity = capacity
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+    def peek(self, user_id):
+        """Gets user without touching LRU order and stats"""
+
+        entry = self.__entries.get(user_id)
+        return None if entry is None else entry[0]
+
+
+    def get(self, user_id):
+        entries = self.__entries
+        entry = entries.get(user_id)
+        if entry is not None and entry[1] <= time.monotonic():
+            del entries[user_id]
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entries.move_to_end(user_id)
+        return entry[0]
+
+
+    def put(self, user):
+        if not self.__capacity:
+            return
+
+        entries = self.__entries
+        entries[user.id] = user, time.monotonic() + self.__ttl
+        entries.move_to_end(user.id)
+        while len(entries) > self.__capacity:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def invalidate(self, user_id):
+        if self.__entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+
+    def clear(self):
+        self.invalidations += len(self.__entries)
+        self.__entries.clear()
+
+
+class CachingRepository:
+    """Write through cache of users in front of async repository. 
+    Cached users are shared among sessions, so changes mirrored by them are cached as well. 
+    Writes are conditional on cached user version, a stale user is dropped from the cache"""
+
+    def __init__(self, repository, cache):
+        self.__repo = repository
+        self.__cache = cache
+        self.stale_writes = 0
+        metrics.register('user_cache_hits', lambda: cache.hits)
+        metrics.register('user_cache_misses', lambda: cache.misses)
+        metrics.register('user_cache_hit_ratio', lambda: cache.hits / max(cache.hits + cache.misses, 1))
+        metrics.register('user_cache_evictions', lambda: cache.evictions)
+        metrics.register('user_cache_expirations', lambda: cache.expirations)
+        metrics.register('user_cache_invalidations', lambda: cache.invalidations)
+        metrics.register('user_cache_entries', lambda: len(cache))
+        metrics.register('user_cache_stale_writes', lambda: self.stale_writes)
+
+
+    async def get_user(self, user_id):
+        cache = self.__cache
+        user = cache.get(user_id)
+        if user is None:
+            user = await self.__repo.get_user(user_id)
+            cache.put(user)
+
+        return user
+
+
+    async def put_user(self, user):
+        self.__cache.invalidate(user.id)
+        await self.__repo.put_user(user)
+
+
+    async def update_user(self, user_id, update, fence=None):
+        cache, repo = self.__cache, self.__repo
+        user = cache.peek(user_id)
+        if user is None:
+            return await repo.update_user(user_id, update, fence=fence)
+
+        # bumped in advance, so the change notification of this update doesn't invalidate the user
+        version = user.version
+        user.version = version + 1
+        try:
+            written = await repo.update_user(user_id, update, version, fence)
+        except BaseException:
+            cache.invalidate(user_id)
+            raise
+
+        if not written:
+            _logger.warning(f'Stale user write [{user_id=}; {version=}]')
+            self.stale_writes += 1
+            cache.invalidate(user_id)
+            # update holds deltas, so it's still valid to apply them to the actual user. 
+            # Dialog seq is got from the actual user as well
+            written = await repo.update_user(user_id, update, fence=fence)
+
+        return written
+
+
+    def invalidate(self, user_id, version=None):
+        """Drops cached user unless it's known to be of the given version"""
+
+        user = self.__cache.peek(user_id)
+        if user is not None and (version is None or user.version != version):
+            self.__cache.invalidate(user_id)
+
+
+    async def watch_changes(self):
+        """Invalidates users changed by other bot replicas"""
+        self.__repo.watch_users(self.invalidate, self.__cache.clear)
+
+
+    async def get_dialog(self, user_id, dialog_id, limit, before_seq=None):
+        return await self.__repo.get_dialog(user_id, dialog_id, limit, before_seq)
+
+
+    async def update_dialog(self, messages, tokens):
+        await self.__repo.update_dialog(messages, tokens)
+
+
+    async def migrate_users(self):
+        return await self.__repo.migrate_users()
+
+
+    async def add_usage_batch(self, batch):
+        return await self.__repo.add_usage_batch(batch)
+
+
+    async def apply_usage_batch(self, batch):
+        cache = self.__cache
+        applied = list()
+        for entry in batch.entries:
+            user = cache.peek(entry['user_id'])
+            if user is None or batch.id in user.usage_batches:
+                continue
+
+            # mirrored in advance as update_user does, so the change notification doesn't invalidate the user
+            for path, amount in entry['inc'].items():
+                *parents, name = path.split('.')
+                doc = reduce(getattr, parents, user)
+                setattr(doc, name, getattr(doc, name) + doc._fields[name].to_python(amount))
+
+            user.version += 1
+            user.usage_batches = (user.usage_batches + [batch.id])[-USAGE_BATCHES_KEPT:]
+            applied.append(user.id)
+
+        try:
+            await self.__repo.apply_usage_batch(batch)
+        except BaseException:
+            # unknown whether increments are written
+            for user_id in applied:
+                cache.invalidate(user_id)
+            raise
+
+
+    async def get_usage_batches(self, before, limit):
+        return await self.__repo.get_usage_batches(before, limit)
+
 
-    #     self.dialog_collection.update_one(
-    #         {"_id": dialog_id, "user_id": user_id},
-    #         {"$set": {"messages": dialog_messages}}
-    #     )
+    async def close(self):
+        await self.__repo.close()
@@ -0,0 +1,491 @@
+from timer_scheduler import utcnow
+from repository import Repository, AsyncRepository, CachingRepository, UserCache, UserSession, User, Dialog, DialogMessage, \
+    Timer, UsageBatch
+import money
+
+from datetime import datetime, timedelta
+
+from mongoengine import disconnect
+import mongomock
+import pytest
+import asyncio
+import logging
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+MONGO_LATENCY = 0.02
+USERS_NUM = 20
+
+
+class BlockingRepository:
+    """Mimics mongo round trip blocking calling thread"""
+
+    def get_user(self, user_id):
+        time.sleep(MONGO_LATENCY)
+        return User(id=user_id)
+
+
+    def put_user(self, user):
+        time.sleep(MONGO_LATENCY)
+
+
+class BlockingAsyncRepository:
+    """Calls repository right on the event loop as it used to be done"""
+
+    def __init__(self, repository):
+        self.__repo = repository
+
+    async def get_user(self, user_id):
+        return self.__repo.get_user(user_id)
+
+    async def put_user(self, user):
+        self.__repo.put_user(user)
+
+
+async def loop_lag(load):
+    """Runs load concurrently with ticker and returns max delay of the ticker wake up"""
+
+    max_lag = 0
+    done = False
+
+    async def ticker():
+        nonlocal max_lag
+        while not done:
+            start = time.monotonic()
+            await asyncio.sleep(0.001)
+            max_lag = max(max_lag, time.monotonic() - start - 0.001)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    await load()
+    done = True
+    await ticker_task
+    return max_lag
+
+
+def run_load(repo):
+    async def handle_update(user_id):
+        user = await repo.get_user(user_id)
+        await repo.put_user(user)
+
+    async def load():
+        await asyncio.gather(*(handle_update(user_id) for user_id in range(USERS_NUM)))
+
+    return asyncio.run(loop_lag(load))
+
+
+def test_async_repository_must_return_results_of_repository():
+    async def test():
+        sut = AsyncRepository(BlockingRepository(), max_workers=2)
+        try:
+            user = await sut.get_user(1)
+            assert user.id == 1
+            await sut.put_user(user)
+        finally:
+            await sut.close()
+
+    asyncio.run(test())
+
+
+def test_async_repository_must_not_block_event_loop():
+    blocking_lag = run_load(BlockingAsyncRepository(BlockingRepository()))
+    sut = AsyncRepository(BlockingRepository(), max_workers=8)
+    lag = run_load(sut)
+    asyncio.run(sut.close())
+    _logger.info(f'Event loop lag: [{blocking_lag=:.3f}; {lag=:.3f}]')
+
+    assert blocking_lag >= MONGO_LATENCY
+    # relative to the blocking baseline, so it holds on a loaded machine
+    assert lag < blocking_lag / 5
+
+
+class FakeRepository:
+    def __init__(self, user, dialog=()):
+        self.user = user
+        self.dialog = list(dialog)
+        self.calls = list()
+
+    async def get_user(self, user_id):
+        self.calls.append('get_user')
+        return self.user
+
+    async def get_dialog(self, user_id, dialog_id, limit, before_seq=None):
+        self.calls.append(('get_dialog', dialog_id, limit))
+        return self.dialog[-limit:]
+
+    async def update_user(self, user_id, update, fence=None):
+        self.calls.append(('update_user', update))
+        # the user is mirrored by the session, so it's the same as the updated one
+        return dict(current_dialog_id=self.user.current_dialog_id, dialog_seq=self.user.dialog_seq)
+
+    async def update_dialog(self, messages, tokens):
+        self.calls.append(('update_dialog', [(m.dialog_id, m.seq, m.content) for m in messages], tokens))
+
+    def invalidate(self, user_id, version=None):
+        self.calls.append('invalidate')
+
+
+def test_user_session_must_read_and_write_user_once():
+    async def test():
+        repo = FakeRepository(User(id=1, current_dialog_id='dialog', dialog_seq=2))
+        async with UserSession(repo, 1, dialog_max_items=4) as session:
+            session.set(chat_mode='assistant')
+            session.inc(stats__llm_total_tokens=10, balance=money.Money(3))
+            session.inc(stats__llm_total_tokens=5)
+
+        user = session.user
+        assert (user.chat_mode, user.stats.llm_total_tokens, user.balance) == ('assistant', 15, money.Money(3))
+        assert repo.calls == [
+            'get_user', 
+            ('update_user', {
+                '$set': {'chat_mode': 'assistant'},
+                '$inc': {'stats.llm_total_tokens': 15, 'balance': 3},
+            })
+        ]
+
+    asyncio.run(test())
+
+
+def test_user_session_must_read_dialog_tail_once_and_write_new_messages():
+    async def test():
+        dialog = [DialogMessage(id=seq, user_id=1, dialog_id='dialog', seq=seq, content=str(seq)) for seq in range(1, 7)]
+        repo = FakeRepository(User(id=1, current_dialog_id='dialog', dialog_seq=6), dialog)
+        async with UserSession(repo, 1, dialog_max_items=4) as session:
+            history = await session.get_dialog()
+            assert [message.seq for message in history] == [3, 4, 5, 6]
+            history[1].tokens['llama3'] = 2
+            session.push_dialog(Dialog(role='user', content='7'), Dialog(role='assistant', content='8'))
+            assert [message.seq for message in await session.get_dialog()] == [3, 4, 5, 6, 7, 8]
+
+        assert repo.calls == [
+            'get_user', 
+            ('get_dialog', 'dialog', 4),
+            ('update_user', {'$inc': {'dialog_seq': 2}}),
+            ('update_dialog', [('dialog', 7, '7'), ('dialog', 8, '8')], {4: {'llama3': 2}}),
+        ]
+
+    asyncio.run(test())
+
+
+def test_user_session_must_start_new_dialog():
+    async def test():
+        repo = FakeRepository(User(id=1, current_dialog_id='dialog', dialog_seq=1), 
+                              [DialogMessage(user_id=1, dialog_id='dialog', seq=1)])
+        async with UserSession(repo, 1, dialog_max_items=4) as session:
+            session.new_dialog()
+            session.push_dialog(Dialog(role='user', content='2'))
+            assert [message.content for message in await session.get_dialog()] == ['2']
+
+        dialog_id = session.user.current_dialog_id
+        assert dialog_id != 'dialog'
+        assert repo.calls == [
+            'get_user', 
+            ('update_user', {'$set': {'current_dialog_id': dialog_id}, '$inc': {'dialog_seq': 1}}),
+            ('update_dialog', [(dialog_id, 2, '2')], {}),
+        ]
+
+    asyncio.run(test())
+
+
+def test_user_session_must_start_dialog_of_new_user():
+    async def test():
+        repo = FakeRepository(User(id=1))
+        async with UserSession(repo, 1, dialog_max_items=4) as session:
+            pass
+
+        assert session.user.current_dialog_id is not None
+        assert repo.calls == ['get_user', ('update_user', {'$set': {'current_dialog_id': session.user.current_dialog_id}})]
+
+    asyncio.run(test())
+
+
+def test_user_session_must_not_write_changes_if_handler_raises():
+    async def test():
+        repo = FakeRepository(User(id=1, current_dialog_id='dialog', dialog_seq=1))
+        with pytest.raises(RuntimeError):
+            async with UserSession(repo, 1, dialog_max_items=4) as session:
+                session.set(chat_mode='assistant')
+                session.push_dialog(Dialog(role='user', content='2'))
+                raise RuntimeError('Completion failed')
+
+        assert repo.calls == ['get_user', 'invalidate']
+
+    asyncio.run(test())
+
+
+def test_user_cache_must_evict_least_recently_used_users():
+    sut = UserCache(capacity=2, ttl=60)
+    for user_id in range(1, 4):
+        sut.put(User(id=user_id))
+        sut.get(1)
+
+    assert [sut.get(user_id) is not None for user_id in range(1, 4)] == [True, False, True]
+    assert (sut.hits, sut.misses, sut.evictions) == (5, 1, 1)
+
+
+def test_user_cache_must_expire_users():
+    sut = UserCache(capacity=2, ttl=0)
+    sut.put(User(id=1))
+    assert sut.get(1) is None
+    assert (sut.expirations, len(sut)) == (1, 0)
+
+
+class VersionedRepository:
+    def __init__(self, user):
+        self.user = user
+        self.calls = list()
+
+    async def get_user(self, user_id):
+        self.calls.append('get_user')
+        return User(id=user_id, version=self.user.version)
+
+    async def update_user(self, user_id, update, version=None, fence=None):
+        self.calls.append(('update_user', version))
+        if version is not None and version != self.user.version:
+            return False
+
+        self.user.version += 1
+        return True
+
+
+def test_caching_repository_must_read_user_once_and_write_through():
+    async def test():
+        repo = VersionedRepository(User(id=1))
+        sut = CachingRepository(repo, UserCache(capacity=2, ttl=60))
+        user = await sut.get_user(1)
+        assert await sut.update_user(1, {'$inc': {'balance': 1}})
+        assert await sut.get_user(1) is user
+        assert user.version == repo.user.version == 1
+        assert repo.calls == ['get_user', ('update_user', 0)]
+
+    asyncio.run(test())
+
+
+def test_caching_repository_must_drop_stale_user():
+    async def test():
+        repo = VersionedRepository(User(id=1))
+        sut = CachingRepository(repo, UserCache(capacity=2, ttl=60))
+        user = await sut.get_user(1)
+        # written by another replica
+        repo.user.version = 5
+        assert await sut.update_user(1, {'$inc': {'balance': 1}})
+        assert sut.stale_writes == 1
+        assert repo.user.version == 6
+        assert (await sut.get_user(1)) is not user
+        assert repo.calls == ['get_user', ('update_user', 0), ('update_user', None), 'get_user']
+
+    asyncio.run(test())
+
+
+def test_caching_repository_must_invalidate_user_of_other_version():
+    async def test():
+        sut = CachingRepository(VersionedRepository(User(id=1)), UserCache(capacity=2, ttl=60))
+        user = await sut.get_user(1)
+        sut.invalidate(1, version=0)
+        assert await sut.get_user(1) is user
+        sut.invalidate(1, version=1)
+        assert await sut.get_user(1) is not user
+
+    asyncio.run(test())
+
+
+class FencedRepository(FakeRepository):
+    def __init__(self, user, last_fence):
+        super().__init__(user)
+        self.last_fence = last_fence
+
+    async def update_user(self, user_id, update, fence=None):
+        self.calls.append(('update_user', update, fence))
+        if fence < self.last_fence:
+            return None
+
+        return dict(current_dialog_id=self.user.current_dialog_id, dialog_seq=self.user.dialog_seq)
+
+
+def test_user_session_must_not_write_dialog_rejected_by_fence():
+    async def test():
+        repo = FencedRepository(User(id=1, current_dialog_id='dialog'), last_fence=5)
+        async with UserSession(repo, 1, dialog_max_items=4, fence=4) as session:
+            session.push_dialog(Dialog(role='user', content='1'))
+
+        assert repo.calls == ['get_user', ('update_user', {'$inc': {'dialog_seq': 1}}, 4)]
+
+        repo.calls.clear()
+        async with UserSession(repo, 1, dialog_max_items=4, fence=5) as session:
+            pass
+
+        # user is written anyway to check the fence
+        assert repo.calls == ['get_user', ('update_user', {}, 5)]
+
+    asyncio.run(test())
+
+
+@pytest.fixture
+def mongo():
+    repo = Repository('mongodb://localhost/valery', mongo_client_class=mongomock.MongoClient, uuidRepresentation='standard')
+    yield repo
+    disconnect()
+
+
+def test_user_session_must_number_messages_by_actual_seq_if_user_is_written_concurrently(mongo):
+    async def test():
+        async_repo = AsyncRepository(mongo, max_workers=2)
+        sut = CachingRepository(async_repo, UserCache(capacity=2, ttl=60))
+        async with UserSession(sut, 1, dialog_max_items=10) as session:
+            session.push_dialog(Dialog(role='user', content='1'))
+
+        # written by another replica, so the cached user is stale
+        async with UserSession(async_repo, 1, dialog_max_items=10) as session:
+            session.push_dialog(Dialog(role='user', content='2'))
+
+        async with UserSession(sut, 1, dialog_max_items=10) as session:
+            session.push_dialog(Dialog(role='user', content='3'), Dialog(role='assistant', content='4'))
+
+        assert sut.stale_writes == 1
+        assert session.user.dialog_seq == 4
+        dialog = await async_repo.get_dialog(1, session.user.current_dialog_id, limit=10)
+        assert [(message.seq, message.content) for message in dialog] == [(1, '1'), (2, '2'), (3, '3'), (4, '4')]
+        await sut.close()
+
+    asyncio.run(test())
+
+
+def test_repository_must_let_timer_be_claimed_once(mongo):
+    now = datetime(2024, 1, 1)
+    timer = mongo.add_timer(Timer(user_id=1, chat_id=1, text='call', fire_at=now, created_at=now))
+    assert [timer.text for timer in mongo.get_new_timers(now, now + timedelta(seconds=1), now, limit=10)] == ['call']
+    assert mongo.get_new_timers(now + timedelta(seconds=1), now + timedelta(seconds=1), now, limit=10) == []
+
+    assert mongo.claim_timer(timer.id, 0, now, now + timedelta(seconds=60))
+    assert not mongo.claim_timer(timer.id, 0, now + timedelta(seconds=1), now + timedelta(seconds=61))
+    assert mongo.get_due_timers(now, now + timedelta(seconds=1), limit=10) == []
+    assert mongo.get_new_timers(now, now + timedelta(seconds=1), now + timedelta(seconds=1), limit=10) == []
+    assert mongo.get_claims_expiry(now, now + timedelta(seconds=1)) == now + timedelta(seconds=60)
+    assert [timer.text for timer in mongo.get_due_timers(now, now + timedelta(seconds=60), limit=10)] == ['call']
+    # claim of stalled replica expires
+    assert mongo.claim_timer(timer.id, 0, now + timedelta(seconds=60), now + timedelta(seconds=120))
+
+    mongo.reschedule_timer(timer.id, now + timedelta(seconds=10))
+    # rescheduled since it's read
+    assert not mongo.claim_timer(timer.id, 0, now, now + timedelta(seconds=60))
+    assert mongo.claim_timer(timer.id, 1, now, now + timedelta(seconds=60))
+
+
+def test_repository_must_grant_lease_to_one_owner_till_it_expires(mongo):
+    # leases expired by the actual time are deleted by ttl index
+    now = utcnow()
+    first = mongo.acquire_lease(1, 'first', now, ttl=30)
+    assert first is not None
+    assert mongo.acquire_lease(1, 'second', now + timedelta(seconds=10), ttl=30) is None
+    assert mongo.acquire_lease(2, 'second', now, ttl=30) is not None
+    assert mongo.renew_lease(1, 'first', first, now + timedelta(seconds=10), ttl=30)
+
+    # taken over once expired
+    second = mongo.acquire_lease(1, 'second', now + timedelta(seconds=40), ttl=30)
+    assert second > first
+    assert not mongo.renew_lease(1, 'first', first, now + timedelta(seconds=40), ttl=30)
+
+    mongo.release_lease(1, 'second', second, now + timedelta(seconds=41))
+    third = mongo.acquire_lease(1, 'first', now + timedelta(seconds=41), ttl=30)
+    assert third > second
+
+
+def test_repository_must_reject_update_of_stale_version_or_earlier_fence(mongo):
+    assert mongo.update_user(1, {'$set': {'current_dialog_id': 'dialog'}}, version=0, fence=5)
+    assert mongo.update_user(1, {'$inc': {'dialog_seq': 2}}, version=1, fence=5) == \
+        dict(_id=1, current_dialog_id='dialog', dialog_seq=2)
+    assert mongo.update_user(1, {'$inc': {'dialog_seq': 1}}, version=1) is None
+    assert mongo.update_user(1, {'$inc': {'dialog_seq': 1}}, fence=4) is None
+    assert mongo.update_user(1, {'$inc': {'dialog_seq': 1}}, fence=6)
+
+    user = mongo.get_user(1)
+    assert (user.dialog_seq, user.version, user.lease_token) == (3, 3, 6)
+
+
+def test_repository_must_apply_usage_batch_once(mongo):
+    for user_id in (1, 2):
+        mongo.update_user(user_id, {'$set': {'current_dialog_id': 'dialog'}})
+
+    entries = [dict(user_id=1, inc={'balance': -3, 'stats.llm_total_tokens': 3}), 
+               dict(user_id=2, inc={'balance': -5})]
+    batch = mongo.add_usage_batch(UsageBatch(entries=entries, created_at=datetime(2024, 1, 1)))
+    assert mongo.get_usage_batches(datetime(2024, 1, 2), limit=10) == [batch]
+
+    mongo.apply_usage_batch(batch)
+    # reapplied by reconciliation
+    mongo.apply_usage_batch(batch)
+
+    first, second = mongo.get_user(1), mongo.get_user(2)
+    assert (first.balance, first.stats.llm_total_tokens, first.usage_batches) == (money.Money(-3), 3, [batch.id])
+    assert second.balance == money.Money(-5)
+    assert mongo.get_usage_batches(datetime(2024, 1, 2), limit=10) == []
+
+
+def test_caching_repository_must_apply_usage_batch_to_cached_users(mongo):
+    async def test():
+        for user_id in (1, 2):
+            mongo.update_user(user_id, {'$set': {'current_dialog_id': 'dialog'}})
+
+        sut = CachingRepository(AsyncRepository(mongo, max_workers=1), UserCache(capacity=2, ttl=60))
+        user = await sut.get_user(1)
+        entries = [dict(user_id=1, inc={'balance': -3, 'stats.llm_total_tokens': 3}), 
+                   dict(user_id=2, inc={'balance': -5})]
+        batch = await sut.add_usage_batch(UsageBatch(entries=entries, created_at=datetime(2024, 1, 1)))
+        await sut.apply_usage_batch(batch)
+        # reapplied by reconciliation
+        await sut.apply_usage_batch(batch)
+
+        actual = mongo.get_user(1)
+        # change notification of the batch leaves the user cached
+        sut.invalidate(1, actual.version)
+        assert await sut.get_user(1) is user
+        assert (user.balance, user.stats.llm_total_tokens, user.usage_batches, user.version) == \
+            (actual.balance, actual.stats.llm_total_tokens, actual.usage_batches, actual.version) == \
+            (money.Money(-3), 3, [batch.id], 2)
+        assert (await sut.get_user(2)).balance == money.Money(-5)
+
+    asyncio.run(test())
+
+
+def test_repository_must_migrate_embedded_dialog(mongo):
+    User(id=1, current_dialog=[Dialog(role='user', content='1'), Dialog(role='assistant', content='2')]).save()
+    User(id=2, current_dialog=[Dialog(role='user', content='3')]).save()
+    user = mongo.get_user(1)
+    assert user.dialog_seq == 2
+    assert [(message.seq, message.content) for message in mongo.get_dialog(1, user.current_dialog_id, limit=10)] == \
+        [(1, '1'), (2, '2')]
+
+    assert mongo.migrate_users() == 1
+    user = mongo.get_user(2)
+    assert [message.content for message in mongo.get_dialog(2, user.current_dialog_id, limit=10)] == ['3']
+    assert User._get_collection().count_documents({'current_dialog': {'$exists': True}}) == 0
+
+
+class FlakyWatchRepository:
+    def __init__(self):
+        self.watches = 0
+
+    def watch_users(self, on_change):
+        self.watches += 1
+        if self.watches < 3:
+            raise ConnectionError('Change stream is closed')
+
+        on_change(1, 2)
+        raise ConnectionError('Change stream is closed')
+
+
+def test_async_repository_must_restart_failed_users_watching():
+    async def test():
+        repo = FlakyWatchRepository()
+        sut = AsyncRepository(repo, max_workers=1)
+        changes, restarts = list(), list()
+        sut.watch_users(lambda *args: changes.append(args), lambda: restarts.append(True), backoff=0.01, max_backoff=0.02)
+        while not changes or len(restarts) < 3:
+            await asyncio.sleep(0.01)
+
+        assert changes[0] == (1, 2)
+        await sut.close()
+
+    asyncio.run(asyncio.wait_for(test(), timeout=5))
@@ -0,0 +1,207 @@
+from webhook import WebhookServer
+
+import telegram
+from telegram import Update
+
+from bisect import bisect
+import multiprocessing
+import asyncio
+import hashlib
+import logging
+import signal
+import threading
+import json
+import queue
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring of shards. Every shard is placed at many points of the ring,
+    so keys are spread evenly and only keys of the removed shard are moved"""
+
+    def __init__(self, shards, points=100):
+        ring = sorted((_hash(f'{shard}:{point}'), shard) for shard in shards for point in range(points))
+        if not ring:
+            raise ValueError('At least one shard must be given')
+
+        self.__hashes = [hash_ for hash_, _ in ring]
+        self.__shards = [shard for _, shard in ring]
+
+
+    def shard(self, key):
+        return self.__shards[bisect(self.__hashes, _hash(key)) % len(self.__shards)]
+
+
+def shard_key(update):
+    """Updates of the same user get the same key"""
+
+    if update.effective_user is not None:
+        return update.effective_user.id
+
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+
+    return update.update_id
+
+
+class ShardIngress:
+    """Feeds application of worker process with updates routed to its shard.
+    Updates are put into application update queue as the polling updater does"""
+
+    def __init__(self, app, updates, stopping):
+        self.__app = app
+        self.__updates = updates
+        self.__stopping = stopping
+
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self.__read, args=(loop,), name='shard-ingress', daemon=True).start()
+
+
+    async def stop(self, drain_timeout):
+        # application stop drains the update queue
+        pass
+
+
+    def __read(self, loop):
+        app = self.__app
+        while (payload := self.__updates.get()) is not None:
+            update = Update.de_json(json.loads(payload), app.bot)
+            asyncio.run_coroutine_threadsafe(app.update_queue.put(update), loop).result()
+
+        loop.call_soon_threadsafe(self.__stopping.set)
+
+
+class ShardDispatcher:
+    """Receives updates and routes them to worker processes by consistent hash of user id,
+    so updates of a user are processed in order by the same worker and the bot uses all the cores.
+    Worker is started as worker_main(*worker_args, shard, updates) and restarted if it dies"""
+
+    def __init__(self, config, workers, worker_main, worker_args, max_queue):
+        if workers < 1:
+            raise ValueError(f'Workers number must be positive [{workers=}]')
+
+        self.__config = config
+        self.__context = multiprocessing.get_context('spawn')
+        self.__worker_main = worker_main
+        self.__worker_args = tuple(worker_args)
+        self.__queues = [self.__context.Queue(maxsize=max_queue) for _ in range(workers)]
+        self.__processes = [None] * workers
+        self.__ring = HashRing(range(workers))
+        self.__bot = None
+
+
+    @property
+    def bot(self):
+        return self.__bot
+
+
+    def run(self):
+        for shard in range(len(self.__queues)):
+            self.__start_worker(shard)
+
+        try:
+            asyncio.run(self.__serve())
+        finally:
+            self.__stop_workers()
+
+
+    def __start_worker(self, shard):
+        process = self.__context.Process(target=self.__worker_main,
+                                         args=self.__worker_args + (shard, self.__queues[shard]),
+                                         name=f'valery-shard-{shard}')
+        process.start()
+        self.__processes[shard] = process
+        _logger.info(f'Worker started [{shard=}; {process.pid=}]')
+
+
+    def __stop_workers(self):
+        for updates in self.__queues:
+            updates.put(None)
+
+        for shard, process in enumerate(self.__processes):
+            process.join(timeout=self.__config['webhook']['drain_timeout'] + 5)
+            if process.is_alive():
+                _logger.warning(f'Worker is killed [{shard=}; {process.pid=}]')
+                process.kill()
+
+
+    async def process_update(self, update):
+        shard = self.__ring.shard(shard_key(update))
+        process = self.__processes[shard]
+        if not process.is_alive():
+            _logger.error(f'Worker died [{shard=}; {process.exitcode=}]')
+            self.__start_worker(shard)
+
+        updates, payload = self.__queues[shard], update.to_json()
+        try:
+            updates.put_nowait(payload)
+        except queue.Full:
+            # waits for the worker, so the order of updates is kept
+            await asyncio.get_running_loop().run_in_executor(None, updates.put, payload)
+
+
+    async def __serve(self):
+        config = self.__config
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in signal.SIGINT, signal.SIGTERM:
+            loop.add_signal_handler(signum, stopping.set)
+
+        self.__bot = bot = telegram.Bot(config['telegram_token'])
+        async with bot:
+            webhook = config['webhook']
+            if not webhook['enabled']:
+                await bot.delete_webhook()
+                await self.__poll(stopping)
+                return
+
+            # the only worker routes updates, so they're routed in the order they're received
+            server = WebhookServer(self,
+                                   url=webhook['url'],
+                                   listen=webhook['listen'],
+                                   port=webhook['port'],
+                                   path=webhook['path'],
+                                   secret_token=webhook['secret_token'],
+                                   max_queue=webhook['max_queue'],
+                                   workers=1)
+            await server.start()
+            try:
+                await stopping.wait()
+            finally:
+                await server.stop(webhook['drain_timeout'])
+
+
+    async def __poll(self, stopping):
+        bot = self.__bot
+        offset = None
+        stop = asyncio.create_task(stopping.wait())
+        while not stopping.is_set():
+            get_updates = asyncio.create_task(bot.get_updates(offset=offset, timeout=10, allowed_updates=Update.ALL_TYPES))
+            await asyncio.wait([get_updates, stop], return_when=asyncio.FIRST_COMPLETED)
+            if not get_updates.done():
+                get_updates.cancel()
+                break
+
+            try:
+                updates = get_updates.result()
+            except telegram.error.TelegramError as e:
+                _logger.warning(f'Getting updates failed [{e!r}]')
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                await self.process_update(update)
+                offset = update.update_id + 1
+
+        stop.cancel()
+        if offset is not None:
+            # confirms routed updates, so they're not received again
+            await bot.get_updates(offset=offset, timeout=0)
@@ -0,0 +1,47 @@
+from sharding import HashRing, ShardIngress
+
+from collections import Counter
+import pytest
+import asyncio
+import logging
+import queue
+import json
+
+
+_logger = logging.getLogger(__name__)
+
+
+def test_hash_ring_must_spread_keys_evenly():
+    sut = HashRing(range(4))
+    shards = Counter(sut.shard(user_id) for user_id in range(10000))
+    assert sorted(shards) == [0, 1, 2, 3]
+    assert min(shards.values()) > 1500
+
+
+def test_hash_ring_must_move_only_keys_of_removed_shard():
+    before, after = HashRing(range(4)), HashRing([0, 1, 3])
+    moved = [user_id for user_id in range(10000) if before.shard(user_id) != after.shard(user_id)]
+    assert moved
+    assert all(before.shard(user_id) == 2 for user_id in moved)
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+
+
+def test_shard_ingress_must_feed_updates_in_order_till_none():
+    async def test():
+        app, updates, stopping = FakeApplication(), queue.Queue(), asyncio.Event()
+        for update_id in range(1, 4):
+            updates.put(json.dumps(dict(update_id=update_id)))
+
+        updates.put(None)
+        sut = ShardIngress(app, updates, stopping)
+        await sut.start()
+        await asyncio.wait_for(stopping.wait(), timeout=5)
+        fed = [app.update_queue.get_nowait().update_id for _ in range(app.update_queue.qsize())]
+        assert fed == [1, 2, 3]
+
+    asyncio.run(test())
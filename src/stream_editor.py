@@ -0,0 +1,191 @@
+import metrics
+
+import telegram
+from telegram.ext import AIORateLimiter
+
+from collections import OrderedDict
+import asyncio
+import logging
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+class _NotRetried(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+class EditRateLimiter(AIORateLimiter):
+    """Rate limiter taking rate_limit_args as dict(max_retries=...), so retries on flood control can be turned off 
+    by 0. AIORateLimiter takes 0 for the default number of retries and bot drops falsy rate_limit_args"""
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = None if rate_limit_args is None else rate_limit_args['max_retries']
+        if max_retries != 0:
+            return await super().process_request(callback, args, kwargs, endpoint, data, max_retries)
+
+        async def no_retry(*args, **kwargs):
+            try:
+                return await callback(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                # hidden from the base limiter, so it isn't retried
+                raise _NotRetried(e) from e
+
+        try:
+            return await super().process_request(no_retry, args, kwargs, endpoint, data, None)
+        except _NotRetried as e:
+            raise e.error from None
+
+
+class EditPacer:
+    """Keeps interval between edits per chat. It's increased on telegram flood control
+    and slowly decreased back on successful edits"""
+
+    def __init__(self, min_interval, max_interval, max_chats=10000):
+        self.__min_interval = min_interval
+        self.__max_interval = max_interval
+        self.__max_chats = max_chats
+        self.__intervals = OrderedDict()
+        self.retries = 0
+        metrics.register('stream_edit_retries', lambda: self.retries)
+
+
+    def interval(self, chat_id):
+        return self.__intervals.get(chat_id, self.__min_interval)
+
+
+    def on_success(self, chat_id):
+        interval = self.__intervals.pop(chat_id, None)
+        if interval is not None and interval * 0.8 > self.__min_interval:
+            self.__set(chat_id, interval * 0.8)
+
+
+    def on_retry_after(self, chat_id, retry_after):
+        self.retries += 1
+        interval = max(self.interval(chat_id) * 2, retry_after)
+        self.__set(chat_id, min(interval, self.__max_interval))
+
+
+    def __set(self, chat_id, interval):
+        intervals = self.__intervals
+        intervals[chat_id] = interval
+        intervals.move_to_end(chat_id)
+        while len(intervals) > self.__max_chats:
+            intervals.popitem(last=False)
+
+
+class StreamEditor:
+    """Edits message with streamed reply coalescing deltas. Edit is sent once the chat interval is elapsed
+    since the previous one and either min_chars are added or the oldest unsent delta waits for max_delay.
+    Flood controlled edits are dropped, the next one carries the whole text anyway.
+    The final text is edited in exactly once. Edit is edit(text, final) coroutine function"""
+
+    def __init__(self, edit, pacer, chat_id, min_chars, max_delay):
+        self.__edit = edit
+        self.__pacer = pacer
+        self.__chat_id = chat_id
+        self.__min_chars = min_chars
+        self.__max_delay = max_delay
+        self.__text = ''
+        self.__sent = ''
+        # time the oldest unsent delta is pushed at
+        self.__pending_since = None
+        self.__last_edit = 0
+        self.__changed = asyncio.Event()
+        self.__finished = False
+        self.__task = None
+        self.edits = 0
+
+
+    async def __aenter__(self):
+        self.__task = asyncio.create_task(self.__run())
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__task.cancel()
+        await asyncio.wait([self.__task])
+
+
+    def push(self, text):
+        """Sets the whole text got so far"""
+
+        if text == self.__text:
+            return
+
+        self.__text = text
+        if self.__pending_since is None:
+            self.__pending_since = time.monotonic()
+
+        self.__changed.set()
+
+
+    async def finish(self, text):
+        """Stops intermediate edits and edits the final text in"""
+
+        self.__finished = True
+        self.__task.cancel()
+        await asyncio.wait([self.__task])
+        self.__text = text
+        await self.__send(final=True)
+
+
+    def __due_at(self):
+        """Time the pending text is to be edited at or None if it's to wait for more chars"""
+
+        ready_at = self.__last_edit + self.__pacer.interval(self.__chat_id)
+        if len(self.__text) - len(self.__sent) >= self.__min_chars:
+            return ready_at
+
+        return max(ready_at, self.__pending_since + self.__max_delay)
+
+
+    async def __run(self):
+        changed = self.__changed
+        while not self.__finished:
+            if self.__pending_since is None:
+                changed.clear()
+                await changed.wait()
+                continue
+
+            delay = self.__due_at() - time.monotonic()
+            if delay > 0:
+                changed.clear()
+                try:
+                    # more chars may make the edit due earlier
+                    await asyncio.wait_for(changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            await self.__send(final=False)
+
+
+    async def __send(self, final):
+        text = self.__text
+        self.__pending_since = None
+        self.__last_edit = time.monotonic()
+        try:
+            await self.__edit(text, final)
+            self.__sent = text
+            self.edits += 1
+            self.__pacer.on_success(self.__chat_id)
+        except telegram.error.RetryAfter as e:
+            self.__pacer.on_retry_after(self.__chat_id, e.retry_after)
+            if final:
+                raise
+
+            _logger.debug(f'Stream edit is flood controlled [{self.__chat_id=}; {e.retry_after=}]')
+            # resent along with the next delta or on time
+            self.__pending_since = self.__last_edit
+        except telegram.error.TelegramError as e:
+            if final:
+                raise
+
+            # intermediate edits go on, the next one carries the whole text anyway
+            _logger.warning(f'Stream edit failed [{self.__chat_id=}] [{e!r}]')
+            self.__pending_since = self.__last_edit
@@ -0,0 +1,105 @@
+from stream_editor import StreamEditor, EditPacer
+
+import telegram
+import pytest
+import asyncio
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+CHAT_ID = 1
+
+
+class FakeChat:
+    def __init__(self, flood_edits=0, retry_after=0.05, failed_edits=0):
+        self.edits = list()
+        self.flood_edits = flood_edits
+        self.retry_after = retry_after
+        self.failed_edits = failed_edits
+
+    async def edit(self, text, final):
+        if not final and self.flood_edits:
+            self.flood_edits -= 1
+            raise telegram.error.RetryAfter(self.retry_after)
+
+        if not final and self.failed_edits:
+            self.failed_edits -= 1
+            raise telegram.error.TimedOut()
+
+        self.edits.append((text, final))
+
+
+async def stream(editor, deltas, delay):
+    text = ''
+    for delta in deltas:
+        text += delta
+        editor.push(text)
+        await asyncio.sleep(delay)
+
+    await editor.finish(text)
+    return text
+
+
+def test_stream_editor_must_coalesce_deltas_and_flush_final_text_once():
+    async def test():
+        chat, pacer = FakeChat(), EditPacer(min_interval=0.05, max_interval=1)
+        async with StreamEditor(chat.edit, pacer, CHAT_ID, min_chars=10, max_delay=1) as sut:
+            text = await stream(sut, ['word '] * 40, delay=0.005)
+
+        assert 1 < len(chat.edits) < 20
+        assert chat.edits[-1] == (text, True)
+        assert [final for _, final in chat.edits].count(True) == 1
+
+    asyncio.run(test())
+
+
+def test_stream_editor_must_edit_few_chars_after_max_delay():
+    async def test():
+        chat, pacer = FakeChat(), EditPacer(min_interval=0.01, max_interval=1)
+        async with StreamEditor(chat.edit, pacer, CHAT_ID, min_chars=100, max_delay=0.05) as sut:
+            sut.push('few')
+            await asyncio.sleep(0.1)
+            assert chat.edits == [('few', False)]
+            await sut.finish('few chars')
+
+        assert chat.edits == [('few', False), ('few chars', True)]
+
+    asyncio.run(test())
+
+
+def test_stream_editor_must_back_off_on_flood_control():
+    async def test():
+        chat, pacer = FakeChat(flood_edits=1, retry_after=0.2), EditPacer(min_interval=0.01, max_interval=1)
+        async with StreamEditor(chat.edit, pacer, CHAT_ID, min_chars=1, max_delay=1) as sut:
+            sut.push('a')
+            await asyncio.sleep(0.1)
+            sut.push('ab')
+            await asyncio.sleep(0.05)
+            # nothing is edited within retry after
+            assert chat.edits == []
+            assert pacer.interval(CHAT_ID) == 0.2
+            await asyncio.sleep(0.2)
+            assert chat.edits == [('ab', False)]
+            await sut.finish('abc')
+
+        assert pacer.retries == 1
+        assert pacer.interval(CHAT_ID) < 0.2
+
+    asyncio.run(test())
+
+
+def test_stream_editor_must_go_on_editing_after_failed_edit():
+    async def test():
+        chat, pacer = FakeChat(failed_edits=1), EditPacer(min_interval=0.01, max_interval=1)
+        async with StreamEditor(chat.edit, pacer, CHAT_ID, min_chars=1, max_delay=1) as sut:
+            sut.push('a')
+            await asyncio.sleep(0.05)
+            assert chat.edits == [('a', False)]
+            sut.push('ab')
+            await asyncio.sleep(0.05)
+            await sut.finish('abc')
+
+        assert chat.edits == [('a', False), ('ab', False), ('abc', True)]
+
+    asyncio.run(test())
@@ -0,0 +1,200 @@
+from repository import Timer
+import metrics
+
+from datetime import datetime, timezone, timedelta
+import asyncio
+import logging
+import heapq
+
+
+_logger = logging.getLogger(__name__)
+
+
+def utcnow():
+    # mongo keeps naive utc datetimes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class TimerScheduler:
+    """Fires timers kept in the repository. Only timers due within the window are loaded
+    and ordered by a heap, the rest stay in the repository. Timers added within the window by other replicas
+    are polled. Timer is claimed before it's fired, so replicas don't fire it twice, and deleted once fired,
+    so it's fired at least once, even if the bot is restarted in between"""
+
+    def __init__(self, repository, window, batch_size, retry_delay, max_attempts, poll_interval, claim_ttl):
+        if batch_size < 1:
+            raise ValueError(f'Batch size must be positive [{batch_size=}]')
+
+        if poll_interval <= 0:
+            raise ValueError(f'Poll interval must be positive [{poll_interval=}]')
+
+        self.__repo = repository
+        self.__window = timedelta(seconds=window)
+        self.__batch_size = batch_size
+        self.__retry_delay = timedelta(seconds=retry_delay)
+        self.__max_attempts = max_attempts
+        self.__poll_interval = timedelta(seconds=poll_interval)
+        self.__claim_ttl = timedelta(seconds=claim_ttl)
+        self.__heap = list()
+        self.__ids = set()
+        # timers firing earlier are loaded into the heap
+        self.__loaded_until = datetime.min
+        # timers added since are polled at the given time
+        self.__poll_since = datetime.min
+        self.__poll_at = datetime.min
+        self.__wakeup = None
+        self.__task = None
+        self.fired = 0
+        self.failed = 0
+        self.claimed_elsewhere = 0
+        metrics.register('timers_loaded', lambda: len(self.__heap))
+        metrics.register('timers_fired', lambda: self.fired)
+        metrics.register('timers_failed', lambda: self.failed)
+        metrics.register('timers_claimed_elsewhere', lambda: self.claimed_elsewhere)
+
+
+    def start(self, fire):
+        """Starts firing timers by awaiting fire(timer). Timer is retried later if it raises"""
+
+        self.__wakeup = asyncio.Event()
+        self.__task = asyncio.create_task(self.__run(fire))
+
+
+    async def stop(self):
+        task = self.__task
+        if task is None:
+            return
+
+        task.cancel()
+        await asyncio.wait([task])
+        self.__task = None
+
+
+    async def add(self, user_id, chat_id, text, fire_at):
+        timer = await self.__repo.add_timer(Timer(user_id=user_id, chat_id=chat_id, text=text, fire_at=fire_at, 
+                                                  created_at=utcnow()))
+        self.__push_loaded(timer)
+        return timer
+
+
+    def __push_loaded(self, timer):
+        """Pushes timer unless it's left in the repository to be loaded later. Timers added to scheduler 
+        which doesn't fire them, e.g. of a worker other than the first one, are polled by the firing one"""
+        if self.__task is not None and timer.fire_at < self.__loaded_until:
+            self.__push(timer)
+
+
+    def __push(self, timer):
+        if timer.id in self.__ids:
+            return
+
+        heapq.heappush(self.__heap, (timer.fire_at, str(timer.id), timer))
+        self.__ids.add(timer.id)
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+
+    async def __load(self, now):
+        repo = self.__repo
+        until = now + self.__window
+        timers = await repo.get_due_timers(until, now, self.__batch_size)
+        # the rest of timers firing at the same time as the last one are loaded once these are fired
+        self.__loaded_until = timers[-1].fire_at if len(timers) == self.__batch_size else until
+        # timers claimed by other replicas are loaded again once the claim expires, in case the replica has stalled
+        claims_expiry = await repo.get_claims_expiry(self.__loaded_until, now)
+        if claims_expiry is not None:
+            self.__loaded_until = min(self.__loaded_until, claims_expiry)
+
+        for timer in timers:
+            self.__push(timer)
+
+        self.__polled(now)
+        _logger.debug(f'Timers loaded [{len(timers)=}; {self.__loaded_until=}]')
+
+
+    async def __poll(self, now):
+        """Pushes timers added to the loaded window since the last poll"""
+
+        timers = await self.__repo.get_new_timers(self.__poll_since, self.__loaded_until, now, self.__batch_size)
+        for timer in timers:
+            self.__push(timer)
+
+        self.__polled(now)
+
+
+    def __polled(self, now):
+        # polls overlap, so timers added by replicas having clocks a bit behind or being added just now aren't missed
+        self.__poll_since = now - self.__poll_interval
+        self.__poll_at = now + self.__poll_interval
+
+
+    async def __run(self, fire):
+        heap = self.__heap
+        while True:
+            try:
+                now = utcnow()
+                if heap and heap[0][0] <= now:
+                    _, _, timer = heapq.heappop(heap)
+                    await self.__fire(fire, timer)
+                    continue
+
+                if now >= self.__loaded_until:
+                    await self.__load(now)
+                    continue
+
+                if now >= self.__poll_at:
+                    await self.__poll(now)
+                    continue
+
+                wake_at = min(self.__loaded_until, self.__poll_at)
+                if heap:
+                    wake_at = min(heap[0][0], wake_at)
+
+                self.__wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.__wakeup.wait(), timeout=(wake_at - now).total_seconds())
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                _logger.error('Timer scheduling failed', exc_info=e)
+                # everything is reloaded, so no timer is lost
+                heap.clear()
+                self.__ids.clear()
+                self.__loaded_until = datetime.min
+                await asyncio.sleep(self.__retry_delay.total_seconds())
+
+
+    async def __fire(self, fire, timer):
+        repo = self.__repo
+        now = utcnow()
+        if not await repo.claim_timer(timer.id, timer.attempts, now, now + self.__claim_ttl):
+            # fired by another replica, claim of stalled one expires and the timer is loaded again
+            self.claimed_elsewhere += 1
+            self.__ids.discard(timer.id)
+            return
+
+        try:
+            await fire(timer)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            self.failed += 1
+            if timer.attempts + 1 >= self.__max_attempts:
+                _logger.error(f'Timer dropped [{timer.id=}; {timer.attempts=}]', exc_info=e)
+                await repo.delete_timer(timer.id)
+                self.__ids.discard(timer.id)
+                return
+
+            _logger.warning(f'Timer firing failed [{timer.id=}; {timer.attempts=}]', exc_info=e)
+            timer.attempts += 1
+            timer.fire_at = utcnow() + self.__retry_delay
+            await repo.reschedule_timer(timer.id, timer.fire_at)
+            self.__ids.discard(timer.id)
+            self.__push_loaded(timer)
+            return
+
+        self.fired += 1
+        await repo.delete_timer(timer.id)
+        self.__ids.discard(timer.id)
@@ -0,0 +1,221 @@
+from timer_scheduler import TimerScheduler, utcnow
+
+from datetime import timedelta
+from itertools import count
+import pytest
+import asyncio
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+
+class FakeRepository:
+    def __init__(self):
+        self.timers = dict()
+        self.loads = list()
+        self.__ids = count(1)
+
+    async def add_timer(self, timer):
+        timer.id = next(self.__ids)
+        self.timers[timer.id] = timer
+        return timer
+
+    @staticmethod
+    def __unclaimed(timer, now):
+        return timer.claimed_until is None or timer.claimed_until <= now
+
+    async def get_due_timers(self, until, now, limit):
+        timers = sorted((timer for timer in self.timers.values() if timer.fire_at <= until and self.__unclaimed(timer, now)), 
+                        key=lambda timer: timer.fire_at)
+        self.loads.append(len(timers[:limit]))
+        return timers[:limit]
+
+    async def get_claims_expiry(self, until, now):
+        return min((timer.claimed_until for timer in self.timers.values() 
+                    if timer.fire_at <= until and not self.__unclaimed(timer, now)), default=None)
+
+    async def get_new_timers(self, since, until, now, limit):
+        timers = [timer for timer in self.timers.values() 
+                  if timer.created_at >= since and timer.fire_at < until and self.__unclaimed(timer, now)]
+        return sorted(timers, key=lambda timer: timer.fire_at)[:limit]
+
+    async def claim_timer(self, timer_id, attempts, now, until):
+        timer = self.timers.get(timer_id)
+        if timer is None or timer.attempts != attempts or (timer.claimed_until or now) > now:
+            return False
+
+        timer.claimed_until = until
+        return True
+
+    async def delete_timer(self, timer_id):
+        del self.timers[timer_id]
+
+    async def reschedule_timer(self, timer_id, fire_at):
+        timer = self.timers[timer_id]
+        timer.fire_at, timer.claimed_until = fire_at, None
+
+
+def make_sut(repo, window=60, batch_size=100, max_attempts=3):
+    return TimerScheduler(repo, window=window, batch_size=batch_size, retry_delay=0.01, max_attempts=max_attempts, 
+                          poll_interval=0.02, claim_ttl=60)
+
+
+async def wait_for(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+def test_timer_scheduler_must_fire_timers_in_order_and_delete_them():
+    async def test():
+        repo = FakeRepository()
+        sut = make_sut(repo)
+        fired = list()
+        async def fire(timer):
+            fired.append(timer.text)
+
+        now = utcnow()
+        # stored before start, e.g. by the previous bot instance
+        await sut.add(1, 1, 'second', now + timedelta(seconds=0.1))
+        sut.start(fire)
+        await sut.add(1, 1, 'first', now + timedelta(seconds=0.05))
+        await sut.add(1, 1, 'late', now + timedelta(hours=1))
+        await asyncio.wait_for(wait_for(lambda: len(fired) == 2), timeout=5)
+        await sut.stop()
+        assert fired == ['first', 'second']
+        assert [timer.text for timer in repo.timers.values()] == ['late']
+
+    asyncio.run(test())
+
+
+def test_timer_scheduler_must_load_timers_in_batches():
+    async def test():
+        repo = FakeRepository()
+        sut = make_sut(repo, batch_size=2)
+        now = utcnow()
+        for i in range(5):
+            await sut.add(1, 1, str(i), now)
+
+        fired = list()
+        async def fire(timer):
+            fired.append(timer.text)
+
+        sut.start(fire)
+        await asyncio.wait_for(wait_for(lambda: len(fired) == 5), timeout=5)
+        await sut.stop()
+        assert sorted(fired) == ['0', '1', '2', '3', '4']
+        assert max(repo.loads) == 2
+
+    asyncio.run(test())
+
+
+def test_timer_scheduler_must_retry_failed_timer():
+    async def test():
+        repo = FakeRepository()
+        sut = make_sut(repo, max_attempts=3)
+        attempts = list()
+        async def fire(timer):
+            attempts.append(timer.text)
+            if timer.text == 'broken' or len(attempts) < 2:
+                raise RuntimeError('Network error')
+
+        sut.start(fire)
+        await sut.add(1, 1, 'flaky', utcnow())
+        await asyncio.wait_for(wait_for(lambda: not repo.timers), timeout=5)
+        await sut.add(1, 1, 'broken', utcnow())
+        await asyncio.wait_for(wait_for(lambda: not repo.timers), timeout=5)
+        await sut.stop()
+        assert attempts == ['flaky'] * 2 + ['broken'] * 3
+        assert (sut.fired, sut.failed) == (1, 4)
+
+    asyncio.run(test())
+
+
+def test_timer_scheduler_must_fire_timer_once_among_replicas():
+    async def test():
+        repo = FakeRepository()
+        replicas = [make_sut(repo) for _ in range(3)]
+        fired = list()
+        async def fire(timer):
+            fired.append(timer.text)
+            await asyncio.sleep(0.01)
+
+        for replica in replicas:
+            replica.start(fire)
+
+        now = utcnow()
+        for i in range(5):
+            await replicas[i % 3].add(1, 1, str(i), now + timedelta(seconds=0.2))
+
+        await asyncio.wait_for(wait_for(lambda: not repo.timers), timeout=5)
+        await asyncio.sleep(0.05)
+        for replica in replicas:
+            await replica.stop()
+
+        assert sorted(fired) == ['0', '1', '2', '3', '4']
+        assert sum(replica.claimed_elsewhere for replica in replicas) == 10
+
+    asyncio.run(test())
+
+
+def test_timer_scheduler_must_poll_timers_added_by_other_replica():
+    async def test():
+        repo = FakeRepository()
+        sut = make_sut(repo, window=60)
+        fired = list()
+        async def fire(timer):
+            fired.append(timer.text)
+
+        sut.start(fire)
+        await asyncio.sleep(0.05)
+        await make_sut(repo).add(1, 1, 'added elsewhere', utcnow() + timedelta(seconds=0.05))
+        # fired long before the window is reloaded
+        await asyncio.wait_for(wait_for(lambda: fired), timeout=1)
+        await sut.stop()
+        assert fired == ['added elsewhere']
+        assert repo.loads == [0]
+
+    asyncio.run(test())
+
+
+def test_timer_scheduler_must_leave_timers_added_while_not_firing_to_firing_one():
+    async def test():
+        repo = FakeRepository()
+        firing, sut = make_sut(repo, window=60), make_sut(repo, window=60)
+        fired = list()
+        async def fire(timer):
+            fired.append(timer.text)
+
+        firing.start(fire)
+        await asyncio.sleep(0.05)
+        await sut.add(1, 1, 'remind', utcnow() + timedelta(seconds=0.05))
+        assert sut._TimerScheduler__heap == []
+        await asyncio.wait_for(wait_for(lambda: fired), timeout=1)
+        await firing.stop()
+        assert fired == ['remind']
+
+    asyncio.run(test())
+
+
+def test_timer_scheduler_must_fire_timer_once_claim_of_stalled_replica_expires():
+    async def test():
+        repo = FakeRepository()
+        now = utcnow()
+        for i in range(2):
+            timer = await make_sut(repo).add(1, 1, str(i), now)
+            # claimed by replica stalled before firing
+            timer.claimed_until = now + timedelta(seconds=0.1 * (i + 1))
+
+        sut = make_sut(repo, window=60, batch_size=1)
+        fired = list()
+        async def fire(timer):
+            fired.append(timer.text)
+
+        sut.start(fire)
+        await asyncio.wait_for(wait_for(lambda: len(fired) == 2), timeout=1)
+        await sut.stop()
+        assert fired == ['0', '1']
+        # loaded once the claims expire, not in a loop
+        assert len(repo.loads) < 10
+
+    asyncio.run(test())
@@ -20,13 +20,19 @@ function main(args) {
     });
 
     const isLlama2 = args.includes('--llama2');
+    // In json mode every line is a json encoded string or array of strings, so the process can be kept 
+    // running and serve requests one per line regardless of newlines in the text.
+    // Token numbers for an array are replied in a single line separated by spaces
+    const isJson = args.includes('--json');
+    const tokenizer = isLlama2 ? llamaTokenizer : llama3Tokenizer;
     rl.on('line', (input) => {
-        if (isLlama2) {
-            console.log(llamaTokenizer.encode(input).length);
+        const request = isJson ? JSON.parse(input) : input;
+        if (Array.isArray(request)) {
+            console.log(request.map((text) => tokenizer.encode(text).length).join(' '));
             return;
-        } 
+        }
 
-        console.log(llama3Tokenizer.encode(input).length);
+        console.log(tokenizer.encode(request).length);
     });
 }
 
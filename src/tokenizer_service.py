@@ -0,0 +1,219 @@
+import metrics
+
+import asyncio
+import logging
+import json
+import hashlib
+from collections import deque, OrderedDict
+
+
+_logger = logging.getLogger(__name__)
+
+
+LLAMA2 = 'llama2'
+LLAMA3 = 'llama3'
+TOKENIZERS = LLAMA2, LLAMA3
+
+TOKENIZER_COMMAND = 'node', 'tokenizer/main.mjs'
+
+
+class TokenizerError(RuntimeError):
+    pass
+
+
+class _Worker:
+    """Resident tokenizer process. Requests are pipelined, i.e. written one per line
+    without waiting for previous replies, and replies are matched in FIFO order"""
+
+    def __init__(self, args):
+        self.__args = args
+        self.__process = None
+        self.__reader = None
+        self.__pending = deque()
+        self.__start_lock = asyncio.Lock()
+
+
+    @property
+    def pending(self):
+        return len(self.__pending)
+
+
+    def __is_running(self):
+        return self.__reader is not None and not self.__reader.done()
+
+
+    async def __ensure_started(self):
+        if self.__is_running():
+            return
+
+        async with self.__start_lock:
+            if self.__is_running():
+                return
+
+            _logger.debug(f'Starting tokenizer worker [{self.__args=}]')
+            self.__process = process = await asyncio.create_subprocess_exec(*self.__args,
+                                                                            stdin=asyncio.subprocess.PIPE,
+                                                                            stdout=asyncio.subprocess.PIPE)
+            self.__reader = asyncio.create_task(self.__read_replies(process))
+
+
+    async def __read_replies(self, process):
+        try:
+            while line := await process.stdout.readline():
+                # cancelled requests are popped as well to keep replies in order
+                future = self.__pending.popleft()
+                if not future.done():
+                    future.set_result(line.decode())
+        finally:
+            returncode = await process.wait()
+            _logger.info(f'Tokenizer worker exited [{returncode=}]')
+            self.__fail_pending(TokenizerError(self.__args, returncode))
+
+
+    def __fail_pending(self, exc):
+        pending = self.__pending
+        while pending:
+            future = pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+
+    async def request(self, payload):
+        await self.__ensure_started()
+        process = self.__process
+        future = asyncio.get_running_loop().create_future()
+        self.__pending.append(future)
+        process.stdin.write(payload.encode('utf-8') + b'\n')
+        await process.stdin.drain()
+        return await future
+
+
+    async def close(self):
+        process, reader = self.__process, self.__reader
+        if process is None:
+            return
+
+        if process.returncode is None:
+            process.stdin.close()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                process.kill()
+
+        await asyncio.wait([reader])
+
+
+class TokenCountCache:
+    """LRU cache of token numbers keyed by tokenizer and text digest. 
+    Only digests are kept, so every entry takes the same small amount of memory"""
+
+    def __init__(self, max_entries):
+        if max_entries < 0:
+            raise ValueError(f'Max entries number must not be negative [{max_entries=}]')
+
+        self.__max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        metrics.register('token_cache_hits', lambda: self.hits)
+        metrics.register('token_cache_misses', lambda: self.misses)
+        metrics.register('token_cache_evictions', lambda: self.evictions)
+        metrics.register('token_cache_entries', lambda: len(self))
+
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+    @staticmethod
+    def __key(tokenizer, text):
+        return tokenizer, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+    def get(self, tokenizer, text):
+        entries = self.__entries
+        key = self.__key(tokenizer, text)
+        token_num = entries.get(key)
+        if token_num is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entries.move_to_end(key)
+        return token_num
+
+
+    def put(self, tokenizer, text, token_num):
+        if not self.__max_entries:
+            return
+
+        entries = self.__entries
+        key = self.__key(tokenizer, text)
+        entries[key] = token_num
+        entries.move_to_end(key)
+        while len(entries) > self.__max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+
+class TokenizerService:
+    """Pool of resident tokenizer processes per tokenizer kind"""
+
+    def __init__(self, workers=1, command=TOKENIZER_COMMAND, cache=None):
+        if workers < 1:
+            raise ValueError(f'Workers number must be positive [{workers=}]')
+
+        self.__workers_num = workers
+        self.__command = tuple(command)
+        self.__pools = dict()
+        self.__cache = cache
+
+
+    def __pool(self, tokenizer):
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f'Unknown tokenizer [{tokenizer=}], must be one of [{TOKENIZERS}]')
+
+        pool = self.__pools.get(tokenizer)
+        if pool is None:
+            args = self.__command + ('--json',) + (('--llama2',) if tokenizer == LLAMA2 else ())
+            self.__pools[tokenizer] = pool = [_Worker(args) for _ in range(self.__workers_num)]
+
+        return pool
+
+
+    def __worker(self, tokenizer):
+        return min(self.__pool(tokenizer), key=lambda worker: worker.pending)
+
+
+    async def count(self, text, tokenizer=LLAMA3):
+        token_nums = await self.count_batch([text], tokenizer)
+        return token_nums[0]
+
+
+    async def count_batch(self, texts, tokenizer=LLAMA3):
+        """Counts tokens of all the given texts in a single request. Cached texts are not sent"""
+
+        cache = self.__cache
+        texts = list(texts)
+        token_nums = [None] * len(texts) if cache is None else [cache.get(tokenizer, text) for text in texts]
+        uncached = [i for i, token_num in enumerate(token_nums) if token_num is None]
+        if not uncached:
+            return token_nums
+
+        reply = await self.__worker(tokenizer).request(json.dumps([texts[i] for i in uncached]))
+        replied = list(map(int, reply.split()))
+        if len(replied) != len(uncached):
+            raise TokenizerError(f'Unexpected tokenizer reply [{reply=}] for [{len(uncached)}] texts')
+
+        for i, token_num in zip(uncached, replied):
+            token_nums[i] = token_num
+            if cache is not None:
+                cache.put(tokenizer, texts[i], token_num)
+
+        return token_nums
+
+
+    async def close(self):
+        workers = [worker for pool in self.__pools.values() for worker in pool]
+        await asyncio.gather(*(worker.close() for worker in workers))
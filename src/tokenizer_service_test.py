@@ -0,0 +1,123 @@
+from tokenizer_service import TokenizerService, TokenizerError, TokenCountCache, LLAMA2, LLAMA3
+
+import pytest
+import asyncio
+import sys
+
+
+# Mimics tokenizer/main.mjs json lines protocol counting words, llama2 counts are doubled
+FAKE_TOKENIZER = '''
+import sys, json
+factor = 2 if '--llama2' in sys.argv else 1
+for line in sys.stdin:
+    request = json.loads(line)
+    texts = request if isinstance(request, list) else [request]
+    if 'die' in texts:
+        sys.exit(1)
+    print(' '.join(str(len(text.split()) * factor) for text in texts), flush=True)
+'''
+
+
+@pytest.fixture
+def command():
+    return sys.executable, '-c', FAKE_TOKENIZER
+
+
+def run(coro_fn):
+    return asyncio.run(coro_fn())
+
+
+def test_count_must_return_token_number(command):
+    async def test():
+        sut = TokenizerService(workers=1, command=command)
+        try:
+            assert await sut.count('one two three') == 3
+            assert await sut.count('one\ntwo\nthree four') == 4
+            assert await sut.count('one two three', LLAMA2) == 6
+        finally:
+            await sut.close()
+
+    run(test)
+
+
+def test_pipelined_requests_must_get_their_own_replies(command):
+    async def test():
+        sut = TokenizerService(workers=2, command=command)
+        try:
+            texts = [' '.join(['word'] * i) for i in range(100)]
+            assert await asyncio.gather(*(sut.count(text) for text in texts)) == list(range(100))
+        finally:
+            await sut.close()
+
+    run(test)
+
+
+def test_count_batch_must_return_token_number_per_text(command):
+    async def test():
+        sut = TokenizerService(workers=1, command=command)
+        try:
+            assert await sut.count_batch(['one', 'one two\nthree', '']) == [1, 3, 0]
+            assert await sut.count_batch(['one', 'one two'], LLAMA2) == [2, 4]
+            assert await sut.count_batch([]) == []
+        finally:
+            await sut.close()
+
+    run(test)
+
+
+def test_worker_must_be_restarted_after_exit(command):
+    async def test():
+        sut = TokenizerService(workers=1, command=command)
+        try:
+            with pytest.raises(TokenizerError):
+                await sut.count('die')
+            assert await sut.count('alive again') == 2
+        finally:
+            await sut.close()
+
+    run(test)
+
+
+def test_unknown_tokenizer_must_raise(command):
+    async def test():
+        sut = TokenizerService(command=command)
+        with pytest.raises(ValueError):
+            await sut.count('text', 'gpt2')
+
+    run(test)
+
+
+def test_cache_must_evict_least_recently_used_entries():
+    sut = TokenCountCache(max_entries=2)
+    sut.put(LLAMA3, 'one', 1)
+    sut.put(LLAMA3, 'two', 2)
+    assert sut.get(LLAMA3, 'one') == 1
+    sut.put(LLAMA3, 'three', 3)
+
+    assert sut.get(LLAMA3, 'two') is None
+    assert sut.get(LLAMA3, 'one') == 1
+    assert sut.get(LLAMA3, 'three') == 3
+    assert sut.get(LLAMA2, 'three') is None
+    assert (sut.hits, sut.misses, sut.evictions, len(sut)) == (3, 2, 1, 2)
+
+
+def test_cache_of_zero_size_must_keep_nothing():
+    sut = TokenCountCache(max_entries=0)
+    sut.put(LLAMA3, 'one', 1)
+    assert sut.get(LLAMA3, 'one') is None
+    assert len(sut) == 0
+
+
+def test_count_batch_must_not_request_cached_texts(command):
+    async def test():
+        cache = TokenCountCache(max_entries=10)
+        cache.put(LLAMA3, 'die', 100)
+        sut = TokenizerService(workers=1, command=command, cache=cache)
+        try:
+            assert await sut.count_batch(['die', 'one two']) == [100, 2]
+            assert await sut.count('one two') == 2
+            assert cache.hits == 2
+        finally:
+            await sut.close()
+
+    run(test)
@@ -0,0 +1,339 @@
+from ogg import OggDurationReader
+import metrics
+
+from deepgram import DeepgramClientOptions, PrerecordedOptions
+from deepgram.clients.prerecorded.v1.response import PrerecordedResponse
+from deepgram.clients.helpers import append_query_params
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from io import BytesIO
+import multiprocessing
+import asyncio
+import logging
+import random
+import httpx
+import json
+
+
+_logger = logging.getLogger(__name__)
+
+
+# too many requests and server errors are retried
+RETRY_STATUSES = 429, 500, 502, 503, 504
+
+
+class TranscriptionError(RuntimeError):
+    pass
+
+
+class AudioTooLargeError(ValueError):
+    pass
+
+
+class FairLimiter:
+    """Limits the number of concurrent holders. Waiters are let in round robin by key,
+    so a key having many waiters doesn't hold back the others"""
+
+    def __init__(self, limit):
+        if limit < 1:
+            raise ValueError(f'Limit must be positive [{limit=}]')
+
+        self.__free = limit
+        self.__waiters = OrderedDict()
+
+
+    @property
+    def waiting(self):
+        return sum(len(waiters) for waiters in self.__waiters.values())
+
+
+    @asynccontextmanager
+    async def acquire(self, key):
+        if self.__free > 0 and not self.__waiters:
+            self.__free -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.__waiters.setdefault(key, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # the slot has been handed over already
+                    self.__release()
+                else:
+                    self.__remove(key, future)
+
+                raise
+
+        try:
+            yield
+        finally:
+            self.__release()
+
+
+    def __release(self):
+        waiters = self.__waiters
+        while waiters:
+            key, futures = next(iter(waiters.items()))
+            future = futures.popleft()
+            if futures:
+                waiters.move_to_end(key)
+            else:
+                del waiters[key]
+
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.__free += 1
+
+
+    def __remove(self, key, future):
+        futures = self.__waiters.get(key)
+        if futures is None or future not in futures:
+            return
+
+        futures.remove(future)
+        if not futures:
+            del self.__waiters[key]
+
+
+async def download_audio(client, url, max_size):
+    """Yields chunks of audio downloaded from url, raises AudioTooLargeError once max_size is exceeded"""
+
+    size = 0
+    reader = OggDurationReader()
+    async with client.stream('GET', url) as resp:
+        resp.raise_for_status()
+        # raw chunks are passed on as read from network, they aren't joined or copied
+        async for chunk in resp.aiter_raw():
+            size += len(chunk)
+            if size > max_size:
+                raise AudioTooLargeError(f'Audio is too large [{size=}; {max_size=}]')
+
+            reader.feed(chunk)
+            yield chunk
+
+    try:
+        _logger.debug(f'Audio downloaded [{size=}; {reader.duration_secs()=}]')
+    except ValueError:
+        _logger.debug(f'Audio downloaded [{size=}]')
+
+
+def _is_retryable(e):
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUSES
+
+    return isinstance(e, httpx.TransportError)
+
+
+class DeepgramTranscriber:
+    """Transcribes audio by deepgram. Connections are kept alive across requests, the number of concurrent requests
+    is limited and users are served in turn. Failed requests are retried with exponential backoff"""
+
+    def __init__(self, api_key, model, models, timeout, max_concurrency, max_attempts, backoff, keepalive_expiry,
+                 transport=None):
+        client_options = DeepgramClientOptions(api_key=api_key)
+        query = json.loads(PrerecordedOptions(**models[model]['options']).to_json())
+        self.__url = append_query_params(f'{client_options.url}/v1/listen', query)
+        self.__headers = client_options.headers
+        self.__client = httpx.AsyncClient(limits=httpx.Limits(max_connections=max_concurrency,
+                                                              max_keepalive_connections=max_concurrency,
+                                                              keepalive_expiry=keepalive_expiry),
+                                          timeout=httpx.Timeout(timeout, connect=5.0),
+                                          transport=transport)
+        # audio is downloaded while uploaded, so downloads don't wait for connections held by uploads
+        self.__download_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=max_concurrency,
+                                                                       max_keepalive_connections=max_concurrency,
+                                                                       keepalive_expiry=keepalive_expiry),
+                                                   timeout=httpx.Timeout(timeout, connect=5.0),
+                                                   transport=transport)
+        self.__limiter = FairLimiter(max_concurrency)
+        self.__max_attempts = max_attempts
+        self.__backoff = backoff
+        self.in_flight = 0
+        self.retries = 0
+        metrics.register('transcriptions_in_flight', lambda: self.in_flight)
+        metrics.register('transcriptions_waiting', lambda: self.__limiter.waiting)
+        metrics.register('transcription_retries', lambda: self.retries)
+
+
+    async def transcribe(self, user_id, audio):
+        """Gets (transcript, duration secs) of the audio bytes"""
+
+        return await self.__transcribe(user_id, lambda: audio)
+
+
+    async def transcribe_url(self, user_id, url, max_size):
+        """Gets (transcript, duration secs) of the audio downloaded from url. Audio is streamed into 
+        transcription request chunk by chunk as it's downloaded, so it's never kept whole. It's downloaded again on retry"""
+
+        return await self.__transcribe(user_id, lambda: self.__download(url, max_size))
+
+
+    async def close(self):
+        await self.__client.aclose()
+        await self.__download_client.aclose()
+
+
+    async def __transcribe(self, user_id, open_audio):
+        async with self.__limiter.acquire(user_id):
+            self.in_flight += 1
+            try:
+                return await self.__transcribe_attempts(open_audio)
+            finally:
+                self.in_flight -= 1
+
+
+    async def __transcribe_attempts(self, open_audio):
+        attempt = 1
+        while True:
+            try:
+                return await self.__request(open_audio())
+            except httpx.HTTPError as e:
+                if not _is_retryable(e) or attempt >= self.__max_attempts:
+                    raise TranscriptionError(f'Transcription failed [{attempt=}; {e!r}]') from e
+
+                delay = self.__backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+                _logger.warning(f'Transcription is retried [{attempt=}; {delay=}; {e!r}]')
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+
+
+    async def __request(self, audio):
+        resp = await self.__client.post(self.__url, headers=self.__headers, content=audio)
+        resp.raise_for_status()
+        result = PrerecordedResponse.from_json(resp.text)
+        _logger.debug(f'Voice transcription: [{result=}]')
+        return result.results.channels[0].alternatives[0].transcript.strip(), result.metadata.duration
+
+
+    def __download(self, url, max_size):
+        return download_audio(self.__download_client, url, max_size)
+
+
+# model of local transcriber worker process
+_model = None
+
+
+def _init_worker(model, compute_type, cpu_threads):
+    global _model
+    try:
+        from faster_whisper import WhisperModel
+    except ImportError as e:
+        raise TranscriptionError('Local transcription requires faster-whisper package to be installed') from e
+
+    _model = WhisperModel(model, device='cpu', compute_type=compute_type, cpu_threads=cpu_threads)
+
+
+def _transcribe_batch(audios, options):
+    """Transcribes audios one by one by the model loaded in the process"""
+
+    results = list()
+    for audio in audios:
+        segments, info = _model.transcribe(BytesIO(audio), **options)
+        results.append((''.join(segment.text for segment in segments).strip(), info.duration))
+
+    return results
+
+
+class LocalTranscriber:
+    """Transcribes audio by whisper model running on cpu in a process pool, so no external service is called.
+    Short audios coming within the batch window are transcribed in a single worker call"""
+
+    def __init__(self, model, compute_type, workers, cpu_threads, options, max_batch, batch_window, batch_max_size,
+                 download_timeout, executor=None):
+        if max_batch < 1:
+            raise ValueError(f'Max batch must be positive [{max_batch=}]')
+
+        self.__executor = executor or ProcessPoolExecutor(max_workers=workers,
+                                                          mp_context=multiprocessing.get_context('spawn'),
+                                                          initializer=_init_worker,
+                                                          initargs=(model, compute_type, cpu_threads))
+        self.__options = dict(options)
+        self.__max_batch = max_batch
+        self.__batch_window = batch_window
+        self.__batch_max_size = batch_max_size
+        self.__download_client = httpx.AsyncClient(timeout=httpx.Timeout(download_timeout, connect=5.0))
+        # the rest of audios wait for their turn, so one user doesn't hold back the others
+        self.__limiter = FairLimiter(workers * max_batch)
+        self.__batch = list()
+        self.__flush_handle = None
+        self.__tasks = set()
+        self.batches = 0
+        metrics.register('transcriptions_waiting', lambda: self.__limiter.waiting)
+        metrics.register('transcription_batches', lambda: self.batches)
+
+
+    async def transcribe(self, user_id, audio):
+        """Gets (transcript, duration secs) of the audio bytes"""
+
+        async with self.__limiter.acquire(user_id):
+            if len(audio) > self.__batch_max_size:
+                result, = await self.__run([bytes(audio)])
+                return result
+
+            future = asyncio.get_running_loop().create_future()
+            self.__batch.append((bytes(audio), future))
+            if len(self.__batch) >= self.__max_batch:
+                self.__flush()
+            elif self.__flush_handle is None:
+                self.__flush_handle = asyncio.get_running_loop().call_later(self.__batch_window, self.__flush)
+
+            return await future
+
+
+    async def transcribe_url(self, user_id, url, max_size):
+        """Gets (transcript, duration secs) of the audio downloaded from url. 
+        Decoder reads the whole file, so it's downloaded before transcription"""
+
+        audio = bytearray()
+        async for chunk in download_audio(self.__download_client, url, max_size):
+            audio += chunk
+
+        return await self.transcribe(user_id, audio)
+
+
+    async def close(self):
+        await self.__download_client.aclose()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def __flush(self):
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+
+        batch, self.__batch = self.__batch, list()
+        task = asyncio.create_task(self.__run_batch(batch))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+
+    async def __run_batch(self, batch):
+        try:
+            results = await self.__run([audio for audio, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+
+            raise
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+    async def __run(self, audios):
+        self.batches += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, _transcribe_batch, audios, self.__options)
@@ -0,0 +1,44 @@
+"""Benchmark of local voice transcription latency, run as python transcription_bench.py DIR [MODEL [CONCURRENCY]].
+DIR keeps .oga files sent concurrently as by that number of users, faster-whisper package is required"""
+
+from transcription import LocalTranscriber
+from ogg_bench import load_corpus
+
+import statistics
+import asyncio
+import time
+import sys
+
+
+async def bench(corpus, model, concurrency):
+    transcriber = LocalTranscriber(model=model, compute_type='int8', workers=2, cpu_threads=2, 
+                                   options=dict(beam_size=1), max_batch=8, batch_window=0.05, 
+                                   batch_max_size=262144, download_timeout=10)
+    # the model is loaded by the first call
+    await transcriber.transcribe(0, next(iter(corpus.values())))
+    latencies = list()
+    audios = list(corpus.values())
+
+    async def user(user_id):
+        for audio in audios[user_id::concurrency]:
+            started = time.monotonic()
+            await transcriber.transcribe(user_id, audio)
+            latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(user(user_id) for user_id in range(concurrency)))
+    total = time.monotonic() - started
+    await transcriber.close()
+    quantiles = statistics.quantiles(latencies, n=20) if len(latencies) > 1 else latencies * 19
+    print(f'{len(latencies)=}; {total=:.2f} s; p50={quantiles[9]:.3f} s; p95={quantiles[18]:.3f} s')
+
+
+def main():
+    corpus = load_corpus(sys.argv[1])
+    model = sys.argv[2] if len(sys.argv) > 2 else 'base'
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    asyncio.run(bench(corpus, model, concurrency))
+
+
+if __name__ == '__main__':
+    main()
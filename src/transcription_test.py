@@ -0,0 +1,223 @@
+from transcription import DeepgramTranscriber, LocalTranscriber, FairLimiter, TranscriptionError, AudioTooLargeError
+import transcription
+from ogg_synth import make_opus
+
+import pytest
+import asyncio
+import logging
+import httpx
+import json
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+
+_logger = logging.getLogger(__name__)
+
+
+MODELS = {'nova-2': dict(options=dict(model='nova-2', smart_format=True))}
+
+
+def deepgram_reply(transcript, duration):
+    return httpx.Response(200, json={'metadata': {'duration': duration},
+                                     'results': {'channels': [{'alternatives': [{'transcript': transcript}]}]}})
+
+
+def make_transcriber(handler, max_concurrency=2, max_attempts=3):
+    return DeepgramTranscriber(api_key='key', model='nova-2', models=MODELS, timeout=1,
+                               max_concurrency=max_concurrency, max_attempts=max_attempts, backoff=0,
+                               keepalive_expiry=10, transport=httpx.MockTransport(handler))
+
+
+def test_transcriber_must_post_audio_with_model_options():
+    requests = list()
+    def handler(request):
+        requests.append(request)
+        return deepgram_reply(' hello ', 1.5)
+
+    async def test():
+        sut = make_transcriber(handler)
+        assert await sut.transcribe(1, b'audio') == ('hello', 1.5)
+        await sut.close()
+
+    asyncio.run(test())
+    request, = requests
+    assert request.content == b'audio'
+    assert request.headers['authorization'] == 'Token key'
+    assert request.url.path == '/v1/listen'
+    assert request.url.params['model'] == 'nova-2'
+    assert request.url.params['smart_format'] == 'true'
+
+
+def test_transcriber_must_retry_server_errors_and_timeouts():
+    replies = [httpx.Response(503), httpx.ConnectTimeout('timeout'), deepgram_reply('hi', 1)]
+    def handler(request):
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+
+        return reply
+
+    async def test():
+        sut = make_transcriber(handler)
+        assert await sut.transcribe(1, b'audio') == ('hi', 1)
+        assert sut.retries == 2
+
+    asyncio.run(test())
+
+
+@pytest.mark.parametrize('status, attempts', [(400, 1), (500, 3)])
+def test_transcriber_must_give_up(status, attempts):
+    requests = list()
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(status)
+
+    async def test():
+        with pytest.raises(TranscriptionError):
+            await make_transcriber(handler).transcribe(1, b'audio')
+
+    asyncio.run(test())
+    assert len(requests) == attempts
+
+
+def test_fair_limiter_must_let_users_in_turn():
+    async def test():
+        sut = FairLimiter(1)
+        order = list()
+        async def hold(key, i):
+            async with sut.acquire(key):
+                order.append((key, i))
+                await asyncio.sleep(0)
+
+        tasks = [asyncio.create_task(hold(key, i)) for key, i in [(1, 0), (1, 1), (1, 2), (2, 0), (3, 0), (2, 1)]]
+        await asyncio.sleep(0)
+        assert sut.waiting == 5
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(test()) == [(1, 0), (1, 1), (2, 0), (3, 0), (1, 2), (2, 1)]
+
+
+def test_fair_limiter_must_drop_canceled_waiter():
+    async def test():
+        sut = FairLimiter(1)
+        release = asyncio.Event()
+        async def hold(key):
+            async with sut.acquire(key):
+                await release.wait()
+
+        holder = asyncio.create_task(hold(1))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold(2))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait([waiter])
+        assert sut.waiting == 0
+        release.set()
+        await holder
+        # the slot is free again
+        await asyncio.wait_for(hold(3), timeout=1)
+
+    asyncio.run(test())
+
+
+class ChunkedStream(httpx.AsyncByteStream):
+    def __init__(self, data, chunk_size):
+        self.__data = data
+        self.__chunk_size = chunk_size
+
+    async def __aiter__(self):
+        for i in range(0, len(self.__data), self.__chunk_size):
+            yield self.__data[i:i + self.__chunk_size]
+
+
+def voice_handler(voice, uploads, statuses=()):
+    statuses = list(statuses)
+    def handler(request):
+        if request.url.host == 'files.example.com':
+            return httpx.Response(200, stream=ChunkedStream(voice, 4096))
+
+        uploads.append(request.content)
+        status = statuses.pop(0) if statuses else 200
+        return deepgram_reply('hi', 2) if status == 200 else httpx.Response(status)
+
+    return handler
+
+
+def test_transcriber_must_stream_downloaded_audio_into_request():
+    voice, uploads = make_opus(10), list()
+    async def test():
+        sut = make_transcriber(voice_handler(voice, uploads, statuses=[502]))
+        assert await sut.transcribe_url(1, 'https://files.example.com/voice.oga', len(voice)) == ('hi', 2)
+
+    asyncio.run(test())
+    # the audio is downloaded again for the retry
+    assert uploads == [voice, voice]
+
+
+def test_transcriber_must_stop_downloading_too_large_audio():
+    voice, uploads = make_opus(10), list()
+    async def test():
+        sut = make_transcriber(voice_handler(voice, uploads))
+        with pytest.raises(AudioTooLargeError):
+            await sut.transcribe_url(1, 'https://files.example.com/voice.oga', len(voice) - 1)
+
+    asyncio.run(test())
+    assert uploads == list()
+
+
+class FakeWhisperModel:
+    def __init__(self):
+        self.calls = list()
+
+    def transcribe(self, audio, **options):
+        audio = audio.read()
+        self.calls.append((audio, options))
+        return [SimpleNamespace(text=f' {audio.decode()}'), SimpleNamespace(text=' text')], SimpleNamespace(duration=len(audio))
+
+
+@pytest.fixture
+def whisper_model(monkeypatch):
+    model = FakeWhisperModel()
+    monkeypatch.setattr(transcription, '_model', model)
+    return model
+
+
+def make_local_transcriber(max_batch=3, batch_window=0.05, batch_max_size=100):
+    return LocalTranscriber(model='tiny', compute_type='int8', workers=1, cpu_threads=1, options=dict(language='en'),
+                            max_batch=max_batch, batch_window=batch_window, batch_max_size=batch_max_size,
+                            download_timeout=1, executor=ThreadPoolExecutor(1))
+
+
+def test_local_transcriber_must_batch_short_audios(whisper_model):
+    async def test():
+        sut = make_local_transcriber(max_batch=3)
+        results = await asyncio.gather(*(sut.transcribe(user_id, f'a{user_id}'.encode()) for user_id in range(4)))
+        assert results == [(f'a{user_id} text', 2) for user_id in range(4)]
+        # a full batch is run at once, the rest waits for the window
+        assert sut.batches == 2
+        await sut.close()
+
+    asyncio.run(test())
+    assert whisper_model.calls[0] == (b'a0', dict(language='en'))
+
+
+def test_local_transcriber_must_run_long_audio_alone(whisper_model):
+    async def test():
+        sut = make_local_transcriber(batch_window=10, batch_max_size=2)
+        assert await asyncio.wait_for(sut.transcribe(1, b'long'), timeout=1) == ('long text', 4)
+        assert sut.batches == 1
+        await sut.close()
+
+    asyncio.run(test())
+
+
+def test_local_transcriber_must_fail_the_whole_batch(monkeypatch):
+    monkeypatch.setattr(transcription, '_model', None)
+    async def test():
+        sut = make_local_transcriber(max_batch=2)
+        results = await asyncio.gather(sut.transcribe(1, b'a'), sut.transcribe(2, b'b'), return_exceptions=True)
+        assert all(isinstance(result, AttributeError) for result in results)
+        await sut.close()
+
+    asyncio.run(test())
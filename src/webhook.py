@@ -0,0 +1,114 @@
+import metrics
+
+from telegram import Update
+from aiohttp import web
+import asyncio
+import logging
+import hmac
+
+
+_logger = logging.getLogger(__name__)
+
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Receives telegram updates over http. Accepted updates are queued and processed by a fixed number of workers.
+    Updates are rejected once the queue is full, so telegram redelivers them later. 
+    App is anything having bot and process_update(update) coroutine function"""
+
+    def __init__(self, app, url, listen, port, path, secret_token, max_queue, workers):
+        if not secret_token:
+            raise ValueError('Webhook secret token must be set')
+
+        if workers < 1:
+            raise ValueError(f'Workers number must be positive [{workers=}]')
+
+        self.__app = app
+        self.__url = url
+        self.__listen = listen
+        self.__port = port
+        self.__path = path
+        self.__secret_token = secret_token.encode('utf-8')
+        self.__queue = asyncio.Queue(maxsize=max_queue)
+        self.__workers_num = workers
+        self.__workers = list()
+        self.__runner = None
+        self.accepted = 0
+        self.rejected = 0
+        metrics.register('webhook_queue', lambda: self.__queue.qsize())
+        metrics.register('webhook_accepted', lambda: self.accepted)
+        metrics.register('webhook_rejected', lambda: self.rejected)
+
+
+    async def start(self):
+        web_app = web.Application()
+        web_app.router.add_post(self.__path, self.__handle)
+        self.__runner = runner = web.AppRunner(web_app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.__listen, self.__port).start()
+        self.__workers = [asyncio.create_task(self.__work()) for _ in range(self.__workers_num)]
+        _logger.info(f'Webhook is listening [{self.__listen=}; {self.__port=}; {self.__path=}]')
+        if self.__url:
+            await self.__app.bot.set_webhook(self.__url, 
+                                             secret_token=self.__secret_token.decode('utf-8'), 
+                                             allowed_updates=Update.ALL_TYPES)
+
+
+    async def stop(self, drain_timeout):
+        """Stops accepting updates and waits for the accepted ones to be processed"""
+
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+        try:
+            await asyncio.wait_for(self.__queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            _logger.warning(f'Webhook updates are not drained [{self.__queue.qsize()=}]')
+
+        workers = self.__workers
+        for worker in workers:
+            worker.cancel()
+
+        if workers:
+            await asyncio.wait(workers)
+
+        self.__workers = list()
+
+
+    async def __handle(self, request):
+        token = request.headers.get(SECRET_TOKEN_HEADER, '').encode('utf-8')
+        if not hmac.compare_digest(token, self.__secret_token):
+            _logger.warning(f'Webhook request with invalid secret token [{request.remote=}]')
+            return web.Response(status=403)
+
+        try:
+            update = Update.de_json(await request.json(), self.__app.bot)
+        except ValueError as e:
+            _logger.warning(f'Malformed webhook request [{e!r}]')
+            return web.Response(status=400)
+
+        try:
+            self.__queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503)
+
+        self.accepted += 1
+        return web.Response()
+
+
+    async def __work(self):
+        app, queue = self.__app, self.__queue
+        while True:
+            update = await queue.get()
+            try:
+                await app.process_update(update)
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                _logger.error('Update processing failed', exc_info=e)
+            finally:
+                queue.task_done()
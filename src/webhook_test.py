@@ -0,0 +1,75 @@
+from webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+from aiohttp import ClientSession
+import pytest
+import asyncio
+import logging
+import socket
+
+
+_logger = logging.getLogger(__name__)
+
+SECRET_TOKEN = 'secret'
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = None
+        self.release = asyncio.Event()
+        self.updates = list()
+
+    async def process_update(self, update):
+        await self.release.wait()
+        self.updates.append(update.update_id)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_sut(app, port, max_queue=10):
+    return WebhookServer(app, url='', listen='127.0.0.1', port=port, path='/telegram', 
+                         secret_token=SECRET_TOKEN, max_queue=max_queue, workers=1)
+
+
+async def post(session, port, update_id, secret_token=SECRET_TOKEN):
+    async with session.post(f'http://127.0.0.1:{port}/telegram', 
+                            json=dict(update_id=update_id), 
+                            headers={SECRET_TOKEN_HEADER: secret_token}) as resp:
+        return resp.status
+
+
+def test_webhook_must_reject_invalid_secret_token():
+    async def test():
+        app, port = FakeApplication(), free_port()
+        sut = make_sut(app, port)
+        await sut.start()
+        async with ClientSession() as session:
+            assert await post(session, port, 1, secret_token='wrong') == 403
+
+        await sut.stop(drain_timeout=1)
+        assert app.updates == []
+
+    asyncio.run(test())
+
+
+def test_webhook_must_reject_updates_when_queue_is_full_and_drain_accepted_ones_on_stop():
+    async def test():
+        app, port = FakeApplication(), free_port()
+        sut = make_sut(app, port, max_queue=2)
+        await sut.start()
+        async with ClientSession() as session:
+            # the first one is taken by the worker
+            statuses = [await post(session, port, update_id) for update_id in range(1, 5)]
+
+        assert statuses == [200, 200, 200, 503]
+        stopping = asyncio.create_task(sut.stop(drain_timeout=5))
+        await asyncio.sleep(0.05)
+        app.release.set()
+        await stopping
+        assert app.updates == [1, 2, 3]
+        assert (sut.accepted, sut.rejected) == (3, 1)
+
+    asyncio.run(test())